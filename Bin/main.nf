@@ -32,10 +32,10 @@ workflow {
     tap  = train_tap_model()
 
     // Step 2: Train classifier head
-    cls  = train_cls_head(tap.tap_model_dir, prep.test_data)
+    cls  = train_cls_head(tap.tap_model_dir, prep.crop_store)
 
-    // Step 3: Analyze predictions
-    probe = probe_model(cls.cls_model, prep.test_data, tap.tap_model_dir)
+    // Step 3: Analyze predictions (the test view references the crop store next to it)
+    probe = probe_model(cls.cls_model, cls.test_data, cls.crop_store, tap.tap_model_dir)
 }
 
 // --- DATA PREP ---
@@ -44,7 +44,7 @@ process data_prep {
     tag "🧼 Data preprocessing"
 
     output:
-    path 'dataset_output/test_data_crops_flat.pth', emit: test_data
+    path 'dataset_output/preprocessed_image_crops', emit: crop_store
 
     container 'tap_pipeline:latest'
 
@@ -61,11 +61,6 @@ process data_prep {
         --crops_per_image 1 \
         --subsample 1 \
         --binarize
-
-    # Move output for Nextflow tracking
-    if [ -f dataset_output/preprocessed_image_crops.pth ]; then
-        mv dataset_output/preprocessed_image_crops.pth dataset_output/test_data_crops_flat.pth
-    fi
     """
 }
 
@@ -118,11 +113,13 @@ process train_cls_head {
 
     input:
     path tap_model_dir
-    path test_data
+    path crop_store
 
     output:
     path 'cls_model.pth', emit: cls_model
-    path 'dataset_output/test_data_crops_flat.pth', emit: test_data
+    // index view of the test split and the (staged) crop store it points to
+    path 'test_data_crops_flat.npz', emit: test_data
+    path 'preprocessed_image_crops', emit: crop_store, includeInputs: true
 
     container 'tap_pipeline:latest'
 
@@ -157,6 +154,7 @@ process probe_model {
     input:
     path cls_model
     path test_data
+    path crop_store
     path tap_model_dir
 
     output:
@@ -248,7 +248,7 @@ EOL
         --masks_path "$INPUT_MASK" \
         --TAP_model_load_path "$TAP_MODEL_DIR" \
         --patch_size "$CROP_SIZE" \
-        --test_data_load_path "$OUTDIR/test_data_crops_flat.pth" \
+        --test_data_load_path "$OUTDIR/test_data_crops_flat.npz" \
         --combined_model_load_dir "$MODEL_RUN_DIR" \
         --model_id "$MODEL_ID" \
         --cls_head_arch linear \
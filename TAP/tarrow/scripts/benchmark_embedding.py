@@ -0,0 +1,111 @@
+"""Throughput and memory per batch of `TimeArrowNet.embedding` against the full projection forward pass.
+
+    python benchmark_embedding.py --backbones unet resnet32 --batchsizes 16 64 --gpu cpu --output embedding.csv
+
+`forward` is the previous implementation of `embedding`: the full projection forward pass
+with all layer outputs captured by hooks. `embedding` runs only up to the requested layer
+and captures nothing. Retained memory counts the activations still referenced by the model
+after the call; peak memory is only measured on cuda.
+"""
+
+import argparse
+import csv
+import logging
+from time import time as now
+
+import torch
+
+import tarrow
+from tarrow.models import TimeArrowNet
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _forward_embedding(model, x, layer):
+    model(x, mode="projection")
+    features = model.projection_head.features[layer]
+    return features.reshape(x.shape[:2] + features.shape[1:])
+
+
+def _retained_bytes(model):
+    tensors = list(model.projection_head.features.values())
+    if model.proj_activations is not None:
+        tensors.append(model.proj_activations)
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+@torch.no_grad()
+def benchmark(model, fn, x, layer, steps, warmup):
+    """Items/s, retained and peak (cuda only) bytes of `fn(model, x, layer)`."""
+    cuda = x.device.type == "cuda"
+    for _ in range(warmup):
+        fn(model, x, layer)
+
+    model.projection_head.features.clear()
+    model.proj_activations = None
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated() if cuda else 0
+    start = now()
+    for _ in range(steps):
+        z = fn(model, x, layer)
+        del z
+    if cuda:
+        torch.cuda.synchronize()
+    rate = steps * len(x) / (now() - start)
+    peak = torch.cuda.max_memory_allocated() - base if cuda else None
+    return rate, _retained_bytes(model), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backbones", nargs="+", default=["unet", "resnet32", "simple"])
+    parser.add_argument("--projhead", default="minimal_batchnorm")
+    parser.add_argument("--layer", type=int, default=0)
+    parser.add_argument("--batchsizes", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--size", type=int, default=96)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--gpu", "-g", type=str, default="0")
+    parser.add_argument("--output", type=str, default=None, help="Optional csv file for the results.")
+    args = parser.parse_args()
+
+    device, _ = tarrow.utils.set_device(args.gpu)
+    torch.manual_seed(0)
+
+    rows = []
+    for backbone in args.backbones:
+        model = TimeArrowNet(backbone=backbone, projection_head=args.projhead, device=device)
+        model.to(device).eval()
+        for batchsize in args.batchsizes:
+            x = torch.rand((batchsize, model.n_frames, 1, args.size, args.size), device=device)
+            for name, fn in (("forward", _forward_embedding), ("embedding", TimeArrowNet.embedding)):
+                rate, retained, peak = benchmark(model, fn, x, args.layer, args.steps, args.warmup)
+                rows.append(
+                    dict(
+                        backbone=backbone,
+                        batchsize=batchsize,
+                        method=name,
+                        items_per_s=round(rate, 2),
+                        retained_mb=round(retained / 2**20, 2),
+                        peak_mb=None if peak is None else round(peak / 2**20, 2),
+                    )
+                )
+                logger.info(
+                    f"{backbone:12} bs={batchsize:<4} {name:10} {rate:10.1f} items/s "
+                    f"retained {retained / 2**20:8.2f} MB"
+                    + ("" if peak is None else f" peak {peak / 2**20:8.2f} MB")
+                )
+
+    if args.output is not None:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        logger.info(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
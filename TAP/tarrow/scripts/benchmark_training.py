@@ -0,0 +1,119 @@
+"""Training throughput (steps/s) of TimeArrowNet backbones, in float32, mixed precision and channels-last.
+
+    python benchmark_training.py --backbones unet resnet18 --size 96 --batchsize 32 --gpu cpu
+
+Each step is a forward and backward pass as in `TimeArrowNet.fit` on random frame pairs.
+"""
+
+import argparse
+import logging
+from time import time as now
+
+import torch
+
+import tarrow
+from tarrow.models import TimeArrowNet
+from tarrow.models.losses import DecorrelationLoss
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKBONES = (
+    "unet",
+    "lnet",
+    "unet_16fmaps",
+    "resnet_bioimage_wider",
+    "resnet32",
+    "resnet32_32fmaps",
+    "resnet18",
+    "simple",
+    "fpn_resnet",
+)
+
+MODES = dict(
+    fp32=dict(mixed_precision=False, channels_last=False),
+    amp=dict(mixed_precision=True, channels_last=False),
+    channels_last=dict(mixed_precision=False, channels_last=True),
+    amp_channels_last=dict(mixed_precision=True, channels_last=True),
+)
+
+
+def benchmark(backbone, mixed_precision, channels_last, device, size, batchsize, steps, warmup):
+    """Steps/s of training `backbone` on random batches of shape (batchsize, 2, 1, size, size)."""
+    model = TimeArrowNet(backbone=backbone, device=device).to(device)
+    model.train()
+    model.channels_last = channels_last
+    if channels_last:
+        model.backbone.to(memory_format=torch.channels_last)
+
+    amp_device = torch.device(device).type
+    amp_dtype = torch.float16 if amp_device == "cuda" else torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler() if mixed_precision and amp_device == "cuda" else None
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = torch.nn.CrossEntropyLoss()
+    criterion_decorr = DecorrelationLoss()
+
+    x = torch.rand((batchsize, 2, 1, size, size), device=device)
+    y = torch.randint(0, 2, (batchsize,), device=device)
+
+    def _step():
+        optimizer.zero_grad()
+        with torch.autocast(amp_device, dtype=amp_dtype, enabled=mixed_precision):
+            out, pro = model(x, mode="both")
+        out, pro = out.float(), pro.float()
+        if out.ndim > 2:
+            out = torch.mean(out, tuple(range(2, out.ndim)))
+        loss = criterion(out, y) + 0.01 * criterion_decorr(pro.flatten(0, 1))
+        if scaler is None:
+            loss.backward()
+            optimizer.step()
+        else:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+    for _ in range(warmup):
+        _step()
+    if amp_device == "cuda":
+        torch.cuda.synchronize()
+    start = now()
+    for _ in range(steps):
+        _step()
+    if amp_device == "cuda":
+        torch.cuda.synchronize()
+    return steps / (now() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backbones", nargs="+", default=list(BACKBONES), choices=BACKBONES)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--size", type=int, default=96)
+    parser.add_argument("--batchsize", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--gpu", "-g", type=str, default="0")
+    args = parser.parse_args()
+
+    device, _ = tarrow.utils.set_device(args.gpu)
+    torch.manual_seed(0)
+
+    logger.info(f"{'backbone':24}" + "".join(f"{m:>20}" for m in args.modes) + "   (steps/s)")
+    for backbone in args.backbones:
+        rates = [
+            benchmark(
+                backbone,
+                device=device,
+                size=args.size,
+                batchsize=args.batchsize,
+                steps=args.steps,
+                warmup=args.warmup,
+                **MODES[m],
+            )
+            for m in args.modes
+        ]
+        logger.info(f"{backbone:24}" + "".join(f"{r:20.2f}" for r in rates))
+
+
+if __name__ == "__main__":
+    main()
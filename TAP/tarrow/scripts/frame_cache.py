@@ -0,0 +1,11 @@
+"""List, check and prune the on-disk cache of preprocessed frame stacks.
+
+    python frame_cache.py list
+    python frame_cache.py check
+    python frame_cache.py prune --stale --older_than 30 --max_size 50
+"""
+
+from tarrow.data.frame_cache import main
+
+if __name__ == "__main__":
+    main()
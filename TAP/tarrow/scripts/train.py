@@ -14,7 +14,7 @@ from torch.utils.data import ConcatDataset, Subset, Dataset
 
 import tarrow
 from tarrow.models import TimeArrowNet
-from tarrow.data import TarrowDataset, get_augmenter
+from tarrow.data import TarrowDataset, BatchCropLoader, ShardedRandomSampler, get_augmenter
 from tarrow.visualizations import create_visuals
 
 
@@ -121,7 +121,13 @@ def get_argparser():
         "--reject_background",
         type=tarrow.utils.str2bool,
         default=False,
-        help="Set to `True` to heuristically reject background patches during training.",
+        help="Set to `True` to heuristically reject background patches during training: crops are drawn where the intensity std of the block-averaged frames (about 8x8 cells per crop) exceeds 0.02.",
+    )
+    p.add(
+        "--batch_crops",
+        type=tarrow.utils.str2bool,
+        default=False,
+        help="Set to `True` to gather each training/validation batch with a single batched crop instead of per-sample DataLoader workers.",
     )
     p.add(
         "--cam_subsampling",
@@ -175,6 +181,12 @@ def get_argparser():
         default=0.01,
         help="Relative weighting of the decorrelation loss.",
     )
+    p.add(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache normalized input frames in this folder to speed up subsequent runs.",
+    )
     p.add("--save_checkpoint_every", type=int, default=25)
     p.add("--num_workers", type=int, default=8, help="Number of CPU workers.")
     p.add(
@@ -185,6 +197,32 @@ def get_argparser():
         help="GPUs to use. Can be a single integer, a comma-separated list of integers, or an interval `a-b`, or 'cpu'.",
     )
     p.add("--tensorboard", type=tarrow.utils.str2bool, default=True)
+    p.add(
+        "--mixed_precision",
+        type=tarrow.utils.str2bool,
+        default=False,
+        help="Set to `True` to train with autocast (float16 with gradient scaling on GPU, bfloat16 on CPU).",
+    )
+    p.add(
+        "--channels_last",
+        type=tarrow.utils.str2bool,
+        default=False,
+        help="Set to `True` to run the backbone in channels-last memory format.",
+    )
+    p.add(
+        "--compile",
+        type=tarrow.utils.str2bool,
+        default=False,
+        help="Set to `True` to run the model with `torch.compile`.",
+    )
+    p.add(
+        "--export",
+        choices=["torchscript", "export"],
+        default=None,
+        help="Also export the best model for inference without the tarrow code (TorchScript or `torch.export`). "
+        "`export` has dynamic batch and frame sizes only if the backbone allows it (e.g. `simple`), "
+        "otherwise the input size is fixed to the example input, as with TorchScript.",
+    )
     p.add(
         "--visual_dataset_frequency",
         type=int,
@@ -245,6 +283,7 @@ def _build_dataset(
         binarize=args.binarize,
         random_crop=random_crop,
         reject_background=reject_background,
+        cache_dir=args.cache_dir,
     )
 
 
@@ -253,7 +292,38 @@ def _subset(data: Dataset, split=(0, 1.0)):
     return Subset(data, range(low, high))
 
 
-def _create_loader(dataset, args, num_samples, num_workers, idx=None, sequential=False):
+def _create_loader(
+    dataset,
+    args,
+    num_samples,
+    num_workers,
+    idx=None,
+    sequential=False,
+    augmenter=None,
+    rank=0,
+    world_size=1,
+):
+    """With several processes, each draws `num_samples / world_size` samples per epoch."""
+    if args.batch_crops and not sequential:
+        # the generator is seeded from the (per-process) global seed
+        return BatchCropLoader(
+            dataset,
+            batch_size=args.batchsize,
+            num_samples=-(-num_samples // world_size),
+            augmenter=augmenter,
+        )
+    if not sequential and world_size > 1:
+        sampler = ShardedRandomSampler(
+            dataset,
+            num_samples=num_samples,
+            seed=args.seed,
+            num_shards=world_size,
+            shard=rank,
+        )
+    elif not sequential:
+        sampler = torch.utils.data.RandomSampler(
+            dataset, replacement=True, num_samples=num_samples
+        )
     return torch.utils.data.DataLoader(
         dataset,
         sampler=(
@@ -266,9 +336,7 @@ def _create_loader(dataset, args, num_samples, num_workers, idx=None, sequential
                 )
             )
             if sequential
-            else torch.utils.data.RandomSampler(
-                dataset, replacement=True, num_samples=num_samples
-            )
+            else sampler
         ),
         batch_size=args.batchsize,
         num_workers=num_workers,
@@ -339,7 +407,18 @@ def main(args):
     args.split_train = _convert_to_split_pairs(args.split_train)
     args.split_val = _convert_to_split_pairs(args.split_val)
 
-    outdir = _build_outdir_path(args)
+    device, n_gpus = tarrow.utils.set_device(args.gpu)
+    rank, world_size, device = tarrow.utils.init_distributed(device)
+    if n_gpus > 1 and world_size == 1:
+        raise NotImplementedError(
+            "Multi-GPU training needs one process per GPU, launch with `torchrun --nproc_per_node N`."
+        )
+    main_process = rank == 0
+    if not main_process:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    # only rank 0 writes logs, checkpoints and visuals
+    outdir = _build_outdir_path(args) if main_process else None
 
     try:
         repo = git.Repo(Path(__file__).resolve().parents[1])
@@ -347,13 +426,11 @@ def main(args):
     except git.InvalidGitRepositoryError:
         pass
 
-    tarrow.utils.seed(args.seed)
+    # different random crops and augmentations in each process
+    tarrow.utils.seed(args.seed + rank)
 
-    device, n_gpus = tarrow.utils.set_device(args.gpu)
-    if n_gpus > 1:
-        raise NotImplementedError("Multi-GPU training not implemented yet.")
-
-    augmenter = get_augmenter(args.augment)
+    # with batched crops, whole batches are augmented by the loader after collation
+    augmenter = get_augmenter(args.augment, batch=args.batch_crops)
 
     inputs = {}
     for inp, phase in zip((args.input_train, args.input_val), ("train", "val")):
@@ -385,7 +462,7 @@ def main(args):
             args=args,
             n_frames=args.frames,
             delta_frames=args.delta,
-            augmenter=augmenter,
+            augmenter=None if args.batch_crops else augmenter,
             reject_background=args.reject_background,
         )
         for split in args.split_train
@@ -413,6 +490,9 @@ def main(args):
         num_samples=args.train_samples_per_epoch,
         num_workers=args.num_workers,
         args=args,
+        augmenter=augmenter,
+        rank=rank,
+        world_size=world_size,
     )
 
     loader_val = _create_loader(
@@ -420,6 +500,8 @@ def main(args):
         num_samples=args.val_samples_per_epoch,
         num_workers=0,
         args=args,
+        rank=rank,
+        world_size=world_size,
     )
 
     logger.info(f"Training set: {len(data_train)} images")
@@ -439,13 +521,16 @@ def main(args):
 
     model = TimeArrowNet(**model_kwargs)
     model.to(device)
+    if args.compile:
+        model.compile()
 
     logger.info(
         f"Number of params: {sum(p.numel() for p in model.parameters())/1.e6:.2f} M"
     )
 
-    with open(outdir / "train_args.yaml", "tw") as f:
-        yaml.dump(vars(args), f)
+    if main_process:
+        with open(outdir / "train_args.yaml", "tw") as f:
+            yaml.dump(vars(args), f)
 
     assert args.ndim == 2
 
@@ -456,7 +541,7 @@ def main(args):
         lr_scheduler=args.lr_scheduler,
         lr_patience=args.lr_patience,
         epochs=args.epochs,
-        steps_per_epoch=args.train_samples_per_epoch // args.batchsize,
+        steps_per_epoch=args.train_samples_per_epoch // (args.batchsize * world_size),
         visual_datasets=tuple(
             Subset(d, list(range(0, len(d), 1 + (len(d) // args.cam_subsampling))))
             for d in data_visuals
@@ -465,11 +550,16 @@ def main(args):
         tensorboard=args.tensorboard > 0,
         save_checkpoint_every=args.save_checkpoint_every,
         lambda_decorrelation=args.decor_loss,
+        mixed_precision=args.mixed_precision,
+        channels_last=args.channels_last,
+        export=args.export,
     )
 
-    if args.write_final_cams:
+    if args.write_final_cams and main_process:
         _write_cams(data_visuals, model, device)
 
+    tarrow.utils.cleanup_distributed()
+
 
 if __name__ == "__main__":
     parser = get_argparser()
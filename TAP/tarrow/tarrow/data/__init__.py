@@ -1,3 +1,7 @@
-from .tarrow_dataset import TarrowDataset, ConcatDatasetWithIndex
+from .tarrow_dataset import TarrowDataset, ConcatDatasetWithIndex, BatchCropLoader
+from .frame_store import FrameStore
+from .crop_store import CropStore, CropStoreWriter, open_crops
+from .samplers import BalancedSampler, ShardedRandomSampler
+from .chunked_array import ChunkedArray, ChunkedArrayWriter
 from .augmentations import *
 from .augmenters import get_augmenter
@@ -24,12 +24,72 @@ def tensor_grid(shape):
     return torch.tensor(u0).float().unsqueeze(0)
 
 
+_grid_cache = dict()
+
+
+def cached_tensor_grid(shape, device="cpu"):
+    """`tensor_grid(shape)`, cached per (shape, device). Do not modify the result in place."""
+    key = (tuple(shape), str(device))
+    if key not in _grid_cache:
+        _grid_cache[key] = tensor_grid(tuple(shape)).to(device)
+    return _grid_cache[key]
+
+
 def torch_uniform(low, high, shape):
     x = torch.rand(shape)
     x = low + (high - low) * x
     return x
 
 
+def _expand_mask(mask, ndim):
+    return mask.reshape(mask.shape + (1,) * (ndim - mask.ndim))
+
+
+def pad_grid(grid, padding_mode):
+    """Applies the padding of `F.grid_sample` (align_corners=True) to normalized positions.
+
+    Args:
+        grid: Normalized (x, y) positions of shape (..., H, W, 2) in an image of size (H, W).
+
+    Returns:
+        Tuple (grid, weight): positions mapped into [-1, 1], and the weight of the value
+        at these positions (grid.shape[:-1]). For `zeros` padding, positions are clamped to
+        the border and the weight falls off linearly to 0 within one pixel outside, as
+        for bilinear interpolation with zeros.
+    """
+    weight = None
+    if padding_mode == "reflection":
+        grid = torch.remainder(grid + 1, 4)
+        grid = torch.where(grid > 2, 4 - grid, grid) - 1
+    elif padding_mode == "zeros":
+        H, W = grid.shape[-3:-1]
+        half = grid.new_tensor([max(W - 1, 1) / 2, max(H - 1, 1) / 2])
+        outside = (grid.abs() - 1).clamp(min=0) * half
+        weight = (1 - outside).clamp(min=0).prod(-1)
+        grid = grid.clamp(-1, 1)
+    elif padding_mode == "border":
+        grid = grid.clamp(-1, 1)
+    else:
+        raise ValueError(f"unknown padding mode {padding_mode}")
+    if weight is None:
+        weight = grid.new_ones(grid.shape[:-1])
+    return grid, weight
+
+
+def grid_sample_batch(x, grid, mode="bilinear", padding_mode="reflection"):
+    """`F.grid_sample` for a batch x of shape (B, T, C, H, W) and grid of shape (B, T, H, W, 2)."""
+    B, T = x.shape[:2]
+    grid = grid.broadcast_to((B, T) + x.shape[-2:] + (2,))
+    y = F.grid_sample(
+        x.flatten(0, 1),
+        grid.flatten(0, 1).to(x.dtype),
+        mode=mode,
+        padding_mode=padding_mode,
+        align_corners=True,
+    )
+    return y.reshape(x.shape)
+
+
 class BaseTransform(torch.nn.Module, ABC):
     def __init__(self, probability: float = 1.0):
         super().__init__()
@@ -39,6 +99,19 @@ class BaseTransform(torch.nn.Module, ABC):
     def forward_impl(self, x: torch.Tensor):
         pass
 
+    def forward_batch(self, x: torch.Tensor, mask: torch.Tensor):
+        """Transforms a batch (B, T, C, H, W) with independent random parameters per sample.
+
+        Only samples where the boolean `mask` of shape (B,) is set are transformed.
+        Falls back to transforming sample by sample.
+        """
+        return torch.stack(
+            tuple(self.forward_impl(_x) if _m else _x for _x, _m in zip(x, mask))
+        )
+
+    def sample_mask(self, batch_size: int, device="cpu"):
+        return (torch.rand(batch_size) <= self._probability).to(device)
+
     @torch.no_grad()
     def forward(self, x: torch.Tensor):
         if x.ndim == 4:
@@ -48,42 +121,82 @@ class BaseTransform(torch.nn.Module, ABC):
             else:
                 return x
         elif x.ndim == 5:
-            p = torch.rand(len(x))
-            return torch.stack(
-                tuple(
-                    self.forward_impl(_x) if _p <= self._probability else _x
-                    for _x, _p in zip(x, p)
-                )
-            )
+            return self.forward_batch(x, self.sample_mask(len(x), x.device))
         else:
             raise ValueError("Transform assumes 4D or 5D data! (B),T,C,H,W")
 
 
+class GeometricTransform(BaseTransform):
+    """Transform that resamples the image along a coordinate grid.
+
+    Batches are transformed by warping a cached base grid and a single `grid_sample`.
+    Consecutive geometric transforms in a `BatchAugmenter` share one `grid_sample`.
+    """
+
+    _mode = "bilinear"
+    _padding_mode = "reflection"
+
+    @abstractmethod
+    def warp_grid(self, grid: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """Maps output to input sampling positions.
+
+        Args:
+            grid: Normalized (x, y) positions of shape (B, T, H, W, 2), with align_corners=True.
+            mask: Boolean tensor of shape (B,), samples to transform.
+
+        Returns:
+            Warped grid of the same shape.
+        """
+
+    def can_warp(self) -> bool:
+        return True
+
+    @torch.no_grad()
+    def forward_batch(self, x, mask):
+        if not self.can_warp():
+            return super().forward_batch(x, mask)
+        if not mask.any():
+            return x
+        B, T = x.shape[:2]
+        grid = cached_tensor_grid(x.shape[-2:], x.device)
+        grid = grid.expand((B, T) + grid.shape[1:])
+        grid = self.warp_grid(grid, mask)
+        y = grid_sample_batch(x, grid, self._mode, self._padding_mode)
+        return torch.where(_expand_mask(mask, x.ndim), y, x)
+
+
 class RandomFlipRot(BaseTransform):
     def forward_impl(self, x):
         dims = (2 + np.where(np.random.randint(0, 2, 2) == 0)[0]).tolist()
         return torch.flip(x, dims)
 
+    def forward_batch(self, x, mask):
+        flips = (torch.randint(0, 2, (len(x), 2)) == 0).to(x.device) & mask[:, None]
+        for i, dim in enumerate((3, 4)):
+            x = torch.where(_expand_mask(flips[:, i], x.ndim), x.flip(dim), x)
+        return x
+
 
-class RandomRotate(BaseTransform):
+class RandomRotate(GeometricTransform):
     def __init__(self, mode="bilinear", padding_mode="reflection", probability=1.0):
         super().__init__(probability=probability)
         self._mode = mode
         self._padding_mode = padding_mode
-        self._grid_cache = dict()
 
     def _get_grid(self, n_frames, shape):
-        # if shape in self._grid_cache:
-        # return self._grid_cache[shape]
-        # else:
-        # grid = tensor_grid(shape)
-        # grid = grid.expand((n_frames,) + shape + (2,)).unsqueeze(-1)
-        # self._grid_cache[shape] = grid
-        # return grid
-        grid = tensor_grid(shape)
+        grid = cached_tensor_grid(shape)
         grid = grid.expand((n_frames,) + shape + (2,)).unsqueeze(-1)
         return grid
 
+    def warp_grid(self, grid, mask):
+        w = 2 * np.pi * torch.rand(len(grid)).to(grid.device)
+        cos, sin = torch.cos(w), torch.sin(w)
+        # same rotation matrix [[cos, sin], [-sin, cos]] as `forward_impl`
+        M_rot = torch.stack((torch.stack((cos, sin), -1), torch.stack((-sin, cos), -1)), -2)
+        M_rot = M_rot.reshape(len(grid), 1, 1, 1, 2, 2)
+        warped = torch.matmul(M_rot, grid.unsqueeze(-1)).squeeze(-1)
+        return torch.where(_expand_mask(mask, grid.ndim), warped, grid)
+
     def forward_impl(self, x):
         # x -> TCHW
 
@@ -115,7 +228,7 @@ class RandomRotate(BaseTransform):
         )
 
 
-class RandomElastic(BaseTransform):
+class RandomElastic(GeometricTransform):
     def __init__(
         self,
         grid=(5, 5),
@@ -154,7 +267,7 @@ class RandomElastic(BaseTransform):
             amount.moveaxis(-1, 1), spatial_shape, align_corners=True, mode="bilinear"
         ).moveaxis(1, -1)
 
-        grid = tensor_grid(spatial_shape)
+        grid = cached_tensor_grid(spatial_shape)
 
         grid = grid + amount
 
@@ -168,8 +281,35 @@ class RandomElastic(BaseTransform):
             align_corners=align_corners,
         )
 
+    def warp_grid(self, grid, mask):
+        B, T = grid.shape[:2]
+        spatial_shape = grid.shape[2:4]
+        amount_normed = self._amount / torch.tensor(spatial_shape)
+
+        if self._axis is None:
+            n = 1
+        elif self._axis == 0:
+            n = T
+        else:
+            raise ValueError()
+        amount = torch_uniform(-1, 1, (B * n,) + self._grid + (2,)) * amount_normed
+        amount = amount.moveaxis(-1, 1).to(grid.device)
+        if n == 1:
+            amount = amount.repeat_interleave(T, dim=0)
+
+        # bilinear lookup of the coarse displacement field at the (possibly warped) positions
+        disp = F.grid_sample(
+            amount,
+            grid.flatten(0, 1),
+            mode="bilinear",
+            padding_mode="border",
+            align_corners=True,
+        )
+        disp = disp.moveaxis(1, -1).reshape(grid.shape)
+        return grid + disp * _expand_mask(mask, grid.ndim)
+
 
-class RandomAffine(BaseTransform):
+class RandomAffine(GeometricTransform):
     def __init__(
         self,
         degrees=0,
@@ -187,6 +327,8 @@ class RandomAffine(BaseTransform):
         else:
             raise ValueError()
 
+        self._mode = interpolation
+        self._padding_mode = "zeros"
         interpolation = {
             "nearest": torchvision.transforms.functional.InterpolationMode.NEAREST,
             "bilinear": torchvision.transforms.functional.InterpolationMode.BILINEAR,
@@ -210,6 +352,61 @@ class RandomAffine(BaseTransform):
                 tuple(self.transform(_x) for _x in torch.split(x, 1, dim=self._axis))
             )
 
+    def can_warp(self):
+        return (
+            self._axis in (None, 0)
+            and self.transform.fill in (0, 0.0)
+            and self.transform.center is None
+        )
+
+    def _sample_params(self, n, size):
+        """Same distributions as `torchvision.transforms.RandomAffine.get_params`, n at once."""
+        t = self.transform
+        width, height = size
+        angle = torch_uniform(*t.degrees, (n,))
+        if t.translate is not None:
+            max_dx, max_dy = t.translate[0] * width, t.translate[1] * height
+            tx = torch.round(torch_uniform(-max_dx, max_dx, (n,)))
+            ty = torch.round(torch_uniform(-max_dy, max_dy, (n,)))
+        else:
+            tx = ty = torch.zeros(n)
+        if t.scale is not None:
+            scale = torch_uniform(*t.scale, (n,))
+        else:
+            scale = torch.ones(n)
+        shear_x = shear_y = torch.zeros(n)
+        if t.shear is not None:
+            shear_x = torch_uniform(t.shear[0], t.shear[1], (n,))
+            if len(t.shear) == 4:
+                shear_y = torch_uniform(t.shear[2], t.shear[3], (n,))
+        return angle, tx, ty, scale, shear_x, shear_y
+
+    def warp_grid(self, grid, mask):
+        # Inverse affine matrix as in `torchvision.transforms.functional.affine`,
+        # acting on pixel coordinates relative to the image center
+        B, T, H, W = grid.shape[:4]
+        n = T if self._axis == 0 else 1
+        angle, tx, ty, scale, shear_x, shear_y = self._sample_params(B * n, (W, H))
+
+        rot = torch.deg2rad(angle)
+        sx, sy = torch.deg2rad(shear_x), torch.deg2rad(shear_y)
+        a = torch.cos(rot - sy) / torch.cos(sy)
+        b = -torch.cos(rot - sy) * torch.tan(sx) / torch.cos(sy) - torch.sin(rot)
+        c = torch.sin(rot - sy) / torch.cos(sy)
+        d = -torch.sin(rot - sy) * torch.tan(sx) / torch.cos(sy) + torch.cos(rot)
+        M = torch.stack((torch.stack((d, -b), -1), torch.stack((-c, a), -1)), -2)
+        M = M / scale[:, None, None]
+        offset = -torch.einsum("nij,nj->ni", M, torch.stack((tx, ty), -1))
+
+        M = M.reshape(B, n, 1, 1, 2, 2).to(grid.device)
+        offset = offset.reshape(B, n, 1, 1, 2).to(grid.device)
+        half = torch.tensor(
+            [max(W - 1, 1) / 2, max(H - 1, 1) / 2], device=grid.device
+        )
+        pix = grid * half
+        warped = (torch.matmul(M, pix.unsqueeze(-1)).squeeze(-1) + offset) / half
+        return torch.where(_expand_mask(mask, grid.ndim), warped, grid)
+
 
 class RandomIntensity(BaseTransform):
     def __init__(
@@ -237,6 +434,19 @@ class RandomIntensity(BaseTransform):
         x = scale * x + shift
         return x
 
+    def forward_batch(self, x, mask):
+        ax = tuple(range(x.ndim - 1))
+        ax = tuple(1 + ax[a] for a in self._axis)
+        shape = (len(x),) + tuple(
+            x.shape[i] if i in ax else 1 for i in range(1, x.ndim)
+        )
+        m = _expand_mask(mask, x.ndim)
+        scale = torch_uniform(*self._scale, shape=shape).to(x.device)
+        shift = torch_uniform(*self._shift, shape=shape).to(x.device)
+        scale = torch.where(m, scale, torch.ones_like(scale))
+        shift = torch.where(m, shift, torch.zeros_like(shift))
+        return scale * x + shift
+
 
 class RandomNoise(BaseTransform):
     def __init__(self, sigma=0.05, probability=1.0):
@@ -248,6 +458,72 @@ class RandomNoise(BaseTransform):
         x = x + torch.rand(1)[0] * self._sigma * torch.rand(*x.shape).to(x.device)
         return x
 
+    def forward_batch(self, x, mask):
+        sigma = torch.rand(len(x)).to(x.device) * self._sigma * mask
+        return x + _expand_mask(sigma, x.ndim) * torch.rand(*x.shape).to(x.device)
+
+
+class BatchAugmenter(torch.nn.Module):
+    """Applies a sequence of transforms to whole batches (B, T, C, H, W).
+
+    Every sample gets its own random parameters and its own probability draw per
+    transform. Runs of consecutive `GeometricTransform`s with the same interpolation
+    mode are fused: their grids are composed and the batch is resampled by a single
+    `grid_sample`. The padding mode of every transform is applied to the intermediate
+    positions (see `pad_grid`), so the result only differs from transforming one
+    after another by interpolating once instead of several times.
+
+    Args:
+        transforms: Transforms, applied in order.
+    """
+
+    def __init__(self, *transforms):
+        super().__init__()
+        self.transforms = torch.nn.ModuleList(transforms)
+
+    @torch.no_grad()
+    def forward(self, x: torch.Tensor):
+        if x.ndim == 4:
+            return self(x.unsqueeze(0)).squeeze(0)
+        if x.ndim != 5:
+            raise ValueError("Transform assumes 4D or 5D data! (B),T,C,H,W")
+
+        B, T = x.shape[:2]
+        run = []
+        for t in self.transforms:
+            if isinstance(t, GeometricTransform) and t.can_warp():
+                if len(run) > 0 and t._mode != run[0]._mode:
+                    x = self._warp(x, run)
+                    run = []
+                run.append(t)
+                continue
+            x = self._warp(x, run)
+            run = []
+            x = t.forward_batch(x, t.sample_mask(B, x.device))
+        return self._warp(x, run)
+
+    def _warp(self, x, run):
+        if len(run) == 0:
+            return x
+        B, T = x.shape[:2]
+        grid = cached_tensor_grid(x.shape[-2:], x.device)
+        grid = grid.expand((B, T) + grid.shape[1:])
+        # y = t_n(...t_1(x)) samples x at t_1(...t_n(grid))
+        masks = [t.sample_mask(B, x.device) for t in run]
+        weight = None
+        for k, (t, mask) in reversed(list(enumerate(zip(run, masks)))):
+            grid = t.warp_grid(grid, mask)
+            if k > 0:
+                # t samples the output of the previous transform with its own padding
+                grid, w = pad_grid(grid, t._padding_mode)
+                weight = w if weight is None else weight * w
+        y = grid_sample_batch(x, grid, run[0]._mode, run[0]._padding_mode)
+        if weight is not None:
+            y = y * weight.unsqueeze(2)
+        # samples that none of the transforms applied to are left untouched
+        mask = torch.stack(masks).any(0)
+        return torch.where(_expand_mask(mask, x.ndim), y, x)
+
 
 if __name__ == "__main__":
     import tarrow
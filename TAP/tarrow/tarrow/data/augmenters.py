@@ -6,10 +6,11 @@ from .augmentations import (
     RandomElastic,
     RandomNoise,
     RandomAffine,
+    BatchAugmenter,
 )
 
 
-def get_augmenter(augment_id: int) -> torch.nn.Module:
+def get_augmenter(augment_id: int, batch: bool = False) -> torch.nn.Module:
     """Augmentations for tensor of (B),T,C,H,W.
 
     All axis parameters get mapped to only T,C,H,W.
@@ -18,6 +19,9 @@ def get_augmenter(augment_id: int) -> torch.nn.Module:
     ----------
     augment_id : int
         augment_id
+    batch : bool
+        If True, return a `BatchAugmenter` that augments whole collated batches
+        (B,T,C,H,W) with per-sample parameters and fused geometric transforms.
 
     Returns
     -------
@@ -97,4 +101,7 @@ def get_augmenter(augment_id: int) -> torch.nn.Module:
     else:
         raise ValueError(f"{augment_id=}")
 
+    if batch:
+        aug = BatchAugmenter(*aug)
+
     return aug
@@ -0,0 +1,167 @@
+"""
+Chunked on-disk arrays, written incrementally along the first axis.
+
+An array is a folder with one `.npy` file per chunk of `chunk_size` entries along
+the first axis, and a `manifest.json`:
+
+    manifest.json
+    chunk_00000.npy   (chunk_size, ...)
+    chunk_00001.npy
+    ...
+
+As for crop stores, the manifest is written last, i.e. an array without manifest is incomplete.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHUNKED_ARRAY_VERSION = 1
+MANIFEST = "manifest.json"
+
+
+def _chunk_path(root, chunk):
+    return Path(root) / f"chunk_{chunk:05d}.npy"
+
+
+class ChunkedArrayWriter:
+    """Writes an array entry by entry (along the first axis) into chunks.
+
+    Use as a context manager, or call `close` to write the last chunk and the manifest.
+
+    Args:
+        root:
+            Output folder. Existing chunks in it are overwritten.
+        shape:
+            Shape of a single entry.
+        dtype:
+            Storage type.
+        chunk_size:
+            Number of entries per chunk.
+        attrs:
+            Json-serializable metadata stored in the manifest.
+    """
+
+    def __init__(self, root, shape, dtype="float32", chunk_size: int = 16, attrs=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / MANIFEST).unlink(missing_ok=True)
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.attrs = {} if attrs is None else dict(attrs)
+        self._buffer = np.empty((chunk_size,) + self.shape, dtype=self.dtype)
+        self._n_buffered = 0
+        self._chunks = []
+
+    def append(self, x):
+        x = np.asarray(x)
+        if x.shape != self.shape:
+            raise ValueError(f"Expected an entry of shape {self.shape}, got {x.shape}")
+        self._buffer[self._n_buffered] = x
+        self._n_buffered += 1
+        if self._n_buffered == self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if self._n_buffered == 0:
+            return
+        chunk = len(self._chunks)
+        np.save(_chunk_path(self.root, chunk), self._buffer[: self._n_buffered])
+        self._chunks.append(self._n_buffered)
+        self._n_buffered = 0
+
+    def __len__(self):
+        return sum(self._chunks) + self._n_buffered
+
+    def close(self):
+        """Writes the last (partial) chunk and the manifest."""
+        self._flush()
+        manifest = dict(
+            version=CHUNKED_ARRAY_VERSION,
+            dtype=self.dtype.str,
+            shape=[len(self)] + list(self.shape),
+            chunks=self._chunks,
+            attrs=self.attrs,
+        )
+        tmp = self.root / f"{MANIFEST}.tmp"
+        with open(tmp, "wt") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.root / MANIFEST)
+        logger.info(f"Saved array of shape {tuple(manifest['shape'])} in {len(self._chunks)} chunks to {self.root}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class ChunkedArray:
+    """Read access to a chunked array, chunks are memory-mapped on demand.
+
+    Supports integer and slice indexing along the first axis (followed by any
+    numpy index of the remaining axes), and `np.asarray`.
+
+    Args:
+        root:
+            Array folder.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        manifest = self.root / MANIFEST
+        if not manifest.exists():
+            raise FileNotFoundError(f"{manifest} not found, incomplete or no chunked array")
+        with open(manifest, "rt") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != CHUNKED_ARRAY_VERSION:
+            raise ValueError(f"Unsupported chunked array version in {manifest}")
+        self._starts = np.cumsum([0] + self.manifest["chunks"])
+        self._chunks = {}
+
+    @property
+    def shape(self):
+        return tuple(self.manifest["shape"])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.manifest["dtype"])
+
+    @property
+    def attrs(self):
+        return self.manifest["attrs"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, c):
+        if c not in self._chunks:
+            self._chunks[c] = np.load(_chunk_path(self.root, c), mmap_mode="r")
+        return self._chunks[c]
+
+    def __getitem__(self, idx):
+        idx, rest = (idx[0], idx[1:]) if isinstance(idx, tuple) else (idx, ())
+        if isinstance(idx, slice):
+            ts = range(*idx.indices(len(self)))
+            out = np.empty((len(ts),) + self.shape[1:], dtype=self.dtype)
+            for k, t in enumerate(ts):
+                out[k] = self[t]
+            return out[(slice(None),) + rest]
+        t = int(idx)
+        if t < 0:
+            t += len(self)
+        if not 0 <= t < len(self):
+            raise IndexError(f"Index {idx} out of range for length {len(self)}")
+        c = int(np.searchsorted(self._starts, t, side="right")) - 1
+        return np.asarray(self._chunk(c)[(t - self._starts[c],) + rest])
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
@@ -0,0 +1,259 @@
+"""
+Sharded, columnar on-disk store of labelled crops (as produced by `Workflow/02_data_prep.py`).
+
+A store is a folder with one `.npy` file per column and shard, and a `manifest.json`:
+
+    manifest.json
+    crops_00000.npy         (n, T, C, h, w) float16, float32 or uint8
+    event_labels_00000.npy  (n,) int64
+    labels_00000.npy        (n,) int64, time arrow label
+    coords_00000.npy        (n, 4) int64, crop origin (i, j), window index, time arrow label
+    crops_00001.npy
+    ...
+
+Shards are written as soon as they are full, so the whole dataset never needs to be in memory.
+The manifest is written last, i.e. a store without manifest is incomplete.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+MANIFEST = "manifest.json"
+CROP_DTYPES = ("float16", "float32", "uint8")
+_COLUMNS = ("crops", "event_labels", "labels", "coords")
+
+
+def _shard_path(root, column, shard):
+    return Path(root) / f"{column}_{shard:05d}.npy"
+
+
+class CropStoreWriter:
+    """Incrementally writes labelled crops into a sharded store.
+
+    Use as a context manager, or call `close` to write the last shard and the manifest.
+
+    Args:
+        root:
+            Output folder. Existing shards in it are overwritten.
+        shard_size:
+            Number of crops per shard.
+        dtype:
+            Storage type of the crops. `uint8` quantizes the (normalized) intensities
+            in [0, 1] to 256 levels, clipping everything outside.
+    """
+
+    def __init__(self, root, shard_size: int = 4096, dtype: str = "float16"):
+        if dtype not in CROP_DTYPES:
+            raise ValueError(f"Crop dtype must be one of {CROP_DTYPES}, got {dtype}")
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / MANIFEST).unlink(missing_ok=True)
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self._crop_shape = None
+        self._buffer = None
+        self._n_buffered = 0
+        self._shards = []
+
+    def _allocate(self, crop_shape):
+        self._crop_shape = tuple(crop_shape)
+        self._buffer = dict(
+            crops=np.empty((self.shard_size,) + self._crop_shape, dtype=self.dtype),
+            event_labels=np.empty(self.shard_size, dtype=np.int64),
+            labels=np.empty(self.shard_size, dtype=np.int64),
+            coords=np.empty((self.shard_size, 4), dtype=np.int64),
+        )
+
+    def _encode(self, x):
+        if self.dtype == "uint8":
+            return np.round(np.clip(x, 0, 1) * 255)
+        return x
+
+    def append(self, x, event_label, label, coords):
+        """Adds a single crop.
+
+        Args:
+            x: Crop of shape (T, C, h, w).
+            event_label: Event class of the crop.
+            label: Time arrow label of the crop.
+            coords: Sequence (i, j, window index, time arrow label).
+        """
+        x = np.asarray(x)
+        if self._buffer is None:
+            self._allocate(x.shape)
+        elif x.shape != self._crop_shape:
+            raise ValueError(
+                f"All crops need to have the same shape, got {x.shape} != {self._crop_shape}"
+            )
+        k = self._n_buffered
+        self._buffer["crops"][k] = self._encode(x)
+        self._buffer["event_labels"][k] = int(event_label)
+        self._buffer["labels"][k] = int(label)
+        self._buffer["coords"][k] = [int(c) for c in coords]
+        self._n_buffered += 1
+        if self._n_buffered == self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if self._n_buffered == 0:
+            return
+        shard = len(self._shards)
+        for col in _COLUMNS:
+            np.save(_shard_path(self.root, col, shard), self._buffer[col][: self._n_buffered])
+        self._shards.append(self._n_buffered)
+        logger.debug(f"Wrote shard {shard} with {self._n_buffered} crops")
+        self._n_buffered = 0
+
+    def __len__(self):
+        return sum(self._shards) + self._n_buffered
+
+    def close(self):
+        """Writes the last (partial) shard and the manifest."""
+        self._flush()
+        manifest = dict(
+            version=STORE_VERSION,
+            dtype=self.dtype,
+            crop_shape=self._crop_shape,
+            shards=self._shards,
+        )
+        tmp = self.root / f"{MANIFEST}.tmp"
+        with open(tmp, "wt") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.root / MANIFEST)
+        logger.info(f"Saved {len(self)} crops in {len(self._shards)} shards to {self.root}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class CropStore(Dataset):
+    """Memory-mapped view of a crop store with O(1) random access.
+
+    Items have the same structure as the crops of `CellEventDataset`:
+    `(x, event_label, label, (i, j, window index, time arrow label))`, with x as float32 tensor.
+
+    Labels and coordinates of all crops are held in memory, crops are read on access.
+
+    Args:
+        root:
+            Store folder.
+        indices:
+            Optional subset (and order) of crops, as indices into the full store.
+    """
+
+    def __init__(self, root, indices=None):
+        self.root = Path(root)
+        manifest = self.root / MANIFEST
+        if not manifest.exists():
+            raise FileNotFoundError(f"{manifest} not found, incomplete or no crop store")
+        with open(manifest, "rt") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported crop store version in {manifest}")
+
+        shards = self.manifest["shards"]
+        n_total = sum(shards)
+        # shard and position within the shard of every crop
+        self._shard = np.repeat(np.arange(len(shards)), shards)
+        self._offset = np.arange(n_total) - np.repeat(np.cumsum([0] + shards[:-1]), shards)
+
+        self.indices = (
+            np.arange(n_total) if indices is None else np.asarray(indices, dtype=np.int64)
+        )
+
+        def _column(col):
+            if len(shards) == 0:
+                return np.empty((0, 4) if col == "coords" else 0, dtype=np.int64)
+            full = np.concatenate(
+                [np.load(_shard_path(self.root, col, s)) for s in range(len(shards))]
+            )
+            return full[self.indices]
+
+        self.event_labels = _column("event_labels")
+        self.labels = _column("labels")
+        self.coords = _column("coords")
+        self._crops = None
+
+    @property
+    def crop_shape(self):
+        return tuple(self.manifest["crop_shape"])
+
+    def _open(self):
+        if self._crops is None:
+            self._crops = [
+                np.load(_shard_path(self.root, "crops", s), mmap_mode="r")
+                for s in range(len(self.manifest["shards"]))
+            ]
+        return self._crops
+
+    def __getstate__(self):
+        # memmaps are reopened in the unpickled copy (e.g. in DataLoader workers)
+        state = self.__dict__.copy()
+        state["_crops"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _decode(self, x):
+        if self.manifest["dtype"] == "uint8":
+            return x.astype(np.float32) / 255
+        return x.astype(np.float32)
+
+    def __getitem__(self, idx):
+        k = self.indices[idx]
+        x = self._open()[self._shard[k]][self._offset[k]]
+        coords = tuple(torch.tensor(c) for c in self.coords[idx])
+        return (
+            torch.from_numpy(self._decode(x)),
+            torch.tensor(self.event_labels[idx]),
+            torch.tensor(self.labels[idx]),
+            coords,
+        )
+
+    def subset(self, indices):
+        """View of the crops at the given positions of this view."""
+        return CropStore(self.root, indices=self.indices[np.asarray(indices, dtype=np.int64)])
+
+    def save_view(self, fname):
+        """Saves the index set of this view as `.npz`, to be reopened with `open_crops`.
+
+        The store folder is referenced relative to `fname`, so both can be moved together.
+        Symlinks are not resolved, i.e. a store staged next to `fname` as a link stays next to it.
+        """
+        root = os.path.relpath(os.path.abspath(self.root), os.path.dirname(os.path.abspath(fname)))
+        np.savez(fname, root=root, indices=self.indices)
+
+
+def open_crops(path):
+    """Opens crops saved by `02_data_prep.py` or `03_event_classification.py`.
+
+    Args:
+        path:
+            A crop store folder, a view saved with `CropStore.save_view` (.npz),
+            or a legacy `torch.save`d list of crops (.pth).
+
+    Returns:
+        CropStore, or a list for legacy files.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return CropStore(path)
+    if path.suffix == ".npz":
+        with np.load(path) as view:
+            return CropStore(path.parent / str(view["root"]), indices=view["indices"])
+    logger.info(f"Loading pickled crops from {path}")
+    return torch.load(path)
@@ -0,0 +1,118 @@
+import logging
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def _summed_area_table(x):
+    """Summed-area table over the last two axes, zero-padded to shape (..., H + 1, W + 1)."""
+    sat = np.zeros(x.shape[:-2] + (x.shape[-2] + 1, x.shape[-1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(x, axis=-2, dtype=np.float64), axis=-1, out=sat[..., 1:, 1:])
+    return sat
+
+
+def _box_sums(sat, kh, kw):
+    """Sums over all (kh, kw) windows, for every valid window origin."""
+    return (
+        sat[..., kh:, kw:]
+        - sat[..., :-kh, kw:]
+        - sat[..., kh:, :-kw]
+        + sat[..., :-kh, :-kw]
+    )
+
+
+def crop_std_map(frames, crop_size, factor, chunk_size=64):
+    """Standard deviation of every crop of every frame, on a grid of crop origins with stride `factor`.
+
+    Frames are clipped to [0, 1] and block-averaged by `factor` (which also
+    smoothes them), then the mean and variance of all crops are obtained from
+    summed-area tables of x and x**2.
+
+    Args:
+        frames: Array of shape (T, C, H, W).
+        crop_size: Tuple (h, w).
+        factor: Downsampling factor.
+
+    Returns:
+        float16 array of shape (T, H // factor - h // factor + 1, W // factor - w // factor + 1).
+    """
+    T, _, H, W = frames.shape
+    Hl, Wl = H // factor, W // factor
+    kh, kw = max(1, crop_size[0] // factor), max(1, crop_size[1] // factor)
+    n = kh * kw
+
+    std = np.empty((T, Hl - kh + 1, Wl - kw + 1), dtype=np.float16)
+    for start in tqdm(
+        range(0, T, chunk_size), desc="building foreground index", leave=False
+    ):
+        x = np.asarray(frames[start : start + chunk_size, :, : Hl * factor, : Wl * factor])
+        x = np.clip(x.mean(axis=1), 0, 1)
+        x = x.reshape(len(x), Hl, factor, Wl, factor).mean(axis=(2, 4))
+        mean = _box_sums(_summed_area_table(x), kh, kw) / n
+        mean_sq = _box_sums(_summed_area_table(x**2), kh, kw) / n
+        std[start : start + chunk_size] = np.sqrt(np.maximum(mean_sq - mean**2, 0))
+    return std
+
+
+class ForegroundIndex:
+    """Low-resolution map of textured (non-background) crop origins of a frame stack.
+
+    A crop counts as foreground if the standard deviation of its intensities,
+    clipped to [0, 1] and block-averaged by `factor` (see `crop_std_map`),
+    exceeds `threshold`, averaged over the frames of a window.
+    Crop origins are drawn uniformly from the foreground origins of a window,
+    or from all origins if there are none.
+
+    For cells on a moderately noisy background, the default threshold accepts
+    the same share of crops as the former criterion (std of the whole window
+    after a 3x3 median filter). Unlike the median filter, block averaging
+    suppresses pixel noise, so crops of noisy but empty background are rejected.
+
+    Args:
+        frames: Array of shape (T, C, H, W), normalized to roughly [0, 1].
+        crop_size: Tuple (h, w).
+        threshold: Minimal standard deviation of a foreground crop.
+        factor: Resolution of the map, i.e. the stride of the crop origin grid.
+            Defaults to 1/8 of the smaller crop side.
+    """
+
+    def __init__(self, frames, crop_size, threshold=0.02, factor=None):
+        if factor is None:
+            factor = max(1, min(crop_size) // 8)
+        self.factor = factor
+        self.threshold = threshold
+        self.crop_size = tuple(crop_size)
+        self.image_size = tuple(frames.shape[-2:])
+        self.std = crop_std_map(frames, crop_size, factor)
+        fg = (self.std > threshold).mean()
+        logger.debug(f"Foreground crop origins: {100 * fg:.1f}%")
+
+    def sample(self, t, generator=None):
+        """Draws crop origins from the foreground of the given windows.
+
+        Args:
+            t: Integer array of shape (B, n_frames), the frame indices of each window.
+            generator: Optional torch.Generator.
+
+        Returns:
+            Tuple of int64 arrays (y, x) of shape (B,), in full resolution.
+        """
+        t = np.asarray(t)
+        std = self.std[t.reshape(-1)].reshape(t.shape + self.std.shape[1:])
+        valid = std.astype(np.float32).mean(axis=1) > self.threshold
+        valid = valid.reshape(len(t), -1)
+        # fall back to uniform sampling for windows without foreground
+        weights = np.where(valid.any(axis=1, keepdims=True), valid, True)
+        origin = torch.multinomial(
+            torch.from_numpy(weights.astype(np.float32)), 1, generator=generator
+        )[:, 0].numpy()
+        oy, ox = np.unravel_index(origin, self.std.shape[1:])
+
+        # jitter within the low-resolution cell
+        jitter = torch.randint(0, self.factor, (2, len(t)), generator=generator).numpy()
+        y = np.minimum(oy * self.factor + jitter[0], self.image_size[0] - self.crop_size[0])
+        x = np.minimum(ox * self.factor + jitter[1], self.image_size[1] - self.crop_size[1])
+        return y.astype(np.int64), x.astype(np.int64)
@@ -0,0 +1,274 @@
+"""
+Content-addressed on-disk cache of preprocessed (normalized, subsampled) frame stacks.
+
+Every entry is a float32 `.npy` file that can be memory-mapped, plus a `.json`
+sidecar with the source file signatures and preprocessing parameters it was built from.
+
+Usage from the command line (see `scripts/frame_cache.py`):
+
+    python frame_cache.py list
+    python frame_cache.py check
+    python frame_cache.py prune --stale --max_size 50
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir() -> Path:
+    return Path(
+        os.environ.get("TARROW_CACHE_DIR", Path("~/.cache/tarrow/frames"))
+    ).expanduser()
+
+
+def file_signature(files: Sequence[os.PathLike]):
+    """List of (path, size, mtime_ns) for the given files."""
+    sig = []
+    for f in files:
+        f = Path(f).expanduser().resolve()
+        st = f.stat()
+        sig.append((str(f), st.st_size, st.st_mtime_ns))
+    return sig
+
+
+class FrameCache:
+    """On-disk cache of preprocessed frame stacks, keyed by input files and parameters.
+
+    Args:
+        root:
+            Cache folder. If None, use `$TARROW_CACHE_DIR` or `~/.cache/tarrow/frames`.
+    """
+
+    def __init__(self, root=None):
+        self.root = default_cache_dir() if root is None else Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(self, sources: Sequence[os.PathLike], params: dict) -> str:
+        """Hash of the source file signatures and the preprocessing parameters."""
+        desc = dict(
+            version=CACHE_VERSION,
+            sources=file_signature(sources),
+            params=params,
+        )
+        s = json.dumps(desc, sort_keys=True, default=str)
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def _data_path(self, key):
+        return self.root / f"{key}.npy"
+
+    def _meta_path(self, key):
+        return self.root / f"{key}.json"
+
+    def open(self, key):
+        """Returns the cached stack as read-only np.memmap, or None if not cached."""
+        fname = self._data_path(key)
+        if not fname.exists() or not self._meta_path(key).exists():
+            return None
+        try:
+            frames = np.load(fname, mmap_mode="r")
+        except (ValueError, OSError) as e:
+            logger.warning(f"Ignoring corrupt cache entry {fname}: {e}")
+            return None
+        # access time for LRU pruning
+        os.utime(self._meta_path(key))
+        logger.info(f"Loaded cached frames {fname}")
+        return frames
+
+    def create(self, key, shape, dtype=np.float32) -> np.memmap:
+        """Allocates a writable memory-mapped stack, which becomes visible after `commit`."""
+        fd, tmp = tempfile.mkstemp(suffix=".npy.tmp", prefix=f"{key}_", dir=self.root)
+        os.close(fd)
+        return np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=dtype, shape=tuple(shape)
+        )
+
+    def commit(self, key, frames: np.memmap, sources, params) -> np.memmap:
+        """Atomically moves a stack from `create` into the cache and reopens it read-only."""
+        frames.flush()
+        tmp = Path(frames.filename)
+        del frames
+        os.replace(tmp, self._data_path(key))
+        meta = dict(
+            version=CACHE_VERSION,
+            sources=file_signature(sources),
+            params=params,
+            created=time.time(),
+        )
+        with open(self._meta_path(key), "wt") as f:
+            json.dump(meta, f, default=str)
+        logger.info(f"Cached frames to {self._data_path(key)}")
+        return np.load(self._data_path(key), mmap_mode="r")
+
+    def entries(self):
+        """Yields (key, metadata) of all entries. Metadata is None if unreadable."""
+        for fname in sorted(self.root.glob("*.npy")):
+            key = fname.stem
+            try:
+                with open(self._meta_path(key), "rt") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+            yield key, meta
+
+    def size(self, key) -> int:
+        return sum(
+            p.stat().st_size
+            for p in (self._data_path(key), self._meta_path(key))
+            if p.exists()
+        )
+
+    def check(self, key, meta) -> str:
+        """Returns 'ok', 'stale' (sources changed or removed) or 'corrupt'."""
+        if meta is None or meta.get("version") != CACHE_VERSION:
+            return "corrupt"
+        try:
+            np.load(self._data_path(key), mmap_mode="r")
+        except (ValueError, OSError):
+            return "corrupt"
+        files = [s[0] for s in meta["sources"]]
+        try:
+            sig = file_signature(files)
+        except OSError:
+            return "stale"
+        if [list(s) for s in sig] != [list(s) for s in meta["sources"]]:
+            return "stale"
+        return "ok"
+
+    def remove(self, key):
+        for p in (self._data_path(key), self._meta_path(key)):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+    def prune(self, stale=False, older_than=None, max_size=None, dry_run=False):
+        """Removes entries.
+
+        Args:
+            stale:
+                Remove entries whose source files changed, and corrupt entries.
+            older_than:
+                Remove entries not accessed for this many days.
+            max_size:
+                Remove least recently used entries until the cache is smaller than this many bytes.
+            dry_run:
+                Only return the keys that would be removed.
+
+        Returns:
+            List of removed keys.
+        """
+        for tmp in self.root.glob("*.npy.tmp"):
+            # leftovers of interrupted runs
+            if time.time() - tmp.stat().st_mtime > 24 * 3600 and not dry_run:
+                tmp.unlink()
+
+        removed = []
+        alive = []
+        for key, meta in self.entries():
+            status = self.check(key, meta)
+            last_access = (
+                self._meta_path(key).stat().st_mtime
+                if self._meta_path(key).exists()
+                else 0
+            )
+            if stale and status != "ok":
+                removed.append(key)
+            elif older_than is not None and time.time() - last_access > older_than * 86400:
+                removed.append(key)
+            else:
+                alive.append((last_access, key))
+
+        if max_size is not None:
+            total = sum(self.size(k) for _, k in alive)
+            for _, key in sorted(alive):
+                if total <= max_size:
+                    break
+                total -= self.size(key)
+                removed.append(key)
+
+        if not dry_run:
+            for key in removed:
+                self.remove(key)
+        return removed
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="tarrow-frame-cache")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache folder. Defaults to $TARROW_CACHE_DIR or ~/.cache/tarrow/frames.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="List cached frame stacks.")
+    sub.add_parser("check", help="Check whether cached stacks are still valid.")
+    prune = sub.add_parser("prune", help="Remove cached frame stacks.")
+    prune.add_argument(
+        "--stale", action="store_true", help="Remove stale and corrupt entries."
+    )
+    prune.add_argument(
+        "--older_than", type=float, default=None, help="Remove entries unused for n days."
+    )
+    prune.add_argument(
+        "--max_size", type=float, default=None, help="Maximal cache size in GB."
+    )
+    prune.add_argument("--all", action="store_true", help="Remove all entries.")
+    prune.add_argument("--dry_run", action="store_true")
+    return parser
+
+
+def main(args=None):
+    if args is None:
+        args = get_argparser().parse_args()
+
+    cache = FrameCache(args.cache_dir)
+
+    if args.command == "list":
+        total = 0
+        for key, meta in cache.entries():
+            size = cache.size(key)
+            total += size
+            if meta is None:
+                print(f"{key}  {size / 1024**2:10.1f} MB  <no metadata>")
+                continue
+            shape = tuple(np.load(cache._data_path(key), mmap_mode="r").shape)
+            src = meta["sources"][0][0] if meta["sources"] else ""
+            n = len(meta["sources"])
+            print(f"{key}  {size / 1024**2:10.1f} MB  {shape}  {src} ({n} files)")
+        print(f"Total: {total / 1024**3:.2f} GB in {cache.root}")
+    elif args.command == "check":
+        for key, meta in cache.entries():
+            print(f"{key}  {cache.check(key, meta)}")
+    elif args.command == "prune":
+        if args.all:
+            removed = [k for k, _ in cache.entries()]
+            if not args.dry_run:
+                for k in removed:
+                    cache.remove(k)
+        else:
+            removed = cache.prune(
+                stale=args.stale,
+                older_than=args.older_than,
+                max_size=None if args.max_size is None else args.max_size * 1024**3,
+                dry_run=args.dry_run,
+            )
+        for k in removed:
+            print(f"{'Would remove' if args.dry_run else 'Removed'} {k}")
+
+
+if __name__ == "__main__":
+    main()
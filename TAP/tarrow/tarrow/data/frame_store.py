@@ -0,0 +1,143 @@
+import logging
+import os
+import tempfile
+import weakref
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def allocate_frames(shape, dtype=np.float32, memmap_dir=None, memmap_threshold=None):
+    """Allocates a frame stack, memory-mapped from disk if it is large.
+
+    Args:
+        shape:
+            Shape of the stack, e.g. (T, C, H, W).
+        dtype:
+            Data type of the stack.
+        memmap_dir:
+            Folder for the backing `.npy` file. Defaults to the system temp dir.
+        memmap_threshold:
+            Stacks with more bytes than this are memory-mapped. `None` never memory-maps, 0 always does.
+
+    Returns:
+        Tuple of (ndarray or np.memmap, path of the backing file or None).
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if memmap_threshold is None or nbytes <= memmap_threshold:
+        return np.empty(shape, dtype=dtype), None
+
+    if memmap_dir is not None:
+        Path(memmap_dir).mkdir(parents=True, exist_ok=True)
+    fd, fname = tempfile.mkstemp(suffix=".npy", prefix="tarrow_frames_", dir=memmap_dir)
+    os.close(fd)
+    logger.info(f"Memory-map {nbytes / 1024**3:.2f} GiB frame stack to {fname}")
+    arr = np.lib.format.open_memmap(fname, mode="w+", dtype=dtype, shape=tuple(shape))
+    return arr, Path(fname)
+
+
+class FrameStore:
+    """A single (T, C, H, W) frame stack from which time windows are built on demand.
+
+    Each frame is stored exactly once, windows are indexed by (t0, delta) pairs
+    and only materialised when accessed. The stack can be an in-memory array or
+    a memory-mapped `.npy` file, so that movies larger than RAM can be used.
+
+    Args:
+        frames:
+            Array of shape (T, C, H, W), a np.memmap or path to a `.npy` file.
+        n_frames:
+            Number of frames in each window.
+        delta_frames:
+            Temporal delta(s) between frames of a window.
+        owned_file:
+            Backing file that is deleted once the store is garbage-collected.
+    """
+
+    def __init__(
+        self,
+        frames,
+        n_frames: int = 2,
+        delta_frames: Sequence[int] = (1,),
+        owned_file=None,
+    ):
+        if isinstance(frames, (str, Path)):
+            frames = np.load(frames, mmap_mode="r")
+        if frames.ndim != 4:
+            raise NotImplementedError(
+                f"only 2D timelapses supported (total image shape: {frames.shape})"
+            )
+
+        self._frames = frames
+        self._n_frames = n_frames
+        self._delta_frames = tuple(delta_frames)
+
+        min_number = max(self._delta_frames) * (n_frames - 1) + 1
+        if len(frames) < min_number:
+            raise ValueError(f"imgs should contain at last {min_number} elements")
+
+        self._index = np.array(
+            [
+                (t0, delta)
+                for delta in self._delta_frames
+                for t0 in range(len(frames) - (n_frames - 1) * delta)
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+
+        self._owned_file = owned_file
+        if owned_file is not None:
+            weakref.finalize(self, _remove_file, Path(owned_file))
+
+    @property
+    def frames(self) -> np.ndarray:
+        return self._frames
+
+    @property
+    def shape(self):
+        return self._frames.shape
+
+    @property
+    def index(self) -> np.ndarray:
+        """(N, 2) array of (t0, delta) pairs, one per window."""
+        return self._index
+
+    @property
+    def filename(self):
+        return getattr(self._frames, "filename", None)
+
+    def __len__(self):
+        return len(self._index)
+
+    def time_slice(self, idx) -> slice:
+        t0, delta = self._index[idx]
+        return slice(int(t0), int(t0 + delta * (self._n_frames - 1) + 1), int(delta))
+
+    def __getitem__(self, idx) -> torch.Tensor:
+        """Returns the window `idx` as a (n_frames, C, H, W) tensor."""
+        x = np.array(self._frames[self.time_slice(idx)])
+        return torch.from_numpy(x)
+
+    def __getstate__(self):
+        # Memory-mapped stacks are reopened instead of being pickled into every DataLoader worker
+        state = self.__dict__.copy()
+        if self.filename is not None:
+            state["_frames"] = Path(self.filename)
+        state["_owned_file"] = None
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["_frames"], Path):
+            state["_frames"] = np.load(state["_frames"], mmap_mode="r")
+        self.__dict__.update(state)
+
+
+def _remove_file(fname: Path):
+    try:
+        fname.unlink()
+    except OSError:
+        pass
@@ -0,0 +1,104 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Sequence
+
+import imageio
+import numpy as np
+import tifffile
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+TIFF_SUFFIXES = (".tif", ".TIFF", ".tiff")
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg")
+
+
+def default_num_workers() -> int:
+    """Number of loader threads, from `$TARROW_LOAD_WORKERS` or the CPU count."""
+    n = os.environ.get("TARROW_LOAD_WORKERS")
+    if n is not None:
+        return max(1, int(n))
+    return min(16, os.cpu_count() or 1)
+
+
+def read_image(fname) -> np.ndarray:
+    """Reads a single 2d image (TIFF, PNG or JPEG). Color images are returned channels-first."""
+    f = Path(fname)
+    if f.suffix in TIFF_SUFFIXES:
+        x = tifffile.imread(f)
+    elif f.suffix in IMAGE_SUFFIXES:
+        x = imageio.imread(f)
+        if x.ndim == 3:
+            x = np.moveaxis(x[..., :3], -1, 0)
+    else:
+        raise ValueError(f"Unsupported image format {f}")
+    return np.squeeze(x)
+
+
+def load_image_files(
+    fnames: Sequence[os.PathLike],
+    num_workers: int = None,
+    out: np.ndarray = None,
+    desc: str = "loading images",
+) -> np.ndarray:
+    """Decodes a list of image files into a single stack, in parallel threads.
+
+    Files are decoded straight into a preallocated array (no intermediate list
+    and `np.stack` copy), in the order of `fnames`. Files with unsupported
+    suffixes are skipped. Most tifffile/imageio codecs release the GIL, so
+    threads give a near-linear speedup on slow (e.g. network) file systems.
+
+    Args:
+        fnames:
+            Image files, one per frame.
+        num_workers:
+            Number of decoding threads. Defaults to `default_num_workers()`. 0 or 1 decodes serially.
+        out:
+            Optional preallocated array of shape (len(fnames), ...) to write into.
+        desc:
+            Progress bar description.
+
+    Returns:
+        Array of shape (n_files, ...) with the dtype of the first image (unless `out` is given).
+    """
+    fnames = [
+        Path(f) for f in fnames if Path(f).suffix in TIFF_SUFFIXES + IMAGE_SUFFIXES
+    ]
+    if len(fnames) == 0:
+        raise ValueError("No image files to load")
+
+    if num_workers is None:
+        num_workers = default_num_workers()
+
+    first = read_image(fnames[0])
+    if out is None:
+        out = np.empty((len(fnames),) + first.shape, dtype=first.dtype)
+    elif out.shape != (len(fnames),) + first.shape:
+        raise ValueError(
+            f"Output array of shape {out.shape} does not fit {len(fnames)} images of shape {first.shape}"
+        )
+    out[0] = first
+
+    def _read_into(i):
+        x = read_image(fnames[i])
+        if x.shape != first.shape:
+            raise ValueError(
+                f"All images need to have the same shape, but {fnames[i]} has shape {x.shape} != {first.shape}"
+            )
+        out[i] = x
+
+    indices = range(1, len(fnames))
+    with tqdm(total=len(fnames), initial=1, leave=False, desc=desc) as pbar:
+        if num_workers <= 1:
+            for i in indices:
+                _read_into(i)
+                pbar.update()
+        else:
+            logger.debug(f"Loading {len(fnames)} images with {num_workers} threads")
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for _ in executor.map(_read_into, indices):
+                    pbar.update()
+
+    return out
@@ -0,0 +1,161 @@
+"""
+Class-balanced sampling of labelled crops from precomputed label arrays,
+and uniform sampling with replacement split across processes.
+"""
+
+import logging
+
+import numpy as np
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_MODES = ("replacement", "no_replacement", "weighted", "sequential")
+
+
+class BalancedSampler(Sampler):
+    """Draws equally many positive (label > 0) and negative (label == 0) indices.
+
+    The order is a function of (seed, epoch) only, so it is reproducible but
+    different in every epoch if `set_epoch` is called at the start of each epoch.
+
+    Args:
+        labels:
+            Array of shape (N,) with the event label of every item, e.g. `CropStore.event_labels`.
+        num_samples:
+            Total number of samples per epoch (before sharding), at most twice the size
+            of the smaller class.
+        seed:
+            Base seed.
+        mode:
+            `replacement`: draw each class with replacement,
+            `no_replacement`: draw each class without replacement,
+            `weighted`: draw from all items with weights inversely proportional to the class size
+            (balanced in expectation),
+            `sequential`: the first items of each class, not shuffled.
+        weights:
+            Optional per-item weights for `weighted` mode, instead of the inverse class sizes.
+        num_shards:
+            Number of disjoint shards the samples of an epoch are split into,
+            e.g. one per DataLoader worker or process. Shards are padded to equal length.
+        shard:
+            Shard returned by this sampler.
+    """
+
+    def __init__(
+        self,
+        labels,
+        num_samples: int,
+        seed: int = 0,
+        mode: str = "replacement",
+        weights=None,
+        num_shards: int = 1,
+        shard: int = 0,
+    ):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Sampling mode must be one of {SAMPLING_MODES}, got {mode}")
+        if not 0 <= shard < num_shards:
+            raise ValueError(f"Shard {shard} out of range for {num_shards} shards")
+        self.labels = np.asarray(labels)
+        self.positive_indices = np.flatnonzero(self.labels > 0)
+        self.negative_indices = np.flatnonzero(self.labels == 0)
+        self.num_samples_per_class = min(
+            num_samples // 2, len(self.positive_indices), len(self.negative_indices)
+        )
+        if self.num_samples_per_class == 0:
+            logger.warning(
+                f"No balanced samples: {len(self.positive_indices)} positive and "
+                f"{len(self.negative_indices)} negative items"
+            )
+
+        if weights is None:
+            weights = np.zeros(len(self.labels))
+            for idx in (self.positive_indices, self.negative_indices):
+                weights[idx] = 1 / max(len(idx), 1)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if len(self.weights) != len(self.labels):
+            raise ValueError(f"{len(self.weights)} weights but {len(self.labels)} labels")
+
+        self.seed = seed
+        self.mode = mode
+        self.num_shards = num_shards
+        self.shard = shard
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def indices(self, epoch=None) -> np.ndarray:
+        """All (unsharded) sample indices of an epoch, by default the current one."""
+        epoch = self.epoch if epoch is None else epoch
+        n = self.num_samples_per_class
+        if self.mode == "sequential":
+            return np.concatenate(
+                [self.positive_indices[:n], self.negative_indices[:n]]
+            )
+
+        rng = np.random.default_rng([self.seed, epoch])
+        if self.mode == "weighted":
+            if n == 0:
+                return np.empty(0, dtype=np.int64)
+            return rng.choice(
+                len(self.labels), 2 * n, replace=True, p=self.weights / self.weights.sum()
+            )
+        replace = self.mode == "replacement"
+        samples = np.concatenate(
+            [
+                rng.choice(idx, n, replace=replace) if n > 0 else idx[:0]
+                for idx in (self.positive_indices, self.negative_indices)
+            ]
+        )
+        return rng.permutation(samples)
+
+    def __iter__(self):
+        idx = self.indices()
+        if self.num_shards > 1:
+            idx = np.resize(idx, len(self) * self.num_shards)[self.shard :: self.num_shards]
+        return iter(idx.tolist())
+
+    def __len__(self):
+        return -(-2 * self.num_samples_per_class // self.num_shards)
+
+
+class ShardedRandomSampler(Sampler):
+    """Uniform sampling with replacement, split into shards (e.g. one per process).
+
+    Distributed version of `RandomSampler(data, replacement=True, num_samples=num_samples)`:
+    every shard draws its share of the samples independently, as a function of (seed, epoch, shard).
+    Call `set_epoch` at the start of each epoch.
+
+    Args:
+        data:
+            Dataset (only its length is used).
+        num_samples:
+            Total number of samples per epoch, over all shards.
+        seed:
+            Base seed, the same in all processes.
+        num_shards:
+            Number of shards, e.g. the world size.
+        shard:
+            Shard returned by this sampler, e.g. the rank.
+    """
+
+    def __init__(self, data, num_samples: int, seed: int = 0, num_shards: int = 1, shard: int = 0):
+        if not 0 <= shard < num_shards:
+            raise ValueError(f"Shard {shard} out of range for {num_shards} shards")
+        self.n = len(data)
+        self.num_samples = num_samples
+        self.seed = seed
+        self.num_shards = num_shards
+        self.shard = shard
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch, self.shard])
+        return iter(rng.integers(0, self.n, len(self)).tolist())
+
+    def __len__(self):
+        return -(-self.num_samples // self.num_shards)
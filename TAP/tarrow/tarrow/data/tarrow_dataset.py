@@ -1,22 +1,28 @@
 import logging
 from pathlib import Path
 import bisect
+from functools import partial
 from tqdm import tqdm
 import tifffile
-import imageio
 import numpy as np
 import torch
 from torch.utils.data import Dataset, ConcatDataset
 from torchvision import transforms
 from skimage.transform import downscale_local_mean
-import skimage
-from ..utils import normalize as utils_normalize
+from ..utils import normalize_stack
+from .frame_store import FrameStore, allocate_frames
+from .frame_cache import FrameCache
+from .image_io import load_image_files
+from .foreground import ForegroundIndex
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 class TarrowDataset(Dataset):
+    # Percentile normalization used by `_default_normalize`
+    _normalize_kwargs = dict(pmin=1, pmax=99.8, subsample=8)
+
     def __init__(
         self,
         imgs,
@@ -36,8 +42,16 @@ class TarrowDataset(Dataset):
         binarize=False,
         random_crop=True,
         reject_background=False,
+        background_threshold=0.02,
+        memmap_dir=None,
+        memmap_threshold=2 * 1024**3,
+        cache_dir=None,
+        load_workers=None,
     ):
-        """Returns 2d+time crops. The image sequence is stored in-memory.
+        """Returns 2d+time crops.
+
+        The normalized image sequence is stored once as a (T, C, H, W) frame stack
+        (memory-mapped from disk if it is large) and time windows are built on demand.
 
         Args:
             imgs:
@@ -74,6 +88,18 @@ class TarrowDataset(Dataset):
                 If `True`, crop random patches in spatial dimensions. If `False`, center-crop the images (e.g. for visualization).
             reject_background:
                 help="Set to `True` to heuristically reject background patches.
+                Crops are drawn from a precomputed foreground index (see `ForegroundIndex`).
+            background_threshold:
+                Minimal intensity standard deviation of a crop (per frame, at the resolution of the
+                foreground index) to not count as background.
+            memmap_dir:
+                Folder for memory-mapped frame stacks. If None, use the system temp dir.
+            memmap_threshold:
+                Frame stacks larger than this number of bytes are memory-mapped from disk. None means never.
+            cache_dir:
+                If given, cache the preprocessed frame stack of inputs given as paths in this folder (see `FrameCache`).
+            load_workers:
+                Number of threads for decoding image folders. If None, use `$TARROW_LOAD_WORKERS` or the CPU count.
         """
 
         super().__init__()
@@ -91,148 +117,207 @@ class TarrowDataset(Dataset):
         self._permute = permute
         self._channels = channels
         self._device = device
+        self._load_workers = load_workers
         self._augmenter = augmenter
         if self._augmenter is not None:
             self._augmenter.to(device)
 
-        if isinstance(imgs, (str, Path)):
-            imgs = self._load(
-                path=imgs,
+        if not isinstance(subsample, int) or subsample < 1:
+            raise NotImplementedError(
+                "Spatial subsampling only implemented for positive integer values."
+            )
+
+        frames, owned_file = None, None
+
+        cache = None
+        if cache_dir is not None and isinstance(imgs, (str, Path)) and normalize is None:
+            cache = FrameCache(cache_dir)
+            cache_sources = self._source_files(imgs)
+            cache_params = self._cache_params(
                 split_start=split_start,
                 split_end=split_end,
                 n_images=n_images,
+                binarize=binarize,
+                subsample=subsample,
             )
-        elif isinstance(imgs, (tuple, list, np.ndarray)) and isinstance(
-            imgs[0], np.ndarray
-        ):
-            imgs = np.asarray(imgs)[:n_images]
-        else:
-            raise ValueError(
-                f"Cannot form a dataset from {imgs}. "
-                "Input should be either a path to a sequence of 2d images, a single 2d+time image, or a list of 2d np.ndarrays."
-            )
+            cache_key = cache.key(cache_sources, cache_params)
+            frames = cache.open(cache_key)
+
+        if frames is None:
+            if isinstance(imgs, (str, Path)):
+                imgs = self._load(
+                    path=imgs,
+                    split_start=split_start,
+                    split_end=split_end,
+                    n_images=n_images,
+                )
+            elif isinstance(imgs, (tuple, list, np.ndarray)) and isinstance(
+                imgs[0], np.ndarray
+            ):
+                imgs = np.asarray(imgs)[:n_images]
+            else:
+                raise ValueError(
+                    f"Cannot form a dataset from {imgs}. "
+                    "Input should be either a path to a sequence of 2d images, a single 2d+time image, or a list of 2d np.ndarrays."
+                )
 
-        if self._channels == 0:
-            imgs = np.expand_dims(imgs, 1)
-        else:
-            imgs = imgs[:, : self._channels, ...]
+            if self._channels == 0:
+                imgs = np.expand_dims(imgs, 1)
+            else:
+                imgs = imgs[:, : self._channels, ...]
 
-        assert imgs.shape[1] == 1
+            assert imgs.shape[1] == 1
 
-        if binarize:
-            logger.debug("Binarize images")
-            imgs = (imgs > 0).astype(np.float32)
-        else:
-            logger.debug("Normalize images")
-            if normalize is None:
-                imgs = self._default_normalize(imgs)
-            else:
-                imgs = normalize(imgs)
+            if imgs.ndim != 4:  # T, C, X, Y
+                raise NotImplementedError(
+                    f"only 2D timelapses supported (total image shape: {imgs.shape})"
+                )
 
-        imgs = torch.as_tensor(imgs)
-        # print(f"subsample : {subsample}")
+            if cache is not None:
+                allocate = lambda shape: (cache.create(cache_key, shape), None)
+            else:
+                allocate = partial(
+                    allocate_frames,
+                    memmap_dir=memmap_dir,
+                    memmap_threshold=memmap_threshold,
+                )
 
-        if not isinstance(subsample, int) or subsample < 1:
-            raise NotImplementedError(
-                "Spatial subsampling only implemented for positive integer values."
+            frames, owned_file = self._prepare_frames(
+                imgs,
+                binarize=binarize,
+                normalize=normalize,
+                subsample=subsample,
+                allocate=allocate,
             )
-        if subsample > 1:
-            factors = (1,) + (subsample,) * (imgs.dim() - 1)
-            full_size = imgs[0].shape
-            imgs = downscale_local_mean(imgs, factors)
-            logger.debug(f"Subsampled from {full_size} to {imgs[0].shape}")
+            del imgs
+
+            if cache is not None:
+                frames = cache.commit(cache_key, frames, cache_sources, cache_params)
 
         if size is None:
-            self._size = imgs[0, 0].shape
+            self._size = frames[0, 0].shape
         else:
             # assert np.all(
             # np.array(size) <= np.array(imgs[0, 0].shape)
             # ), f"{size=} {imgs[0,0].shape=}"
             # self._size = size
 
-            self._size = tuple(min(a, b) for a, b in zip(size, imgs[0, 0].shape))
+            self._size = tuple(min(a, b) for a, b in zip(size, frames[0, 0].shape))
 
+        self._random_crop = random_crop
         if random_crop:
-            if reject_background:
-                self._crop = self._reject_background()
-            else:
-                self._crop = transforms.RandomCrop(
-                    self._size,
-                    padding_mode="reflect",
-                    pad_if_needed=True,
-                )
+            self._crop = transforms.RandomCrop(
+                self._size,
+                padding_mode="reflect",
+                pad_if_needed=True,
+            )
         else:
             self._crop = transforms.CenterCrop(self._size)
 
-        if imgs.ndim != 4:  # T, C, X, Y
-            raise NotImplementedError(
-                f"only 2D timelapses supported (total image shape: {imgs.shape})"
-            )
-        min_number = max(self._delta_frames) * (n_frames - 1) + 1
-        if len(imgs) < min_number:
-            raise ValueError(f"imgs should contain at last {min_number} elements")
-        if len(imgs.shape[2:]) != len(self._size):
+        if len(frames.shape[2:]) != len(self._size):
             raise ValueError(
                 f"incompatible shapes between images and size last {n_frames} elements"
             )
 
-        # Precompute the time slices
-        self._imgs_sequences = []
-        for delta in self._delta_frames:
-            n, k = self._n_frames, delta
-            logger.debug(f"Creating delta {delta} crops")
-            tslices = tuple(
-                slice(i, i + k * (n - 1) + 1, k) for i in range(len(imgs) - (n - 1) * k)
-            )
-            imgs_sequences = [torch.as_tensor(imgs[ss]) for ss in tslices]
-            self._imgs_sequences.extend(imgs_sequences)
-
-        self._crops_per_image = max(
-            1, int(np.prod(imgs.shape[1:3]) / np.prod(self._size))
+        # Time windows are built on demand from a single frame stack
+        self._frames = FrameStore(
+            frames,
+            n_frames=self._n_frames,
+            delta_frames=self._delta_frames,
+            owned_file=owned_file,
         )
 
-    def _reject_background(self, threshold=0.02, max_iterations=10):
-        rc = transforms.RandomCrop(
-            self._size,
-            padding_mode="reflect",
-            pad_if_needed=True,
+        self._crops_per_image = max(
+            1, int(np.prod(frames.shape[1:3]) / np.prod(self._size))
         )
 
-        def smoother(img):
-            img = skimage.util.img_as_ubyte(img.squeeze(1).numpy().clip(-1, 1))
-            img = skimage.filters.rank.median(
-                img, footprint=np.ones((self._n_frames, 3, 3))
+        if random_crop and reject_background:
+            self._foreground = ForegroundIndex(
+                frames, self._size, threshold=background_threshold
             )
-            return torch.as_tensor(skimage.util.img_as_float32(img)).unsqueeze(1)
+        else:
+            self._foreground = None
+
+    def _prepare_frames(
+        self,
+        imgs,
+        binarize,
+        normalize,
+        subsample,
+        allocate=allocate_frames,
+        chunk_size=32,
+    ):
+        """Binarizes/normalizes and subsamples raw frames into a single float32 stack.
 
-        def crop(x):
-            with torch.no_grad():
-                for i in range(max_iterations):
-                    out = rc(x)
-                    mask = smoother(out)
-                    if mask.std() > threshold:
-                        return out
-                    # logger.debug(f"Reject {i}")
-                return out
+        The default normalization is applied in chunks of frames, writing
+        directly into the (possibly memory-mapped) output stack.
 
-        return crop
+        Args:
+            imgs: ndarray of shape (T, C, H, W).
+            allocate: Function that returns an empty (frames, backing file) pair for a given shape.
 
-    def _default_normalize(self, imgs):
+        Returns:
+            Tuple of (frame stack, path of the backing file or None).
+        """
+        if subsample > 1:
+            factors = (1,) + (subsample,) * (imgs.ndim - 1)
+        else:
+            factors = (1,) * imgs.ndim
+
+        if binarize:
+            logger.debug("Binarize images")
+        else:
+            logger.debug("Normalize images")
+            if normalize is not None:
+                # A custom normalization might use statistics of the whole movie
+                imgs = normalize(imgs)
+
+        out_shape = tuple(int(np.ceil(s / f)) for s, f in zip(imgs.shape, factors))
+        frames, owned_file = allocate(out_shape)
+
+        for start in tqdm(
+            range(0, len(imgs), chunk_size), desc="preparing frames", leave=False
+        ):
+            x = imgs[start : start + chunk_size]
+            if binarize:
+                x = (x > 0).astype(np.float32)
+            elif normalize is None:
+                if subsample == 1:
+                    # normalize straight into the frame stack
+                    self._default_normalize(x, out=frames[start : start + chunk_size])
+                    continue
+                x = self._default_normalize(x)
+            if subsample > 1:
+                x = downscale_local_mean(x, factors)
+            frames[start : start + chunk_size] = x
+
+        if subsample > 1:
+            logger.debug(f"Subsampled from {imgs.shape[1:]} to {out_shape[1:]}")
+
+        if isinstance(frames, np.memmap):
+            frames.flush()
+
+        return frames, owned_file
+
+    def _window_frames(self, idx):
+        """Frame indices of the windows `idx`, shape (B, n_frames)."""
+        t0, delta = self._frames.index[np.asarray(idx)].T
+        return t0[:, None] + delta[:, None] * np.arange(self._n_frames)
+
+    def _default_normalize(self, imgs, out=None):
         """Default normalization.
 
         Normalizes each image separately. Can be overwritten in subclasses.
 
         Args:
             imgs: List of images or ndarray.
+            out: Optional float32 array to write the normalized images into.
 
         Returns:
             ndarray
 
         """
-        imgs_norm = []
-        for img in tqdm(imgs, desc="normalizing images", leave=False):
-            imgs_norm.append(utils_normalize(img, subsample=8))
-        return np.stack(imgs_norm)
+        return normalize_stack(np.asarray(imgs), out=out, **self._normalize_kwargs)
 
     def _load(self, path, split_start, split_end, n_images=None):
         """Loads image from disk into CPU memory.
@@ -259,20 +344,17 @@ class TarrowDataset(Dataset):
         inp = Path(path).expanduser()
 
         if inp.is_dir():
-            suffixes = ("png", "jpg", "tif", "tiff")
-            for s in suffixes:
-                fnames = sorted(Path(inp).glob(f"*.{s}"))
-                if len(fnames) > 0:
-                    break
-            if len(fnames) == 0:
-                raise ValueError(f"Could not find ay images in {inp}")
-
+            fnames = self._list_image_folder(inp)
             fnames = fnames[:n_images]
             imgs = self._load_image_folder(fnames, split_start, split_end)
 
         elif inp.suffix == ".tif" or inp.suffix == ".tiff":
             logger.info(f"Loading {inp}")
-            imgs = tifffile.imread(str(inp))
+            try:
+                # Uncompressed stacks are memory-mapped and only read frame by frame
+                imgs = tifffile.memmap(str(inp), mode="r")
+            except ValueError:
+                imgs = tifffile.imread(str(inp))
             logger.info("Done")
             print(f"imgs shape : {imgs.shape}")
             assert imgs.ndim == 3
@@ -288,6 +370,33 @@ class TarrowDataset(Dataset):
 
         return imgs
 
+    def _list_image_folder(self, inp):
+        suffixes = ("png", "jpg", "tif", "tiff")
+        for s in suffixes:
+            fnames = sorted(Path(inp).glob(f"*.{s}"))
+            if len(fnames) > 0:
+                break
+        if len(fnames) == 0:
+            raise ValueError(f"Could not find ay images in {inp}")
+        return fnames
+
+    def _source_files(self, path):
+        """Files that a dataset given by `path` is read from."""
+        inp = Path(path).expanduser()
+        if inp.is_dir():
+            return self._list_image_folder(inp)
+        else:
+            return [inp]
+
+    def _cache_params(self, **kwargs):
+        """Preprocessing parameters that determine the content of the frame stack."""
+        return dict(
+            dataset=type(self).__name__,
+            channels=self._channels,
+            normalize=None if kwargs.get("binarize") else self._normalize_kwargs,
+            **kwargs,
+        )
+
     def _load_image_folder(
         self,
         fnames,
@@ -299,32 +408,22 @@ class TarrowDataset(Dataset):
         fnames = fnames[idx_start:idx_end]
 
         logger.info(f"Load images {idx_start}-{idx_end}")
-        imgs = []
-        for f in tqdm(fnames, leave=False, desc="loading images"):
-            f = Path(f)
-            if f.suffix in (".tif", ".TIFF", ".tiff"):
-                x = tifffile.imread(f)
-            elif f.suffix in (".png", ".jpg", ".jpeg"):
-                x = imageio.imread(f)
-                if x.ndim == 3:
-                    x = np.moveaxis(x[..., :3], -1, 0)
-            else:
-                continue
-            x = np.squeeze(x)
-            imgs.append(x)
-        imgs = np.stack(imgs)
-        return imgs
+        return load_image_files(fnames, num_workers=self._load_workers)
 
     def __len__(self):
-        return len(self._imgs_sequences)
+        return len(self._frames)
 
     def __getitem__(self, idx):
         if isinstance(idx, (list, tuple)):
             return list(self[_idx] for _idx in idx)
 
-        x = self._imgs_sequences[idx]
+        x = self._frames[idx]
 
-        x = self._crop(x)
+        if self._foreground is not None:
+            (y0,), (x0,) = self._foreground.sample(self._window_frames([idx]))
+            x = x[..., y0 : y0 + self._size[0], x0 : x0 + self._size[1]]
+        else:
+            x = self._crop(x)
 
         if self._permute:
             if self._mode == "flip":
@@ -346,6 +445,154 @@ class TarrowDataset(Dataset):
 
         return x, label
 
+    @property
+    def crop_size(self):
+        return self._size
+
+    def crop_params(self, idx, generator=None) -> torch.Tensor:
+        """Draws crop origins and permutation labels for a batch of windows.
+
+        Args:
+            idx: Sequence or 1D tensor of window indices.
+            generator: Optional torch.Generator.
+
+        Returns:
+            LongTensor of shape (B, 4) with rows (window index, y, x, label).
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long).flatten()
+        B = len(idx)
+        H, W = self._frames.shape[2:]
+        h, w = self._size
+        if self._foreground is not None:
+            y, x = self._foreground.sample(self._window_frames(idx), generator=generator)
+            y, x = torch.from_numpy(y), torch.from_numpy(x)
+        elif self._random_crop:
+            y = torch.randint(0, H - h + 1, (B,), generator=generator)
+            x = torch.randint(0, W - w + 1, (B,), generator=generator)
+        else:
+            # same origin as transforms.CenterCrop
+            y = torch.full((B,), int(round((H - h) / 2.0)), dtype=torch.long)
+            x = torch.full((B,), int(round((W - w) / 2.0)), dtype=torch.long)
+
+        if not self._permute:
+            label = torch.zeros(B, dtype=torch.long)
+        elif self._mode == "flip":
+            label = torch.randint(0, 2, (B,), generator=generator)
+        elif self._mode == "roll":
+            label = torch.randint(0, self._n_frames, (B,), generator=generator)
+        else:
+            raise ValueError()
+
+        return torch.stack((idx, y, x, label), dim=1)
+
+    def get_batch(self, params):
+        """Gathers a batch of crops at once.
+
+        The time permutation (flip/roll) is applied as part of the gather index.
+        Per-sample augmentations are not applied (see `BatchCropLoader`).
+
+        Args:
+            params: (B, 4) tensor of (window index, y, x, label), e.g. from `crop_params`.
+
+        Returns:
+            Tuple of (tensor of shape (B, T, C, h, w), labels of shape (B,)).
+        """
+        params = torch.as_tensor(params, dtype=torch.long).numpy()
+        idx, y, x, label = params.T
+        T = self._n_frames
+        h, w = self._size
+
+        t = np.arange(T)
+        if self._mode == "flip":
+            # label 1 reverses the window
+            perm = np.where(label[:, None] == 1, T - 1 - t, t)
+        else:
+            # same as torch.roll(window, label, dims=0)
+            perm = (t[None] - label[:, None]) % T
+        t0, delta = self._frames.index[idx].T
+        tt = t0[:, None] + delta[:, None] * perm
+
+        # (T, C, H - h + 1, W - w + 1, h, w) view of all crops, gathered in one go
+        crops = np.lib.stride_tricks.sliding_window_view(
+            self._frames.frames, (h, w), axis=(2, 3)
+        )
+        out = torch.from_numpy(crops[tt, :, y[:, None], x[:, None]])
+        label = torch.from_numpy(label)
+        return out.to(self._device), label.to(self._device)
+
+
+class BatchCropLoader:
+    """Drop-in replacement for a `DataLoader` with a replacement `RandomSampler`.
+
+    Draws `num_samples` random windows per epoch from one or several `TarrowDataset`s
+    and builds each batch with a single gather per dataset (`TarrowDataset.get_batch`)
+    instead of cropping, permuting and collating sample by sample.
+
+    Args:
+        dataset:
+            A `TarrowDataset` or a `ConcatDataset` of them, all with the same crop size.
+        batch_size:
+            Number of samples per batch.
+        num_samples:
+            Number of samples per epoch.
+        augmenter:
+            Optional module applied to every batch of shape (B, T, C, h, w). If None,
+            the per-sample augmenter of each dataset is applied to its samples.
+        seed:
+            Seed of the generator used for sampling.
+    """
+
+    def __init__(self, dataset, batch_size, num_samples, augmenter=None, seed=None):
+        self.datasets = (
+            tuple(dataset.datasets)
+            if isinstance(dataset, ConcatDataset)
+            else (dataset,)
+        )
+        if len(set(d.crop_size for d in self.datasets)) > 1:
+            raise ValueError("All datasets need to have the same crop size")
+        self.cumulative_sizes = np.cumsum([len(d) for d in self.datasets])
+        self.batch_size = batch_size
+        self.num_samples = num_samples
+        self.augmenter = augmenter
+        self.generator = torch.Generator()
+        self.generator.manual_seed(
+            int(torch.empty((), dtype=torch.int64).random_().item())
+            if seed is None
+            else seed
+        )
+
+    def __len__(self):
+        return int(np.ceil(self.num_samples / self.batch_size))
+
+    def _batch(self, batch_size):
+        idx = torch.randint(
+            0, int(self.cumulative_sizes[-1]), (batch_size,), generator=self.generator
+        ).numpy()
+        dataset_idx = np.searchsorted(self.cumulative_sizes, idx, side="right")
+        offsets = np.concatenate(([0], self.cumulative_sizes[:-1]))
+
+        x, y = None, None
+        for i in np.unique(dataset_idx):
+            data = self.datasets[i]
+            where = torch.from_numpy(np.nonzero(dataset_idx == i)[0])
+            params = data.crop_params(idx[where] - offsets[i], generator=self.generator)
+            _x, _y = data.get_batch(params)
+            if self.augmenter is None and data._augmenter is not None:
+                _x = torch.stack(tuple(data._augmenter(s) for s in _x))
+            if x is None:
+                x = _x.new_empty((batch_size,) + _x.shape[1:])
+                y = _y.new_empty((batch_size,))
+            x[where.to(x.device)] = _x
+            y[where.to(y.device)] = _y
+
+        if self.augmenter is not None:
+            x = self.augmenter(x)
+        return x, y
+
+    def __iter__(self):
+        for start in range(0, self.num_samples, self.batch_size):
+            yield self._batch(min(self.batch_size, self.num_samples - start))
+
 
 class ConcatDatasetWithIndex(ConcatDataset):
     """Additionally returns index"""
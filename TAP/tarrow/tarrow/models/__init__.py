@@ -1 +1,6 @@
 from .model import TimeArrowNet
+from .embedding_cache import EmbeddingCache, EmbeddedCrops
+from .frame_lru import FrameLRU
+from .event_maps import dense_embedding, window_logits, event_maps
+from .compiled import BucketedModule, export_model, load_exported
+from .tiled import TiledExecutor, plan_tiles
@@ -112,11 +112,13 @@ class MaxPool2dDividing(nn.MaxPool2d):
         assert self.dilation == 1
 
     def forward(self, input):
-        if torch.any(
-            torch.tensor(input.shape[-2:], device=input.device)
-            % torch.tensor(self.kernel_size, device=input.device)
-            != 0
-        ):
+        # checked on python ints, so that no device sync (or graph break when compiled) is needed
+        kernel_size = (
+            self.kernel_size
+            if isinstance(self.kernel_size, tuple)
+            else (self.kernel_size,) * 2
+        )
+        if any(s % k != 0 for s, k in zip(input.shape[-2:], kernel_size)):
             raise ValueError(
                 (
                     f"Kernel size of {self} does not divide input of shape "
@@ -0,0 +1,185 @@
+"""
+Compiled execution of a TimeArrowNet with shape buckets, and export for deployment.
+
+`torch.compile` specializes a graph to the input shapes it has seen, so full frames
+and CAM windows of arbitrary size would recompile the backbone again and again.
+In eval mode, the backbone input is therefore padded to one of a few bucket sizes
+(and the batch to a power of two) and the output cropped back, in the same way
+as `PadCropModule` pads to a multiple of the backbone's downsampling factor.
+
+Exported models (TorchScript or `torch.export`) map frames of shape (B, T, C, H, W)
+to the tuple (logits, projections) and can be loaded with `load_exported` without the
+tarrow model code.
+"""
+
+import logging
+from pathlib import Path
+
+import torch
+import yaml
+
+from .backbones import PadCropModule
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (64, 96, 128, 192, 256, 384, 512, 768, 1024)
+EXPORT_FORMATS = {"torchscript": "model_scripted.pt", "export": "model_exported.pt2"}
+EXPORT_META = "export.yaml"
+
+
+def bucket_size(n: int, buckets=DEFAULT_BUCKETS) -> int:
+    """Smallest bucket >= n, or the next multiple of the largest bucket."""
+    for b in sorted(buckets):
+        if n <= b:
+            return b
+    b = max(buckets)
+    return -(-n // b) * b
+
+
+class BucketedModule(PadCropModule):
+    """Compiled module applied to inputs padded to bucket sizes.
+
+    In training mode (of the wrapped module), inputs are passed through unchanged,
+    as training crops have a fixed size anyway. In eval mode, the spatial dimensions are
+    center-padded to the next bucket and the batch is padded to the next power of two,
+    such that the compiled graph is reused for all inputs of the same bucket.
+    The output is cropped to the input size (scaled by the downsampling of the module).
+
+    Every combination of batch size and spatial buckets is a separate graph,
+    at most `torch._dynamo.config.recompile_limit` of them are compiled per module.
+
+    Args:
+        module:
+            Module on tensors of shape (B, C, H, W).
+        buckets:
+            Spatial bucket sizes.
+        mode:
+            Padding mode, `replicate` is used for inputs too small to be reflected.
+        compile_kwargs:
+            Passed to `torch.compile`.
+    """
+
+    def __init__(self, module, buckets=DEFAULT_BUCKETS, mode="reflect", **compile_kwargs):
+        super().__init__(module, mode=mode)
+        self.buckets = tuple(sorted(buckets))
+        compile_kwargs.setdefault("dynamic", False)
+        self._compiled = torch.compile(module, **compile_kwargs)
+        # input shapes the compiled module has been called with
+        self.shapes = set()
+
+    def next_valid(self, n: int):
+        return bucket_size(n, self.buckets)
+
+    def pad(self, x, shape):
+        if all(2 * s > t for s, t in zip(x.shape[-2:], shape)):
+            return super().pad(x, shape)
+        mode, self._mode = self._mode, "replicate"
+        try:
+            return super().pad(x, shape)
+        finally:
+            self._mode = mode
+
+    def _run(self, x):
+        self.shapes.add(tuple(x.shape))
+        return self._compiled(x)
+
+    def forward(self, x: torch.Tensor):
+        if self._module.training:
+            return self._run(x)
+
+        n, x_shape = len(x), x.shape[-2:]
+        n_pad = 1 << max(n - 1, 0).bit_length()
+        if n_pad > n:
+            x = torch.cat((x, x.new_zeros((n_pad - n,) + x.shape[1:])))
+        shape = self.valid_shape(x_shape)
+        y = self._run(self.pad(x, shape))[:n]
+        out_shape = tuple(-(-s * o // p) for s, o, p in zip(x_shape, y.shape[-2:], shape))
+        return self.crop(y, out_shape)
+
+
+class _InferenceModule(torch.nn.Module):
+    """Frames (B, T, C, H, W) -> (logits, projections), the interface of exported models."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, mode="both")
+
+
+@torch.no_grad()
+def export_model(model, fpath, example_input, format="torchscript"):
+    """Saves an inference-only artefact of a TimeArrowNet (in eval mode, uncompiled).
+
+    Args:
+        model:
+            TimeArrowNet.
+        fpath:
+            Output file.
+        example_input:
+            Frames of shape (B, T, C, H, W) used for tracing.
+        format:
+            `torchscript`: `torch.jit.trace`, inputs should have the spatial size of `example_input`,
+            as size-dependent padding in the backbone (e.g. of `Unet2d`) is traced as constant,
+            `export`: `torch.export` with dynamic batch and spatial size (64 to 8192), or static
+            shapes (with a warning) if the model specializes them, e.g. through size-dependent
+            padding as in `Unet2d`. `meta["dynamic"]` of `load_exported` tells which.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Export format must be one of {tuple(EXPORT_FORMATS)}, got {format}")
+
+    module = _InferenceModule(model).eval()
+    meta = dict(
+        format=format,
+        example_input_shape=list(example_input.shape),
+        n_frames=model.n_frames,
+        n_features=model.n_features,
+        outputs=["logits", "projections"],
+    )
+
+    compiled, model._compiled = model._compiled, None
+    is_training = model.training
+    model.eval()
+    try:
+        if format == "torchscript":
+            traced = torch.jit.trace(module, example_input, check_trace=False)
+            torch.jit.save(traced, str(fpath), _extra_files={EXPORT_META: yaml.dump(meta)})
+        else:
+            meta["dynamic"] = True
+            # named dims (available since torch 2.1), the export fails if the model specializes them;
+            # spatial sizes from the smallest bucket on, such that downsampled sizes stay > 1
+            dims = {
+                0: torch.export.Dim("batch"),
+                3: torch.export.Dim("height", min=min(DEFAULT_BUCKETS), max=8192),
+                4: torch.export.Dim("width", min=min(DEFAULT_BUCKETS), max=8192),
+            }
+            try:
+                program = torch.export.export(module, (example_input,), dynamic_shapes={"x": dims})
+            except Exception as e:
+                logger.warning(
+                    f"Dynamic shapes not supported by this model ({type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}), "
+                    "exporting static shapes"
+                )
+                # the failed attempt leaves dynamic-dimension marks on the example tensor
+                program = torch.export.export(module, (example_input.clone(),))
+                meta["dynamic"] = False
+            torch.export.save(program, str(fpath), extra_files={EXPORT_META: yaml.dump(meta)})
+    finally:
+        model._compiled = compiled
+        model.train(is_training)
+
+    logger.info(f"Exported model ({format}) to {fpath}")
+    return fpath
+
+
+def load_exported(fpath, map_location="cpu"):
+    """Loads an exported model as a callable frames -> (logits, projections), and its metadata."""
+    fpath = Path(fpath)
+    files = {EXPORT_META: ""}
+    if fpath.suffix == ".pt2":
+        program = torch.export.load(str(fpath), extra_files=files)
+        module = program.module().to(map_location)
+    else:
+        module = torch.jit.load(str(fpath), map_location=map_location, _extra_files=files)
+    return module, yaml.safe_load(files[EXPORT_META])
@@ -0,0 +1,195 @@
+"""
+Cache of the embeddings of a frozen TimeArrowNet for a fixed set of crops.
+
+Heads on top of a frozen model (e.g. the event classification heads of
+`Workflow/03_event_classification.py`) can then be trained on the cached
+features, instead of running the backbone on every batch of every epoch.
+
+Entries are keyed by a hash of the model weights and a hash of the crops,
+so a retrained model or a different crop set never reuses stale features.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+FEATURE_DTYPES = ("float16", "float32")
+
+
+def state_dict_hash(model: torch.nn.Module) -> str:
+    """Hash of all parameters and buffers of a model."""
+    h = hashlib.sha1()
+    for name, t in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def crop_set_hash(data) -> str:
+    """Hash of a set of crops.
+
+    For a `CropStore` this is computed from its manifest, shard files and indices,
+    otherwise from the crop tensors themselves (the first element of every item).
+    """
+    from ..data.crop_store import CropStore
+
+    h = hashlib.sha1()
+    if isinstance(data, CropStore):
+        h.update(json.dumps(data.manifest, sort_keys=True).encode())
+        for f in sorted(data.root.glob("crops_*.npy")):
+            st = f.stat()
+            h.update(f"{f.resolve()}:{st.st_size}:{st.st_mtime_ns}".encode())
+        h.update(np.ascontiguousarray(data.indices).tobytes())
+    else:
+        for item in data:
+            h.update(torch.as_tensor(item[0]).cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def _digest(desc: dict) -> str:
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+
+class EmbeddedCrops(Dataset):
+    """Precomputed embeddings with event labels, items are `(features, event_label)`.
+
+    Args:
+        features:
+            Array of shape (N, T, C, h, w), e.g. a np.memmap.
+        event_labels:
+            Array of shape (N,).
+    """
+
+    def __init__(self, features, event_labels):
+        if len(features) != len(event_labels):
+            raise ValueError(
+                f"{len(features)} features but {len(event_labels)} event labels"
+            )
+        self.features = features
+        self.event_labels = np.asarray(event_labels, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, idx):
+        x = np.asarray(self.features[idx], dtype=np.float32)
+        return torch.from_numpy(x), torch.tensor(self.event_labels[idx])
+
+
+@torch.no_grad()
+def compute_embeddings(
+    model, data, batch_size=64, device="cpu", dtype="float16", layer=0, out=None
+):
+    """Runs `model.embedding` over all crops of `data`, in the model's current (train/eval) mode.
+
+    Args:
+        out:
+            Optional callable `shape -> array` that allocates the output, e.g. a np.memmap.
+
+    Returns:
+        Tuple (features of shape (N, T, C, h, w), event labels of shape (N,)).
+    """
+    if dtype not in FEATURE_DTYPES:
+        raise ValueError(f"Feature dtype must be one of {FEATURE_DTYPES}, got {dtype}")
+    loader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False)
+    features, event_labels = None, np.empty(len(data), dtype=np.int64)
+    start = 0
+    for batch in tqdm(loader, desc="computing embeddings", leave=False):
+        x, y = batch[0].to(device), batch[1]
+        z = model.embedding(x, layer=layer).cpu().numpy()
+        if features is None:
+            shape = (len(data),) + z.shape[1:]
+            features = (
+                np.empty(shape, dtype=dtype) if out is None else out(shape, dtype)
+            )
+        features[start : start + len(z)] = z
+        event_labels[start : start + len(z)] = y.numpy()
+        start += len(z)
+    if features is None:
+        raise ValueError("No crops to embed")
+    return features, event_labels
+
+
+class EmbeddingCache:
+    """Embeddings of crop sets, in memory or memory-mapped from disk.
+
+    Args:
+        root:
+            Cache folder for `.npy` entries. If None, embeddings are only kept in memory.
+        dtype:
+            Storage type of the features, float16 halves the size.
+    """
+
+    def __init__(self, root=None, dtype="float16"):
+        if dtype not in FEATURE_DTYPES:
+            raise ValueError(f"Feature dtype must be one of {FEATURE_DTYPES}, got {dtype}")
+        self.root = None if root is None else Path(root).expanduser()
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+
+    def describe(self, model, data, layer=0) -> dict:
+        """Model and crop set hashes (and parameters) an entry is computed from."""
+        return dict(
+            version=CACHE_VERSION,
+            model=state_dict_hash(model),
+            training=model.training,
+            crops=crop_set_hash(data),
+            layer=layer,
+            dtype=self.dtype,
+        )
+
+    def key(self, model, data, layer=0) -> str:
+        return _digest(self.describe(model, data, layer))
+
+    def embed(self, model, data, batch_size=64, device="cpu", layer=0) -> EmbeddedCrops:
+        """Embeddings of all crops of `data`, computed at most once per model and crop set."""
+        if self.root is None:
+            features, event_labels = compute_embeddings(
+                model, data, batch_size, device, self.dtype, layer
+            )
+            return EmbeddedCrops(features, event_labels)
+
+        desc = self.describe(model, data, layer)
+        key = _digest(desc)
+        fname, labels_fname = self.root / f"{key}.npy", self.root / f"{key}_labels.npy"
+        if fname.exists() and labels_fname.exists():
+            logger.info(f"Loaded cached embeddings {fname}")
+            return EmbeddedCrops(np.load(fname, mmap_mode="r"), np.load(labels_fname))
+
+        tmp_files = []
+
+        def _allocate(shape, dtype):
+            fd, tmp = tempfile.mkstemp(suffix=".npy.tmp", prefix=f"{key}_", dir=self.root)
+            os.close(fd)
+            tmp_files.append(tmp)
+            return np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+
+        try:
+            features, event_labels = compute_embeddings(
+                model, data, batch_size, device, self.dtype, layer, out=_allocate
+            )
+            features.flush()
+            del features
+            np.save(labels_fname, event_labels)
+            os.replace(tmp_files[0], fname)
+        finally:
+            for tmp in tmp_files:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        with open(self.root / f"{key}.json", "wt") as f:
+            json.dump(dict(desc, n_crops=len(event_labels), created=time.time()), f)
+        logger.info(f"Cached embeddings to {fname}")
+        return EmbeddedCrops(np.load(fname, mmap_mode="r"), event_labels)
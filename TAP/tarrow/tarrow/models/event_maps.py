@@ -0,0 +1,163 @@
+"""
+Dense event probability maps of whole movies.
+
+A classification head trained on the TAP embeddings of crops (e.g. in
+`Workflow/03_event_classification.py`) is evaluated on every window of full
+frame pairs. The TAP embedding of a frame is computed once, tile by tile
+with overlap, instead of once per (overlapping) crop and frame pair.
+"""
+
+import logging
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .frame_lru import FrameLRU
+from .tiled import TiledExecutor
+
+logger = logging.getLogger(__name__)
+
+
+@torch.no_grad()
+def dense_embedding(
+    model,
+    frames,
+    tile_size=(256, 256),
+    overlap=(32, 32),
+    layer=0,
+    device="cpu",
+    batch_size=4,
+    memory_budget=None,
+):
+    """TAP embedding of full frames, computed on batches of overlapping tiles.
+
+    Args:
+        frames:
+            Normalized frames of shape (T, C, H, W), each embedded independently.
+        tile_size:
+            Spatial size of the tiles (without overlap).
+        overlap:
+            Context added on each side of a tile (reflected at the frame borders),
+            discarded after the embedding.
+        batch_size:
+            Tiles per batch.
+        memory_budget:
+            If given, peak memory in bytes of one batch, `tile_size` and `batch_size` are
+            then chosen from it (see `TiledExecutor`).
+
+    Returns:
+        Tensor of shape (T, C_embedding, H, W) on `device`.
+    """
+    # backbone and projection head process every frame independently, so all frames can be tiled as one window
+    executor = TiledExecutor(
+        model,
+        mode="embedding",
+        layer=layer,
+        tile_size=None if memory_budget is not None else tile_size,
+        overlap=overlap,
+        batch_size=None if memory_budget is not None else batch_size,
+        memory_budget=memory_budget,
+        device=device,
+    )
+    return torch.from_numpy(executor(frames)).to(device)
+
+
+@torch.no_grad()
+def window_logits(head, z, window, stride=1, batch_size=1024):
+    """Logits of a classification head for all windows of a dense embedding.
+
+    Heads with a `dense_forward(z, stride)` method (e.g. a single linear layer,
+    which is a correlation over the embedding) are evaluated in one call,
+    other heads on batches of `batch_size` unfolded windows.
+
+    Args:
+        z:
+            Embedding of shape (T, C, H, W).
+        window:
+            Crop size (h, w) the head was trained on.
+
+    Returns:
+        Tensor of shape (n_classes, H', W'), with H' = (H - h) // stride + 1,
+        i.e. entry [:, a, b] are the logits of the crop at (a * stride, b * stride).
+    """
+    if hasattr(head, "dense_forward"):
+        return head.dense_forward(z, stride)
+
+    T, C, H, W = z.shape
+    h, w = window
+    n_rows, n_cols = (H - h) // stride + 1, (W - w) // stride + 1
+    if n_rows < 1 or n_cols < 1:
+        raise ValueError(f"Window {window} larger than the frames {(H, W)}")
+    rows_per_batch = max(1, batch_size // n_cols)
+    out = []
+    for r0 in range(0, n_rows, rows_per_batch):
+        r1 = min(n_rows, r0 + rows_per_batch)
+        zz = z[:, :, r0 * stride : (r1 - 1) * stride + h]
+        # (T, C, rows, cols, h, w) -> (rows * cols, T, C, h, w)
+        windows = zz.unfold(2, h, stride).unfold(3, w, stride)
+        windows = windows.permute(2, 3, 0, 1, 4, 5).reshape(-1, T, C, h, w)
+        out.append(head(windows).reshape(r1 - r0, n_cols, -1))
+    return torch.cat(out).permute(2, 0, 1)
+
+
+@torch.no_grad()
+def event_maps(
+    model,
+    head,
+    frames,
+    window,
+    stride=1,
+    delta_frames=1,
+    tile_size=(256, 256),
+    overlap=(32, 32),
+    batch_size=1024,
+    layer=0,
+    device="cpu",
+    out=None,
+    tile_batch_size=4,
+    memory_budget=None,
+):
+    """Event probability maps of all frame pairs (t, t + delta_frames) of a movie.
+
+    Args:
+        model:
+            TimeArrowNet (in eval mode).
+        head:
+            Classification head on embedding crops of size `window`, class 1 is the event.
+        frames:
+            Normalized movie of shape (T, C, H, W).
+        tile_batch_size, memory_budget:
+            Batching of the embedding tiles, see `dense_embedding`.
+        out:
+            Optional writer with an `append` method (e.g. `ChunkedArrayWriter`) that receives
+            the map of every frame pair. If None, all maps are returned as an array.
+
+    Returns:
+        Array of shape (T - delta_frames, H', W') if `out` is None, else `out`.
+    """
+
+    def _embed(idx):
+        # frames are embedded independently, i.e. each frame once for both of its pairs
+        return dense_embedding(
+            model,
+            frames[idx],
+            tile_size=tile_size,
+            overlap=overlap,
+            layer=layer,
+            device=device,
+            batch_size=tile_batch_size,
+            memory_budget=memory_budget,
+        )
+
+    cache = FrameLRU(_embed, maxsize=delta_frames + 1)
+    maps = []
+    for t in tqdm(range(len(frames) - delta_frames), desc="event maps", leave=False):
+        z = torch.stack(cache.get([t, t + delta_frames]))
+        logits = window_logits(head, z, window, stride=stride, batch_size=batch_size)
+        probs = torch.softmax(logits, dim=0)[1].cpu().numpy()
+        if out is None:
+            maps.append(probs)
+        else:
+            out.append(probs)
+    return np.stack(maps) if out is None else out
@@ -0,0 +1,62 @@
+"""
+LRU cache of per-frame results, keyed by frame index.
+
+Backbone and projection head of a TimeArrowNet process every frame independently,
+so when sliding over a movie, the frames shared by consecutive windows
+(t, t + delta, ...) only need to be embedded once.
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FrameLRU:
+    """Least-recently-used cache of per-frame results.
+
+    Args:
+        fn:
+            Callable mapping a list of frame indices to a sequence of results
+            (e.g. a tensor with one entry per index). Called once per `get` with all missing frames.
+        maxsize:
+            Maximum number of cached frames.
+    """
+
+    def __init__(self, fn, maxsize: int):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be positive, got {maxsize}")
+        self.fn = fn
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, t):
+        return t in self._cache
+
+    def get(self, indices):
+        """Results of the frames `indices`, computing only the ones not in the cache."""
+        indices = [int(t) for t in indices]
+        missing = list(dict.fromkeys(t for t in indices if t not in self._cache))
+        self.misses += len(missing)
+        self.hits += len(indices) - len(missing)
+        fresh = dict(zip(missing, self.fn(missing))) if missing else {}
+        out = []
+        for t in indices:
+            if t in fresh:
+                out.append(fresh[t])
+            else:
+                out.append(self._cache[t])
+                self._cache.move_to_end(t)
+        for t, v in fresh.items():
+            self._cache[t] = v
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return out
+
+    def clear(self):
+        self._cache.clear()
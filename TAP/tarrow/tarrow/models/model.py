@@ -21,8 +21,11 @@ from .backbones import get_backbone
 from .proj_heads import ProjectionHead
 from .class_heads import ClassificationHead
 from .losses import DecorrelationLoss
-from ..utils import normalize, tile_iterator
-from ..visualizations import create_visuals
+from .frame_lru import FrameLRU
+from .compiled import DEFAULT_BUCKETS, EXPORT_FORMATS, BucketedModule, export_model
+from .tiled import TiledExecutor
+from ..utils import normalize, tile_iterator, is_distributed, is_main_process
+from ..visualizations import iter_visuals
 from ..visualizations import cam_insets
 
 from pdb import set_trace
@@ -85,6 +88,7 @@ class TimeArrowNet(nn.Module):
         )
 
         self.n_features = n_features
+        self.n_input_channels = n_input_channels
         self.backbone, self.bb_n_feat = get_backbone(backbone, n_input=n_input_channels)
 
         self.projection_head = ProjectionHead(
@@ -104,6 +108,10 @@ class TimeArrowNet(nn.Module):
 
         self.n_frames = n_frames
         self.device = device
+        # set by `fit(channels_last=True)`, frames are passed to the backbone as NHWC
+        self.channels_last = False
+        # compiled backbone and classification head, see `compile`
+        self._compiled = None
 
         self.proj_activations = None
         self.proj_gradients = None
@@ -138,17 +146,82 @@ class TimeArrowNet(nn.Module):
         for sub in (".", "tb", "visuals"):
             (self._outdir / sub).mkdir(exist_ok=True, parents=True)
 
+    def __getstate__(self):
+        # compiled graphs are not picklable, compile again after loading
+        state = self.__dict__.copy()
+        state["_compiled"] = None
+        return state
+
+    def compile(self, buckets=DEFAULT_BUCKETS, **compile_kwargs):
+        """Runs backbone and classification head with `torch.compile` (in training and inference).
+
+        In eval mode, backbone inputs are padded to the spatial `buckets` (see `BucketedModule`),
+        so frames and windows of varying size reuse a few compiled graphs.
+        As with any padding, outputs within the receptive field of the backbone from the
+        borders differ from the uncompiled model.
+        The classification head (which pools over space) is compiled without padding.
+        The projection head (a few 1x1 convolutions, whose layer outputs are used by
+        `embedding`) stays uncompiled.
+
+        Args:
+            buckets:
+                Spatial bucket sizes.
+            compile_kwargs:
+                Passed to `torch.compile`, e.g. `mode` or `backend`.
+        """
+        self._compiled = dict(
+            backbone=BucketedModule(self.backbone, buckets=buckets, **compile_kwargs),
+            classification_head=torch.compile(self.classification_head, **compile_kwargs),
+        )
+        return self
+
+    def export(self, format="torchscript", outdir=None, example_input=None):
+        """Saves an inference artefact (frames -> logits, projections) next to the model state.
+
+        Args:
+            format:
+                `torchscript` (saved as `model_scripted.pt`) or `export` (`model_exported.pt2`).
+            example_input:
+                Frames of shape (B, T, C, H, W) to trace the model with.
+
+        Returns:
+            Path of the artefact, to be loaded with `tarrow.models.load_exported`.
+        """
+        if outdir is None:
+            outdir = self.outdir
+        if example_input is None:
+            example_input = torch.rand(
+                (2, self.n_frames, self.n_input_channels, 96, 96), device=self.device
+            )
+        return export_model(
+            self, Path(outdir) / EXPORT_FORMATS[format], example_input, format=format
+        )
+
     def get_activation(self, model, input, output):
         self.proj_activations = output.detach()
 
     def get_gradients(self, grad):
         self.proj_gradients = grad.detach()
 
+    def _backbone(self, x):
+        """Backbone (compiled, if enabled) on frames of shape (B, C, H, W)."""
+        # models pickled before these attributes existed
+        if getattr(self, "channels_last", False):
+            x = x.contiguous(memory_format=torch.channels_last)
+        compiled = getattr(self, "_compiled", None)
+        backbone = self.backbone if compiled is None else compiled["backbone"]
+        return backbone(x)
+
     def forward(self, x, mode="classification"):
         s_in = x.shape
-        x = x.flatten(end_dim=1)
+        compiled = getattr(self, "_compiled", None)
+        classification_head = (
+            self.classification_head
+            if compiled is None
+            else compiled["classification_head"]
+        )
 
-        x = self.backbone(x)
+        x = self._backbone(x.flatten(end_dim=1))
         s_out = x.shape
 
         features = x.reshape(s_in[:2] + (self.bb_n_feat,) + s_out[2:])
@@ -159,70 +232,117 @@ class TimeArrowNet(nn.Module):
             projections.register_hook(self.get_gradients)
 
         if mode == "classification":
-            final = self.classification_head(projections)
+            final = classification_head(projections)
             return final
         elif mode == "projection":
             return projections
         elif mode == "both":
-            final = self.classification_head(projections)
+            final = classification_head(projections)
             return final, projections
         else:
             raise ValueError(f"unknown mode {mode}")
 
-    def gradcam(
-        self, x, class_id=0, norm=False, all_frames=False, tile_size=(512, 512)
+    def _cam_gradients(self, x, class_id=0):
+        """Projections and their gradients of the class score, for a batch of independent windows.
+
+        One forward and backward pass: in eval mode the windows do not interact,
+        so the gradient of the summed scores w.r.t. each window's projections is
+        the gradient of that window's own score.
+        """
+        x = torch.as_tensor(x, device=self.device)
+        with torch.enable_grad():
+            projections = self(x, mode="projection")
+            u = self.classification_head(projections)[:, class_id]
+            (alpha,) = torch.autograd.grad(u.sum(), projections)
+        return alpha, projections.detach()
+
+    def gradcam_batch(
+        self, x, class_id=0, tile_size=None, batch_size=8, return_projections=False
     ):
+        """Grad-CAMs of a batch of windows.
+
+        Windows (or, if tiled, the tiles of all windows) are processed `batch_size` at a time,
+        with one backward pass per batch.
+
+        Args:
+            x:
+                Windows of shape (B, T, C, H, W).
+            tile_size:
+                If given and smaller than the windows, CAMs are computed on overlapping tiles.
+            return_projections:
+                Also return the projections from the same forward pass.
+
+        Returns:
+            CAMs of shape (B, T, H', W'), per frame and unnormalized,
+            and projections of shape (B, T, n_features, H', W') if `return_projections`
+            (stitched from the tiles if tiled).
+        """
         if is_training := self.training:
             self.eval()
 
-        assert x.ndim == 4, f"{x.ndim=}"
-
-        def _get_alpha_and_activation(_x: torch.Tensor):
-            self.zero_grad()
-            u = self(_x.unsqueeze(0))[0]
-            u = u[class_id]
-            u.backward()
-            A = self.proj_activations[0].detach()
-            alpha = self.proj_gradients[0].detach()
-
-            return alpha, A
+        assert x.ndim == 5, f"{x.ndim=}"
 
         if tile_size is None or torch.all(
             torch.as_tensor(tile_size) >= torch.as_tensor(x.shape[-2:])
         ):
-            x = torch.as_tensor(x, device=self.device)
-            alpha, A = _get_alpha_and_activation(x)
+            alpha, A = [], []
+            for i in range(0, len(x), batch_size):
+                _alpha, _A = self._cam_gradients(x[i : i + batch_size], class_id)
+                alpha.append(_alpha)
+                A.append(_A)
+            alpha, A = torch.cat(alpha), torch.cat(A)
         else:
             if isinstance(x, torch.Tensor):
                 x = x.detach().cpu().numpy()
-            shape = (x.shape[0], self.n_features) + x.shape[2:]
+            shape = x.shape[:2] + (self.n_features,) + x.shape[3:]
             alpha = torch.zeros(shape, device=self.device)
             A = torch.zeros(shape, device=self.device)
-            blocksize = x.shape[:2] + tuple(
-                min(t, s) for t, s in zip(tile_size, x.shape[2:])
+            blocksize = x.shape[1:3] + tuple(
+                min(t, s) for t, s in zip(tile_size, x.shape[3:])
             )
-            tq = tile_iterator(
-                x,
-                blocksize=blocksize,
-                padsize=(0, 0, min(64, tile_size[0] // 4), min(64, tile_size[1] // 4)),
-                mode="reflect",
-            )
-            for tile, s_src, s_dest in tq:
-                tile = torch.as_tensor(tile, device=self.device)
-                _alpha, _A = _get_alpha_and_activation(tile)
-                if _alpha.shape[-2:] != tile.shape[-2:]:
+            tiles = [
+                (b, tile, s_src, s_dest)
+                for b in range(len(x))
+                for tile, s_src, s_dest in tile_iterator(
+                    x[b],
+                    blocksize=blocksize,
+                    padsize=(0, 0, min(64, tile_size[0] // 4), min(64, tile_size[1] // 4)),
+                    mode="reflect",
+                )
+            ]
+            for i in range(0, len(tiles), batch_size):
+                chunk = tiles[i : i + batch_size]
+                _alpha, _A = self._cam_gradients(
+                    np.stack([tile for _, tile, _, _ in chunk]), class_id
+                )
+                if _alpha.shape[-2:] != chunk[0][1].shape[-2:]:
                     raise NotImplementedError(
                         "Tiled CAMs only for nets with input size == output size"
                     )
-                s_src = (slice(None),) * 2 + s_src[2:]
-                s_dest = (slice(None),) * 2 + s_dest[2:]
-                alpha[s_src] = _alpha[s_dest]
-                A[s_src] = _A[s_dest]
+                for (b, _, s_src, s_dest), _a, _act in zip(chunk, _alpha, _A):
+                    s_src = (b,) + (slice(None),) * 2 + s_src[2:]
+                    s_dest = (slice(None),) * 2 + s_dest[2:]
+                    alpha[s_src] = _a[s_dest]
+                    A[s_src] = _act[s_dest]
 
         alpha = torch.sum(alpha, (-1, -2))
-        cam = torch.einsum("tc,tcyx->tyx", alpha, A)
-        cam = torch.abs(cam)
+        cam = torch.abs(torch.einsum("btc,btcyx->btyx", alpha, A))
+
+        if is_training:
+            self.train()
+
+        return (cam, A) if return_projections else cam
+
+    def gradcam(
+        self, x, class_id=0, norm=False, all_frames=False, tile_size=(512, 512)
+    ):
+        assert x.ndim == 4, f"{x.ndim=}"
+        cam = self.gradcam_batch(x[None], class_id=class_id, tile_size=tile_size)[0]
+        return self._finalize_cam(cam, x.shape, norm=norm, all_frames=all_frames)
 
+    @staticmethod
+    def _finalize_cam(cam, shape, norm=False, all_frames=False):
+        """CAM of a window (T, H', W') as numpy image of the input size `shape[-2:]`."""
         if all_frames:
             cam = cam.sum(0)
         else:
@@ -232,26 +352,108 @@ class TimeArrowNet(nn.Module):
             cam = (cam - cam.min()) / (cam.max() - cam.min())
 
         cam = cam.cpu().numpy()
-        factor = np.array(x.shape[-2:]) / np.array(cam.shape)
+        factor = np.array(shape[-2:]) / np.array(cam.shape)
         if not np.all(factor - 1 == 0):
             cam = zoom(cam, factor, order=1)
 
-        if is_training:
-            self.train()
-
         return cam
 
     def embedding(self, x, layer=0):
-        _ = self(x, mode="projection")
-        n = len(self.projection_head.features)
-        if n <= layer:
+        """Embedding of projection head layer `layer` (0 is the projection, 1 the layer before, ...).
+
+        Only the backbone and the projection head layers up to `layer` are run, and no
+        activations are kept in hooks (`proj_activations`, `projection_head.features`),
+        so under `torch.no_grad` nothing but the returned tensor outlives the call.
+
+        Args:
+            x: Tensor of shape (B, T, C, H, W).
+
+        Returns:
+            Tensor of shape (B, T, C', H', W').
+        """
+        features = self._backbone(x.flatten(end_dim=1))
+        features = self.projection_head.layer_output(features, layer=layer)
+        return features.reshape(x.shape[:2] + features.shape[1:])
+
+    def tiled_inference(self, x, mode="embedding", layer=0, **kwargs):
+        """Embedding or projections of a large window, computed on batches of overlapping tiles.
+
+        Args:
+            x:
+                Array or tensor of shape (T, C, H, W).
+            mode:
+                `embedding` (of projection head layer `layer`) or `projection`.
+            kwargs:
+                Passed to `TiledExecutor`, e.g. `memory_budget` (in bytes) or `stitch`.
+
+        Returns:
+            Array of shape (T, C', H, W).
+        """
+        return TiledExecutor(self, mode=mode, layer=layer, device=self.device, **kwargs)(x)
+
+    def frame_features(self, x, mode="embedding", layer=0):
+        """Embedding (of projection head layer `layer`) or projections of single frames.
+
+        Embeddings are computed with `embedding`, i.e. only up to layer `layer` and without hooks.
+
+        Args:
+            x: Tensor of shape (B, C, H, W).
+            mode: `embedding` or `projection`.
+
+        Returns:
+            Tensor of shape (B, C', H', W').
+        """
+        if mode == "embedding":
+            return self.embedding(x.unsqueeze(1), layer=layer)[:, 0]
+        return self(x.unsqueeze(1), mode="projection")[:, 0]
+
+    @torch.no_grad()
+    def movie_windows(
+        self, frames, delta_frames=1, mode="classification", layer=0, cache_size=None
+    ):
+        """Outputs for all windows (t, t + delta_frames, ..., t + (n_frames - 1) * delta_frames) of a movie.
+
+        Backbone and projection head run once per frame, the per-frame features are kept
+        in an LRU cache keyed by frame index and assembled into windows.
+
+        Args:
+            frames:
+                Tensor or array of shape (T, C, H, W).
+            mode:
+                `classification`: logits of shape (n_classes,) per window,
+                `projection`: projections of shape (n_frames, n_features, H', W'),
+                `embedding`: embedding of projection head layer `layer`, same shape.
+            cache_size:
+                Number of cached frames, by default the frame span of a window.
+
+        Yields:
+            Tuples (t, output) for every window start t.
+        """
+        if mode not in ("classification", "projection", "embedding"):
+            raise ValueError(f"unknown mode {mode}")
+        n_layers = self.projection_head.n_feature_layers
+        if mode == "embedding" and n_layers <= layer:
             raise ValueError(
-                f"{n} available feature layers. Embedding for layer {layer} not available."
+                f"{n_layers} available feature layers. Embedding for layer {layer} not available."
             )
+        span = (self.n_frames - 1) * delta_frames
+        if cache_size is None:
+            cache_size = span + 1
+
+        def _features(idx):
+            x = torch.as_tensor(frames[idx], device=self.device)
+            z = self.frame_features(
+                x, mode="embedding" if mode == "embedding" else "projection", layer=layer
+            )
+            return list(z)
 
-        features = self.projection_head.features[layer]
-        features = features.reshape(x.shape[:2] + features.shape[1:])
-        return features
+        cache = FrameLRU(_features, maxsize=cache_size)
+        for t in range(len(frames) - span):
+            z = torch.stack(cache.get(range(t, t + span + 1, delta_frames)))
+            if mode == "classification":
+                z = self.classification_head(z.unsqueeze(0))[0]
+            yield t, z
+        logger.debug(f"movie_windows: {cache.misses} frames embedded, {cache.hits} reused")
 
     def save(self, prefix="model", which="both", exist_ok: bool = False, outdir=None):
         if outdir is None:
@@ -349,8 +551,50 @@ class TimeArrowNet(nn.Module):
         save_checkpoint_every=100,
         weight_decay=1e-6,
         lambda_decorrelation=0.01,
+        mixed_precision=False,
+        channels_last=False,
+        export=None,
     ):
-        assert self.outdir is not None
+        """Trains the model.
+
+        Args:
+            mixed_precision:
+                Run forward passes under autocast, with float16 and gradient scaling on cuda
+                and bfloat16 otherwise. Losses are computed in float32.
+            channels_last:
+                Use channels-last memory format for the backbone weights and inputs.
+            export:
+                If given, the best model is also exported in this format (see `export`).
+
+        In a distributed run (see `tarrow.utils.init_distributed`), the model is wrapped in
+        `DistributedDataParallel`, the batch norm layers of the projection head are synchronized
+        and each process trains on its own shard of the loaders. Metrics are averaged over
+        all processes, TensorBoard logs and checkpoints are only written by rank 0, which
+        alone needs an `outdir`.
+        """
+        distributed = is_distributed()
+        main_process = is_main_process()
+        assert self.outdir is not None or not main_process
+
+        amp_device = torch.device(self.device).type
+        amp_dtype = torch.float16 if amp_device == "cuda" else torch.bfloat16
+        # gradient scaling is only needed for float16 (torch.cuda.amp for torch < 2.3)
+        scaler = (
+            torch.cuda.amp.GradScaler()
+            if mixed_precision and amp_device == "cuda"
+            else None
+        )
+        self.channels_last = channels_last
+        if channels_last:
+            self.backbone.to(memory_format=torch.channels_last)
+
+        if distributed:
+            self.projection_head.convert_sync_batchnorm()
+            net = nn.parallel.DistributedDataParallel(
+                self, device_ids=[self.device] if amp_device == "cuda" else None
+            )
+        else:
+            net = self
 
         optimizer = torch.optim.Adam(
             self.parameters(), lr=lr, weight_decay=weight_decay
@@ -382,59 +626,56 @@ class TimeArrowNet(nn.Module):
             n_insets = 8
             inset_size = 48
 
+            if tb_writer is None:
+                return
+
             for i, data in enumerate(dataset):
-                vis = create_visuals(
-                    dataset=data,
-                    model=self,
-                    device=self.device,
-                    max_height=480,
-                    outdir=None,
-                    return_feats=save_features,
-                )
-                if tb_writer is not None:
-                    for j, (raw_with_time, cam) in tqdm(
-                        enumerate(zip(vis.raw_with_time, vis.cam)),
-                        desc="Write insets",
-                        total=len(vis.raw_with_time),
-                        leave=True,
-                    ):
-                        fig, _, _ = cam_insets(
-                            xs=raw_with_time,
-                            cam=cam,
-                            n_insets=n_insets,
-                            w_inset=inset_size,
-                            main_frame=0,
-                        )
-                        tb_writer["cams"].add_figure(
-                            f"dataset_{i}/{j}", fig, global_step=epoch
-                        )
+                # windows are computed, normalized and written one at a time
+                for j, vis in enumerate(
+                    iter_visuals(
+                        dataset=data,
+                        model=self,
+                        max_height=480,
+                        return_feats=save_features,
+                    )
+                ):
+                    fig, _, _ = cam_insets(
+                        xs=vis.raw_with_time,
+                        cam=vis.cam,
+                        n_insets=n_insets,
+                        w_inset=inset_size,
+                        main_frame=0,
+                    )
+                    tb_writer["cams"].add_figure(
+                        f"dataset_{i}/{j}", fig, global_step=epoch
+                    )
 
                     if save_features:
-                        for j, feats in tqdm(
-                            enumerate(vis.feats),
-                            desc="Write features",
-                            total=len(vis.feats),
-                            leave=True,
-                        ):
-                            for k, feat in enumerate(feats):
-                                tb_writer["features"].add_image(
-                                    f"features_{i}/{j}",
-                                    normalize(feat[None], clip=True),
-                                    global_step=k,
-                                )
-
-        def _model_step(loader, phase="train", title="Training"):
+                        for k, feat in enumerate(vis.feats):
+                            tb_writer["features"].add_image(
+                                f"features_{i}/{j}",
+                                normalize(feat[None], clip=True),
+                                global_step=k,
+                            )
+
+        def _model_step(loader, phase="train", title="Training", epoch=0):
             start = now()
             if phase == "train":
                 self.train()
             else:
                 self.eval()
 
-            losses, losses_decorr, accs = 0.0, 0.0, 0.0
-            count, sum_preds = 0, 0
+            # loss, decorrelation loss, correct and class 1 predictions, summed on the device
+            # and synced once per epoch (and for the progress bar every few seconds)
+            sums = torch.zeros(4, device=self.device)
+            count = 0
+            last_sync = now()
+
+            if hasattr(getattr(loader, "sampler", None), "set_epoch"):
+                loader.sampler.set_epoch(epoch)
 
             with torch.set_grad_enabled(phase == "train"):
-                pbar = tqdm(loader, leave=False)
+                pbar = tqdm(loader, leave=False, disable=not main_process)
 
                 for x, y in pbar:
                     x, y = x.to(self.device), y.to(self.device)
@@ -442,7 +683,9 @@ class TimeArrowNet(nn.Module):
                     if phase == "train":
                         optimizer.zero_grad()
 
-                    out, pro = self(x, mode="both")
+                    with torch.autocast(amp_device, dtype=amp_dtype, enabled=mixed_precision):
+                        out, pro = net(x, mode="both")
+                    out, pro = out.float(), pro.float()
 
                     if out.ndim > 2:
                         y = torch.broadcast_to(
@@ -466,22 +709,38 @@ class TimeArrowNet(nn.Module):
 
                     loss_all = loss + lambda_decorrelation * loss_decorr
                     if phase == "train":
-                        loss_all.backward()
-                        optimizer.step()
+                        if scaler is None:
+                            loss_all.backward()
+                            optimizer.step()
+                        else:
+                            scaler.scale(loss_all).backward()
+                            scaler.step(optimizer)
+                            scaler.update()
                         if lr_scheduler == "cyclic":
                             scheduler.step()
 
-                    sum_preds += pred.sum().item()
-
-                    count += pred.shape[0]
-                    acc = torch.mean((pred == y).float())
-                    losses += loss.item() * pred.shape[0]
-                    losses_decorr += loss_decorr.item() * pred.shape[0]
-                    accs += acc.item() * pred.shape[0]
-                    pbar.set_description(
-                        f"{losses/count:.6f} | {losses_decorr/count:.6f} ({phase})"
+                    n = pred.shape[0]
+                    count += n
+                    sums += torch.stack(
+                        (
+                            loss.detach() * n,
+                            loss_decorr.detach() * n,
+                            (pred == y).sum(),
+                            pred.sum(),
+                        )
                     )
+                    if now() - last_sync > 5:
+                        last_sync = now()
+                        losses, losses_decorr = (sums[:2] / count).tolist()
+                        pbar.set_description(
+                            f"{losses:.6f} | {losses_decorr:.6f} ({phase})"
+                        )
 
+            if distributed:
+                sums = torch.cat((sums, sums.new_tensor([count])))
+                torch.distributed.all_reduce(sums)
+                sums, count = sums[:4], int(sums[4].item())
+            losses, losses_decorr, accs, sum_preds = sums.tolist()
             metrics = dict(
                 loss=losses / count,
                 loss_decorr=losses_decorr / count,
@@ -497,7 +756,7 @@ class TimeArrowNet(nn.Module):
         # --- NEW: Accumulate per-epoch metrics for CSV ---
         per_epoch_metrics = []
 
-        if tensorboard:
+        if tensorboard and main_process:
             tb_writer = dict(
                 (key, SummaryWriter(str(self.outdir / "tb" / key)))
                 for key in ("train", "val", "cams", "features")
@@ -516,9 +775,10 @@ class TimeArrowNet(nn.Module):
                 loader_train,
                 "train",
                 f"--- Training   ({i}/{epochs})",
+                epoch=i,
             )
             metrics_val = _model_step(
-                loader_val, "val", f"+++ Validation ({i}/{epochs})"
+                loader_val, "val", f"+++ Validation ({i}/{epochs})", epoch=i
             )
 
             if lr_scheduler == "plateau":
@@ -547,6 +807,9 @@ class TimeArrowNet(nn.Module):
                 "lr": metrics_train["lr"],
             })
 
+            if not main_process:
+                continue
+
             if self.outdir is not None:
                 if visual_dataset_frequency > 0 and i % visual_dataset_frequency == 0:
                     _save_visuals(visual_datasets, tb_writer, epoch=i)
@@ -577,6 +840,14 @@ class TimeArrowNet(nn.Module):
             if np.argmin(target) + 1 == i:
                 logger.info(f"Saving best model: epoch = {i} val_loss = {target[-1]}")
                 self.save(which="both", exist_ok=True)
+                if export is not None:
+                    try:
+                        self.export(format=export)
+                    except Exception as e:
+                        logger.warning(f"Could not export model: {e}")
+
+        if not main_process:
+            return per_epoch_metrics
 
         # --- Write per-epoch CSV at end of training ---
         import csv
@@ -617,46 +888,38 @@ class TimeArrowNet(nn.Module):
             n_insets = 8
             inset_size = 24
 
+            if tb_writer is None:
+                return
+
             for i, data in enumerate(dataset):
-                vis = create_visuals(
-                    dataset=data,
-                    model=self,
-                    device=self.device,
-                    max_height=480,
-                    outdir=None,
-                    return_feats=save_features,
-                )
-                if tb_writer is not None:
-                    for j, (raw_with_time, cam) in tqdm(
-                            enumerate(zip(vis.raw_with_time, vis.cam)),
-                            desc="Write insets",
-                            total=len(vis.raw_with_time),
-                            leave=True,
-                    ):
-                        fig, _, _ = cam_insets(
-                            xs=raw_with_time,
-                            cam=cam,
-                            n_insets=n_insets,
-                            w_inset=inset_size,
-                            main_frame=0,
-                        )
-                        tb_writer["cams"].add_figure(
-                            f"dataset_{i}/{j}", fig, global_step=epoch
-                        )
+                # windows are computed, normalized and written one at a time
+                for j, vis in enumerate(
+                    iter_visuals(
+                        dataset=data,
+                        model=self,
+                        max_height=480,
+                        return_feats=save_features,
+                    )
+                ):
+                    fig, _, _ = cam_insets(
+                        xs=vis.raw_with_time,
+                        cam=vis.cam,
+                        n_insets=n_insets,
+                        w_inset=inset_size,
+                        main_frame=0,
+                    )
+                    tb_writer["cams"].add_figure(
+                        f"dataset_{i}/{j}", fig, global_step=epoch
+                    )
 
                     if save_features:
-                        for j, feats in tqdm(
-                                enumerate(vis.feats),
-                                desc="Write features",
-                                total=len(vis.feats),
-                                leave=True,
-                        ):
-                            for k, feat in enumerate(feats):
-                                tb_writer["features"].add_image(
-                                    f"features_{i}/{j}",
-                                    normalize(feat[None], clip=True),
-                                    global_step=k,
-                                )
+                        for k, feat in enumerate(vis.feats):
+                            tb_writer["features"].add_image(
+                                f"features_{i}/{j}",
+                                normalize(feat[None], clip=True),
+                                global_step=k,
+                            )
+
         def _model_step(loader, title="Validating"):
             start = now()
             self.eval()
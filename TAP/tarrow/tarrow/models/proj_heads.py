@@ -1,9 +1,76 @@
 import logging
+import torch
 from torch import nn
+import torch.distributed as dist
 
 logger = logging.getLogger(__name__)
 
 
+class _AllReduceSum(torch.autograd.Function):
+    """Sum over all processes, with the gradients of all processes summed in the backward pass."""
+
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+class SyncBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d with batch statistics over all processes of the default process group.
+
+    Unlike `torch.nn.SyncBatchNorm`, it also runs on CPU (with the gloo backend).
+    Outside of distributed training it is a plain BatchNorm2d.
+    """
+
+    def forward(self, x):
+        if not (
+            self.training
+            and dist.is_available()
+            and dist.is_initialized()
+            and dist.get_world_size() > 1
+        ):
+            return super().forward(x)
+
+        # statistics in float32, also under autocast
+        dtype, x = x.dtype, x.float()
+        C = x.shape[1]
+        stats = torch.cat(
+            (
+                x.sum((0, 2, 3)),
+                (x * x).sum((0, 2, 3)),
+                x.new_full((1,), x.numel() // C),
+            )
+        )
+        # differentiable all-reduce, i.e. gradients flow back to every process
+        stats = _AllReduceSum.apply(stats)
+        n = stats[-1]
+        mean = stats[:C] / n
+        var = stats[C : 2 * C] / n - mean**2
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = (
+                    1 / float(self.num_batches_tracked)
+                    if self.momentum is None
+                    else self.momentum
+                )
+                self.running_mean.lerp_(mean, momentum)
+                self.running_var.lerp_(var * n / (n - 1), momentum)
+
+        x = (x - mean[:, None, None]) * torch.rsqrt(var[:, None, None] + self.eps)
+        if self.affine:
+            x = x * self.weight[:, None, None] + self.bias[:, None, None]
+        return x.to(dtype)
+
+
 def _project_heads(
     in_features: int, out_features: int, mode: str = "minimal"
 ) -> nn.Module:
@@ -67,18 +134,69 @@ class ProjectionHead(nn.Module):
 
         # Named hooks for all layers
         self.features = {}
+        self.capture_features = True
 
         def get_activation(name):
             def hook(model, input, output):
-                self.features[name] = output
+                if self.capture_features:
+                    self.features[name] = output
 
             return hook
 
-        layer_count = 0
-        for layer in reversed(list(self.layers.children())):
-            if isinstance(layer, (nn.Conv2d, nn.Identity, nn.BatchNorm2d)):
-                layer.register_forward_hook(get_activation(layer_count))
-                layer_count += 1
+        for layer_count, i in enumerate(self._feature_layers()):
+            self.layers[i].register_forward_hook(get_activation(layer_count))
+
+    def convert_sync_batchnorm(self):
+        """Replaces the batch norm layers by `SyncBatchNorm2d` (with the same parameters, buffers and hooks)."""
+        for i, layer in enumerate(self.layers.children()):
+            if isinstance(layer, nn.BatchNorm2d) and not isinstance(layer, SyncBatchNorm2d):
+                sync = SyncBatchNorm2d(
+                    layer.num_features,
+                    eps=layer.eps,
+                    momentum=layer.momentum,
+                    affine=layer.affine,
+                    track_running_stats=layer.track_running_stats,
+                )
+                # share parameters, buffers and hooks, so that e.g. an optimizer is unaffected
+                sync._parameters = layer._parameters
+                sync._buffers = layer._buffers
+                sync._forward_hooks = layer._forward_hooks
+                sync.train(layer.training)
+                self.layers[i] = sync
+        return self
+
+    def _feature_layers(self):
+        """Indices in `self.layers` of the feature layers, last layer first (the keys of `features`)."""
+        return [
+            i
+            for i, layer in reversed(list(enumerate(self.layers.children())))
+            if isinstance(layer, (nn.Conv2d, nn.Identity, nn.BatchNorm2d))
+        ]
+
+    @property
+    def n_feature_layers(self):
+        return len(self._feature_layers())
+
+    def layer_output(self, x, layer=0):
+        """Output of feature layer `layer` (numbered as `features`), without running later layers.
+
+        Nothing is stored in `features`.
+
+        Args:
+            x: Tensor of shape (batch, in_features, D0, ..., Dn), timepoints flattened into the batch.
+        """
+        feature_layers = self._feature_layers()
+        if len(feature_layers) <= layer:
+            raise ValueError(
+                f"{len(feature_layers)} available feature layers. Embedding for layer {layer} not available."
+            )
+        self.capture_features = False
+        try:
+            for module in list(self.layers.children())[: feature_layers[layer] + 1]:
+                x = module(x)
+        finally:
+            self.capture_features = True
+        return x
 
     def forward(self, x):
         # Flatten timepoints into the batch dimension
@@ -0,0 +1,247 @@
+"""
+Memory-bounded tiled inference of a TimeArrowNet on arbitrarily large frames.
+
+A window of frames is split into overlapping tiles (padded one at a time by
+`tile_iterator`), tiles are processed in batches, and the outputs are stitched
+either by cropping each tile to its valid (non-overlapping) part or by blending
+overlapping tiles with linear ramps. Tile and batch size can be derived from a
+peak-memory budget, using an upper bound of the activation memory per pixel
+measured on a small probe.
+"""
+
+import logging
+
+import numpy as np
+import torch
+
+from ..utils import tile_iterator
+
+logger = logging.getLogger(__name__)
+
+STITCH_MODES = ("crop", "blend")
+
+
+@torch.no_grad()
+def activation_bytes_per_pixel(model, fn, example):
+    """Upper bound of the memory per input pixel of `fn(example)`.
+
+    Sums the sizes of the input and of the outputs of all leaf modules of `model`,
+    i.e. assumes that no activation is freed during the forward pass.
+
+    Args:
+        example:
+            Probe of shape (1, T, C, h, w).
+    """
+    total = example.numel() * example.element_size()
+
+    def hook(module, inp, out):
+        nonlocal total
+        for o in out if isinstance(out, (tuple, list)) else (out,):
+            if torch.is_tensor(o):
+                total += o.numel() * o.element_size()
+
+    handles = [
+        m.register_forward_hook(hook)
+        for m in model.modules()
+        if next(m.children(), None) is None
+    ]
+    try:
+        fn(example)
+    finally:
+        for h in handles:
+            h.remove()
+    return total / np.prod(example.shape[-2:])
+
+
+def plan_tiles(
+    shape, bytes_per_pixel, memory_budget, overlap=(0, 0), tile_size=None, multiple=32, n_max=None
+):
+    """Largest tile size and then largest batch size within a memory budget.
+
+    Args:
+        shape:
+            Spatial frame size (H, W).
+        bytes_per_pixel:
+            Memory per pixel of a padded tile, see `activation_bytes_per_pixel`.
+        memory_budget:
+            Peak memory of one batch in bytes.
+        overlap:
+            Context on each side of a tile.
+        tile_size:
+            If given, only the batch size is chosen.
+        multiple:
+            Tile sizes are multiples of this (or the frame size).
+        n_max:
+            Maximal batch size, e.g. the number of tiles.
+
+    Returns:
+        Tuple (tile_size, batch_size).
+    """
+
+    def _tile(s):
+        return tuple(min(s, n) for n in shape)
+
+    def _cost(tile):
+        return bytes_per_pixel * np.prod([t + 2 * o for t, o in zip(tile, overlap)])
+
+    if tile_size is None:
+        s = -(-max(shape) // multiple) * multiple
+        while s > multiple and _cost(_tile(s)) > memory_budget:
+            s -= multiple
+        tile_size = _tile(s)
+    tile_size = tuple(min(t, n) for t, n in zip(tile_size, shape))
+    cost = _cost(tile_size)
+    if cost > memory_budget:
+        raise ValueError(
+            f"Memory budget of {memory_budget / 2**20:.1f} MB too small for a single tile "
+            f"of size {tile_size} (+ overlap {overlap}), which needs {cost / 2**20:.1f} MB"
+        )
+    batch_size = int(memory_budget // cost)
+    if n_max is not None:
+        batch_size = min(batch_size, n_max)
+    return tile_size, max(batch_size, 1)
+
+
+def _ramp(n, overlap):
+    """Blending weights along a padded tile of length n, rising over the first and falling over the last 2 * overlap positions."""
+    if overlap == 0:
+        return np.ones(n, np.float32)
+    k = np.arange(n, dtype=np.float32)
+    return np.clip(np.minimum(k + 0.5, n - k - 0.5) / (2 * overlap), 0, 1)
+
+
+class TiledExecutor:
+    """Embedding or projections of a TimeArrowNet on a large window, computed tile by tile.
+
+    Args:
+        model:
+            TimeArrowNet (in eval mode), with output size == input size.
+        mode:
+            `embedding` (of projection head layer `layer`) or `projection`.
+        tile_size:
+            Tile size (h, w) without overlap. Chosen from `memory_budget` if None.
+        overlap:
+            Context (y, x) added on each side of a tile, padded with `pad_mode` at the frame borders.
+        batch_size:
+            Tiles per batch. Chosen from `memory_budget` if None.
+        memory_budget:
+            Peak memory (in bytes, estimated) of one batch, used for the tile and batch size
+            that are not given. If None, tiles of size 256 are processed 4 at a time.
+        stitch:
+            `crop`: every output pixel comes from the tile it is in the valid part of,
+            `blend`: overlapping tiles are averaged with weights ramping over the overlap.
+        device:
+            Device the model runs on, outputs are stitched on the host.
+    """
+
+    def __init__(
+        self,
+        model,
+        mode="embedding",
+        layer=0,
+        tile_size=None,
+        overlap=(32, 32),
+        batch_size=None,
+        memory_budget=None,
+        stitch="crop",
+        pad_mode="reflect",
+        device="cpu",
+    ):
+        if mode not in ("embedding", "projection"):
+            raise ValueError(f"unknown mode {mode}")
+        if stitch not in STITCH_MODES:
+            raise ValueError(f"Stitch mode must be one of {STITCH_MODES}, got {stitch}")
+        self.model = model
+        self.mode = mode
+        self.layer = layer
+        self.tile_size = tile_size
+        self.overlap = tuple(overlap)
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.stitch = stitch
+        self.pad_mode = pad_mode
+        self.device = device
+
+    def _fn(self, x):
+        if self.mode == "embedding":
+            return self.model.embedding(x, layer=self.layer)
+        return self.model(x, mode="projection")
+
+    def plan(self, shape):
+        """Tile size and batch size for a window of shape (T, C, H, W)."""
+        T, C, H, W = shape
+        tile_size, batch_size = self.tile_size, self.batch_size
+        if self.memory_budget is None or (tile_size is not None and batch_size is not None):
+            tile_size = (256, 256) if tile_size is None else tile_size
+            return tuple(min(t, s) for t, s in zip(tile_size, (H, W))), batch_size or 4
+
+        probe = torch.zeros((1, T, C, 64, 64), device=self.device)
+        bpp = activation_bytes_per_pixel(self.model, self._fn, probe)
+        if tile_size is None:
+            tile_size, _ = plan_tiles((H, W), bpp, self.memory_budget, self.overlap)
+        n_tiles = int(np.prod([-(-s // t) for s, t in zip((H, W), tile_size)]))
+        tile_size, planned_batch_size = plan_tiles(
+            (H, W), bpp, self.memory_budget, self.overlap, tile_size=tile_size, n_max=n_tiles
+        )
+        batch_size = batch_size or planned_batch_size
+        logger.debug(f"Tiles {tile_size} in batches of {batch_size} ({bpp:.0f} bytes/pixel)")
+        return tile_size, batch_size
+
+    @torch.no_grad()
+    def __call__(self, x, out=None):
+        """Tiled output of a window.
+
+        Args:
+            x:
+                Array or tensor of shape (T, C, H, W).
+            out:
+                Optional zero-initialized float array of shape (T, C', H, W) to write into,
+                e.g. a `np.memmap`. Allocated if None.
+
+        Returns:
+            Array of shape (T, C', H, W).
+        """
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        x = np.asarray(x, dtype=np.float32)
+        assert x.ndim == 4, f"{x.ndim=}"
+        T, C, H, W = x.shape
+        tile_size, batch_size = self.plan(x.shape)
+
+        weights = np.zeros((H, W), np.float32) if self.stitch == "blend" else None
+        tiles = tile_iterator(
+            x,
+            blocksize=(T, C) + tile_size,
+            padsize=(0, 0) + self.overlap,
+            mode=self.pad_mode,
+        )
+        while batch := [t for _, t in zip(range(batch_size), tiles)]:
+            inp = torch.from_numpy(np.stack([tile for tile, _, _ in batch])).to(self.device)
+            pred = self._fn(inp)
+            if pred.shape[-2:] != inp.shape[-2:]:
+                raise NotImplementedError("Tiled inference only for nets with input size == output size")
+            pred = pred.float().cpu().numpy()
+            if out is None:
+                out = np.zeros((T, pred.shape[2], H, W), np.float32)
+            for p, (tile, s_src, s_dest) in zip(pred, batch):
+                if self.stitch == "crop":
+                    out[..., s_src[2], s_src[3]] = p[..., s_dest[2], s_dest[3]]
+                else:
+                    self._blend(out, weights, p, s_src, s_dest)
+
+        if weights is not None:
+            out /= weights
+        return out
+
+    def _blend(self, out, weights, p, s_src, s_dest):
+        # the padded tile starts `overlap` before its valid part, only positions inside the frame are kept
+        s_out, s_tile, ramps = [], [], []
+        for s, d, n, L, o in zip(s_src[2:], s_dest[2:], out.shape[2:], p.shape[2:], self.overlap):
+            start = s.start - d.start
+            lo, hi = max(start, 0), min(start + L, n)
+            s_out.append(slice(lo, hi))
+            s_tile.append(slice(lo - start, hi - start))
+            ramps.append(_ramp(L, o)[lo - start : hi - start])
+        w = np.outer(*ramps)
+        out[..., s_out[0], s_out[1]] += w * p[..., s_tile[0], s_tile[1]]
+        weights[s_out[0], s_out[1]] += w
@@ -1,2 +1,10 @@
 from .utils import *
 from .set_device import set_device
+from .distributed import (
+    init_distributed,
+    cleanup_distributed,
+    is_distributed,
+    get_rank,
+    get_world_size,
+    is_main_process,
+)
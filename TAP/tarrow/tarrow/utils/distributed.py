@@ -0,0 +1,71 @@
+"""
+Helpers for multi-process data-parallel training, launched with `torchrun`, e.g.
+
+    torchrun --nproc_per_node 2 train.py --gpu 0,1 ...      # one process per GPU (nccl)
+    torchrun --nproc_per_node 2 train.py --gpu cpu ...       # e.g. one process per CPU socket (gloo)
+
+Without a launcher (WORLD_SIZE unset or 1) nothing is initialized and all helpers
+behave as for a single process.
+"""
+
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(device):
+    """Initializes the default process group from the environment set by `torchrun`.
+
+    The backend is nccl for cuda devices and gloo otherwise. On CPU, the available cores
+    are split between the processes on a node.
+
+    Args:
+        device:
+            Device as returned by `set_device`.
+
+    Returns:
+        Tuple (rank, world_size, device), with the device of this process (`cuda:local_rank` on GPUs).
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    device = torch.device(device)
+    if world_size == 1:
+        return 0, 1, device
+
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if device.type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        backend = "gloo"
+        n_local = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_local))
+    dist.init_process_group(backend)
+    logger.info(f"Process {rank}/{world_size} on {device} ({backend})")
+    return rank, world_size, device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
@@ -13,10 +13,92 @@ import torch
 logger = logging.getLogger(__name__)
 
 
+# Integer types for which percentiles are computed exactly from a histogram
+_HISTOGRAM_DTYPES = (np.uint8, np.uint16)
+
+
+def image_histogram(x, subsample: int = 1):
+    """Intensity histogram of a uint8/uint16 image (or stack), for `normalize(..., hist=...)`.
+
+    Args:
+        x:
+            uint8 or uint16 array.
+        subsample:
+            Only count every n-th pixel along each axis.
+
+    Returns:
+        int64 array of 256 or 65536 counts.
+    """
+    x = np.asarray(x)
+    if x.dtype not in _HISTOGRAM_DTYPES:
+        raise ValueError(f"Histogram only supported for uint8/uint16, got {x.dtype}")
+    x = x[(slice(None, None, subsample),) * x.ndim]
+    return np.bincount(x.ravel(), minlength=np.iinfo(x.dtype).max + 1)
+
+
+def percentile_from_histogram(hist, q):
+    """Exact percentiles (numpy's default linear interpolation) from histogram counts.
+
+    Bin i is taken to hold the value i.
+
+    Args:
+        hist:
+            Array of counts of shape (..., nbins).
+        q:
+            Percentile or sequence of percentiles in [0, 100].
+
+    Returns:
+        float32 array of shape q.shape + hist.shape[:-1].
+    """
+    hist = np.asarray(hist)
+    q = np.asarray(q, dtype=np.float64)
+    batch_shape = hist.shape[:-1]
+    cdf = np.cumsum(hist.reshape(-1, hist.shape[-1]), axis=-1)
+    n = cdf[:, -1]
+    if np.any(n == 0):
+        raise ValueError("Empty histogram")
+
+    # ranks of the neighbouring order statistics, shape (n_q, n_batch)
+    pos = q.reshape(-1, 1) / 100 * (n - 1)
+    lo = np.floor(pos)
+    frac = pos - lo
+    hi = np.minimum(lo + 1, n - 1)
+
+    # the k-th smallest value is the first bin whose cdf exceeds k
+    v_lo = np.stack([np.searchsorted(c, k, side="right") for c, k in zip(cdf, lo.T)], -1)
+    v_hi = np.stack([np.searchsorted(c, k, side="right") for c, k in zip(cdf, hi.T)], -1)
+
+    res = v_lo + (v_hi - v_lo) * frac
+    return res.reshape(q.shape + batch_shape).astype(np.float32)
+
+
 def normalize(
-    x, pmin=1, pmax=99.8, clip=False, eps=1e-10, axis=None, subsample: int = 1
+    x,
+    pmin=1,
+    pmax=99.8,
+    clip=False,
+    eps=1e-10,
+    axis=None,
+    subsample: int = 1,
+    hist=None,
 ):
-    x = np.asarray(x, dtype=np.float32)
+    """Percentile-based normalization to roughly [0, 1].
+
+    For uint8/uint16 input the percentiles are computed exactly from an
+    intensity histogram (`np.bincount`, linear time) instead of sorting.
+
+    Args:
+        hist:
+            Optional precomputed intensity histogram (see `image_histogram`), e.g. of the whole movie,
+            from which the percentiles are taken instead of `x`. Only for `axis=None`.
+    """
+    x = np.asarray(x)
+
+    if hist is not None:
+        if axis is not None:
+            raise ValueError("A precomputed histogram can only be used with axis=None")
+        mi, ma = percentile_from_histogram(hist, (pmin, pmax))
+        return _rescale(x, mi, ma, clip, eps)
 
     # standardize axis, e.g. (-2,-1) -> (1,2) for 3d data
     if axis is None:
@@ -30,11 +112,19 @@ def normalize(
         for i in tuple(range(x.ndim))
     )
 
-    mi, ma = np.percentile(x[subslice], (pmin, pmax), axis=axis, keepdims=True)
+    if x.dtype in _HISTOGRAM_DTYPES and len(axis) == x.ndim:
+        mi, ma = percentile_from_histogram(image_histogram(x[subslice]), (pmin, pmax))
+    else:
+        x = x.astype(np.float32, copy=False)
+        mi, ma = np.percentile(x[subslice], (pmin, pmax), axis=axis, keepdims=True)
     logger.debug(f"Min intensity (at p={pmin/100}) = {mi}")
     logger.debug(f"Max intensity (at p={pmax/100}) = {ma}")
 
-    x = (x - mi) / (ma - mi + eps)
+    return _rescale(x, mi, ma, clip, eps)
+
+
+def _rescale(x, mi, ma, clip, eps):
+    x = (np.asarray(x, dtype=np.float32) - mi) / (ma - mi + eps)
 
     if clip:
         x = np.clip(x, 0, 1)
@@ -42,6 +132,68 @@ def normalize(
     return x.astype(np.float32, copy=False)
 
 
+def normalize_stack(
+    x,
+    pmin=1,
+    pmax=99.8,
+    clip=False,
+    eps=1e-10,
+    subsample: int = 1,
+    out=None,
+    chunk_size: int = 64,
+):
+    """Percentile-normalizes every frame of a stack separately.
+
+    Same result as `np.stack([normalize(f, ...) for f in x])` up to float32
+    rounding (abs. deviation below 1e-6 per unit of normalized intensity), but the percentiles
+    of a chunk of frames are computed in a single vectorized pass (`np.percentile`,
+    or one offset `np.bincount` for uint8/uint16 frames) and the result is written in place into a float32 buffer.
+
+    Args:
+        x:
+            Stack of frames of shape (T, ...).
+        subsample:
+            Use every n-th pixel along each non-leading axis for the percentiles.
+        out:
+            Optional float32 array of the same shape as `x` to write into, e.g. a np.memmap. Can be `x` itself.
+        chunk_size:
+            Number of frames processed at once, to bound peak memory.
+
+    Returns:
+        float32 ndarray of shape x.shape (`out`, if given).
+    """
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    elif out.shape != x.shape:
+        raise ValueError(f"Output shape {out.shape} does not match {x.shape}")
+
+    subslice = (slice(None),) + (slice(0, None, subsample),) * (x.ndim - 1)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start : start + chunk_size]
+        if chunk.dtype in _HISTOGRAM_DTYPES:
+            # one bincount for all frames of the chunk, with frame-specific offsets
+            nbins = np.iinfo(chunk.dtype).max + 1
+            sub = np.asarray(chunk[subslice]).reshape(len(chunk), -1)
+            offsets = np.arange(len(chunk), dtype=np.int64)[:, None] * nbins
+            hist = np.bincount(
+                (sub + offsets).ravel(), minlength=len(chunk) * nbins
+            ).reshape(len(chunk), nbins)
+            mi, ma = percentile_from_histogram(hist, (pmin, pmax))
+        else:
+            sub = np.asarray(chunk[subslice], dtype=np.float32).reshape(len(chunk), -1)
+            mi, ma = np.percentile(sub, (pmin, pmax), axis=1)
+        bshape = (len(chunk),) + (1,) * (x.ndim - 1)
+        mi, ma = mi.reshape(bshape), ma.reshape(bshape)
+
+        o = out[start : start + chunk_size]
+        np.subtract(chunk, mi, out=o, dtype=np.float32, casting="unsafe")
+        np.divide(o, ma - mi + np.float32(eps), out=o)
+        if clip:
+            np.clip(o, 0, 1, out=o)
+
+    return out
+
+
 def crop(x, divby):
     assert len(x) == len(divby)
     return x[tuple(slice(0, (s // d) * d) for s, d in zip(x.shape, divby))]
@@ -146,6 +298,9 @@ def tile_iterator(
 
         tile[slice_dest] is the tile in im[slice_src]
 
+    Tiles are padded one at a time (for modes that copy image values), tiles inside
+    the image are views of `im`.
+
     """
 
     if not (im.ndim == len(blocksize) == len(padsize)):
@@ -164,9 +319,23 @@ def tile_iterator(
     if verbose:
         print("tile padding... ")
 
-    im_pad = np.pad(
-        im, [(p, p + pm) for pm, p in zip(pad_mismatch, padsize)], mode=mode
-    )
+    # padding is done per tile: for each axis, the index into `im` of every position
+    # of the padded image (-1 for constant padding)
+    lazy = mode in _INDEX_PAD_MODES
+    if lazy:
+        pad_index = [
+            np.pad(
+                np.arange(n),
+                (p, p + pm),
+                mode=mode,
+                **(dict(constant_values=-1) if mode == "constant" else {}),
+            )
+            for n, p, pm in zip(im.shape, padsize, pad_mismatch)
+        ]
+    else:
+        im_pad = np.pad(
+            im, [(p, p + pm) for pm, p in zip(pad_mismatch, padsize)], mode=mode
+        )
 
     # iterates over cartesian product of subgrids
     for i, index in enumerate(product(*[range(sg) for sg in subgrids])):
@@ -188,11 +357,37 @@ def tile_iterator(
                 for i, b, p in zip(index, blocksize, padsize)
             ]
         )
-        padded_block = im_pad[s_padinput]
+        if lazy:
+            padded_block = _padded_block(im, [idx[s] for idx, s in zip(pad_index, s_padinput)])
+        else:
+            padded_block = im_pad[s_padinput]
 
         yield padded_block, s_input, s_output
 
 
+# np.pad modes that only copy values of the image, i.e. can be applied per tile
+_INDEX_PAD_MODES = ("constant", "edge", "reflect", "symmetric", "wrap")
+
+
+def _padded_block(im, indices):
+    """Block of the padded image, given the image index of every position along each axis."""
+    if all(
+        idx[0] >= 0 and np.array_equal(idx, np.arange(idx[0], idx[0] + len(idx)))
+        for idx in indices
+    ):
+        # inside the image: a view, as for the padded image before
+        return im[tuple(slice(idx[0], idx[0] + len(idx)) for idx in indices)]
+    block = im[np.ix_(*[np.maximum(idx, 0) for idx in indices])]
+    outside = np.zeros(block.shape, dtype=bool)
+    for ax, idx in enumerate(indices):
+        if np.any(idx < 0):
+            shape = [1] * block.ndim
+            shape[ax] = len(idx)
+            outside |= (idx < 0).reshape(shape)
+    block[outside] = 0
+    return block
+
+
 def uniform_filter(x, k):
     assert k % 2 == 1
     nc = x.shape[1]
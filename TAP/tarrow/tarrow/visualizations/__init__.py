@@ -1,2 +1,2 @@
-from .create_visuals import create_visuals
+from .create_visuals import create_visuals, iter_visuals
 from .cam_insets import cam_insets
@@ -2,6 +2,7 @@ from types import SimpleNamespace
 from collections import defaultdict
 from pathlib import Path
 import argparse
+import tempfile
 import numpy as np
 from tqdm import tqdm
 import imageio
@@ -11,6 +12,151 @@ import torch
 
 # from ..utils import normalize
 from tarrow.utils import normalize, str2bool
+from tarrow.utils.utils import _rescale
+
+
+def _write_frame(outdir, name, i, x, file_format):
+    subdir = Path(outdir) / name
+    subdir.mkdir(parents=True, exist_ok=True)
+    imageio.imsave(
+        subdir / f"{name}_{i:05d}.{file_format}",
+        x,
+        compression="zlib",
+    )
+
+
+def _iter_raw_visuals(dataset, model, max_height=np.inf, return_feats=False, batch_size=8):
+    """Unnormalized (raw, cam, feat or None) of every window of the dataset, computed batch by batch."""
+    for start in tqdm(
+        range(0, len(dataset), batch_size),
+        total=-(-len(dataset) // batch_size),
+        desc="creating cams",
+    ):
+        xs = torch.stack(
+            [dataset[i][0] for i in range(start, min(start + batch_size, len(dataset)))]
+        )
+        zoom_factor = (
+            max_height / xs.shape[-2]
+            if max_height > 0 and xs.shape[-2] > max_height
+            else 1
+        )
+
+        # CAMs (and projections) of the whole batch from a single forward/backward pass
+        cams, projections = model.gradcam_batch(
+            xs,
+            class_id=0,
+            # tile_size=(256, 256),
+            tile_size=None,
+            batch_size=batch_size,
+            return_projections=True,
+        )
+
+        for x, cam, proj in zip(xs, cams, projections):
+            cam = model._finalize_cam(cam, x.shape)
+
+            feat = None
+            if return_feats:
+                feat = proj[0].cpu().numpy()
+                if zoom_factor != 1:
+                    feat = ndi.zoom(feat, (1,) + (zoom_factor,) * 2, order=1)
+
+            raw = x[:, 0].detach().cpu().numpy()
+            if zoom_factor != 1:
+                raw = ndi.zoom(raw, (1,) + (zoom_factor,) * 2, order=1)
+                cam = ndi.zoom(cam, (zoom_factor,) * 2, order=1)
+
+            yield raw, cam, feat
+
+
+class PercentileSketch:
+    """Uniform random sample (reservoir) of fixed size from a stream of values, for approximate percentiles.
+
+    Args:
+        capacity:
+            Number of kept values, i.e. the memory bound.
+    """
+
+    def __init__(self, capacity: int = 2**20, seed: int = 0):
+        self.capacity = capacity
+        self.count = 0
+        self._sample = np.empty(capacity, dtype=np.float32)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float32).ravel()
+        n_fill = min(len(x), max(0, self.capacity - self.count))
+        self._sample[self.count : self.count + n_fill] = x[:n_fill]
+        rest = x[n_fill:]
+        if len(rest) > 0:
+            # item k of the stream replaces a random slot with probability capacity / (k + 1)
+            k = self.count + n_fill + np.arange(len(rest))
+            j = (self._rng.random(len(rest)) * (k + 1)).astype(np.int64)
+            keep = j < self.capacity
+            self._sample[j[keep]] = rest[keep]
+        self.count += len(x)
+
+    def percentile(self, q):
+        return np.percentile(self._sample[: min(self.count, self.capacity)], q)
+
+
+def iter_visuals(
+    dataset,
+    model,
+    max_height: int = np.inf,
+    return_feats: bool = False,
+    norm_cam=True,
+    batch_size: int = 8,
+    workdir: str = None,
+):
+    """Streaming version of `create_visuals`, yields the visuals of one window at a time.
+
+    The first pass computes raws, CAMs (and features) batch by batch, appends them to
+    chunked arrays in `workdir` (a temporary folder if None) and estimates the normalization
+    percentiles from a fixed-size sample. The second pass reads them back window by window.
+    Memory use does not depend on the length of the movie.
+
+    Yields:
+        SimpleNamespace with `raw_with_time` (T, H, W), `raws` (H, W), `cam` (H, W)
+        and `feats` (n_features, H, W) if `return_feats`, normalized as in `create_visuals`.
+    """
+    from tarrow.data import ChunkedArray, ChunkedArrayWriter
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp if workdir is None else workdir).expanduser()
+        sketches = dict(raws=PercentileSketch(), cam=PercentileSketch(seed=1))
+        writers = {}
+        for raw, cam, feat in _iter_raw_visuals(
+            dataset, model, max_height, return_feats, batch_size
+        ):
+            visual = dict(raws=raw, cam=cam, feats=feat)
+            if not writers:
+                writers = {
+                    k: ChunkedArrayWriter(workdir / k, v.shape, dtype=np.float32)
+                    for k, v in visual.items()
+                    if v is not None
+                }
+            for k, w in writers.items():
+                w.append(visual[k])
+            for k, sketch in sketches.items():
+                sketch.update(visual[k])
+        torch.cuda.empty_cache()
+        for w in writers.values():
+            w.close()
+        if not writers:
+            return
+
+        raw_range = sketches["raws"].percentile((1, 99.8))
+        cam_range = sketches["cam"].percentile((0.1, 99.99)) if norm_cam else None
+        arrays = {k: ChunkedArray(workdir / k) for k in writers}
+        for i in range(len(arrays["raws"])):
+            raw = _rescale(arrays["raws"][i], *raw_range, clip=False, eps=1e-10)
+            cam = arrays["cam"][i]
+            if cam_range is not None:
+                cam = _rescale(cam, *cam_range, clip=False, eps=1e-10)
+            res = SimpleNamespace(raw_with_time=raw, raws=raw[0], cam=cam)
+            if return_feats:
+                res.feats = arrays["feats"][i]
+            yield res
 
 
 def create_visuals(
@@ -24,42 +170,44 @@ def create_visuals(
     outdir: str = None,
     fps: int = 5,
     file_format: str = "tiff",
+    batch_size: int = 8,
+    stream: bool = False,
 ):
-    res = defaultdict(list)
-
-    for i, (x, _) in tqdm(enumerate(dataset), total=len(dataset), desc="creating cams"):
-        zoom_factor = (
-            max_height / x.shape[-2]
-            if max_height > 0 and x.shape[-2] > max_height
-            else 1
-        )
-
-        cam = model.gradcam(
-            x,
-            class_id=0,
-            norm=False,
-            # tile_size=(256, 256),
-            tile_size=None,
-        )
-
-        if return_feats:
-            feat = (
-                model(x.unsqueeze(0).to(model.device), mode="projection")[0, 0]
-                .detach()
-                .cpu()
-                .numpy()
+    """Grad-CAMs (and raw frames, features) of all windows of a dataset, optionally written to outdir.
+
+    If `stream`, the visuals are written to `outdir` window by window (see `iter_visuals`),
+    with the unnormalized stacks kept as chunked arrays in `outdir/chunked`,
+    and only the number of written windows is returned.
+    """
+    if stream:
+        if outdir is None:
+            raise ValueError("Streaming visuals need an outdir")
+        outdir = Path(outdir).expanduser()
+        n = 0
+        for i, vis in enumerate(
+            iter_visuals(
+                dataset,
+                model,
+                max_height=max_height,
+                return_feats=return_feats,
+                norm_cam=norm_cam,
+                batch_size=batch_size,
+                workdir=outdir / "chunked",
             )
-            if zoom_factor != 1:
-                feat = ndi.zoom(feat, (1,) + (zoom_factor,) * 2, order=1)
-            res["feats"].append(feat)
-
-        raw = x[:, 0].detach().cpu()
-        if zoom_factor != 1:
-            raw = ndi.zoom(raw, (1,) + (zoom_factor,) * 2, order=1)
-            cam = ndi.zoom(cam, (zoom_factor,) * 2, order=1)
+        ):
+            for name in ("raws", "cam"):
+                _write_frame(outdir, name, i, getattr(vis, name), file_format)
+            n += 1
+        return SimpleNamespace(n_frames=n, outdir=outdir)
 
+    res = defaultdict(list)
+    for raw, cam, feat in _iter_raw_visuals(
+        dataset, model, max_height, return_feats, batch_size
+    ):
         res["raws"].append(raw)
         res["cam"].append(cam)
+        if feat is not None:
+            res["feats"].append(feat)
 
     torch.cuda.empty_cache()
     for k, v in res.items():
@@ -96,14 +244,8 @@ def create_visuals(
         for name, visual in vars(res_rgb).items():
             if visual.ndim > 4:
                 continue
-            subdir = outdir / name
-            subdir.mkdir(parents=True, exist_ok=True)
             for i, x in tqdm(enumerate(visual), leave=False, desc=f"Write {name}"):
-                imageio.imsave(
-                    subdir / f"{name}_{i:05d}.{file_format}",
-                    x,
-                    compression="zlib",
-                )
+                _write_frame(outdir, name, i, x, file_format)
 
     return res
 
@@ -156,6 +298,20 @@ def get_argparser():
         help="Limit size of input image to the model",
     )
     parser.add_argument("--norm_cam", type=str2bool, default=False)
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write visuals frame by frame with bounded memory (percentiles estimated from a sample)",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="Windows per Grad-CAM batch"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache normalized input frames in this folder",
+    )
     return parser
 
 
@@ -194,6 +350,7 @@ def write_visuals(args=None):
         permute=False,
         random_crop=False,
         device=args.device,
+        cache_dir=args.cache_dir,
     )
 
     res = create_visuals(
@@ -207,6 +364,8 @@ def write_visuals(args=None):
         norm_cam=args.norm_cam,
         fps=args.fps,
         file_format=args.file_format,
+        batch_size=args.batch_size,
+        stream=args.stream,
     )
 
 
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms.functional as TF
+
+from tarrow.data import get_augmenter
+from tarrow.data.augmentations import (
+    BatchAugmenter,
+    RandomAffine,
+    RandomElastic,
+    RandomFlipRot,
+    RandomIntensity,
+    RandomNoise,
+    RandomRotate,
+    cached_tensor_grid,
+    grid_sample_batch,
+)
+
+
+def _batch(B=4, T=2, shape=(40, 50)):
+    torch.manual_seed(0)
+    return torch.rand(B, T, 1, *shape)
+
+
+def _base_grid(x):
+    return cached_tensor_grid(x.shape[-2:]).expand(x.shape[:2] + x.shape[-2:] + (2,))
+
+
+def test_affine_matches_torchvision():
+    x = _batch()
+    aug = RandomAffine(degrees=30, translate=(0.1, 0.1), scale=(0.8, 1.2), shear=10)
+
+    torch.manual_seed(1)
+    params = aug._sample_params(len(x), x.shape[-1:-3:-1])
+    torch.manual_seed(1)
+    grid = aug.warp_grid(_base_grid(x), torch.ones(len(x), dtype=torch.bool))
+    y = grid_sample_batch(x, grid, "bilinear", "zeros")
+
+    for i, _x in enumerate(x):
+        angle, tx, ty, scale, shx, shy = (p[i].item() for p in params)
+        expected = TF.affine(
+            _x,
+            angle,
+            [tx, ty],
+            scale,
+            [shx, shy],
+            interpolation=TF.InterpolationMode.BILINEAR,
+            fill=None,
+        )
+        assert torch.allclose(y[i], expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("transform", [RandomRotate, RandomElastic])
+def test_warp_matches_single(transform):
+    x = _batch(B=1)
+    aug = transform()
+    torch.manual_seed(5)
+    expected = aug.forward_impl(x[0])
+    torch.manual_seed(5)
+    grid = aug.warp_grid(_base_grid(x), torch.ones(1, dtype=torch.bool))
+    assert torch.allclose(grid_sample_batch(x, grid)[0], expected, atol=1e-4)
+
+
+@pytest.mark.parametrize(
+    "transform",
+    [
+        RandomFlipRot(),
+        RandomRotate(),
+        RandomElastic(axis=0),
+        RandomAffine(degrees=10, axis=0),
+        RandomIntensity(axis=0),
+        RandomNoise(),
+    ],
+)
+def test_batch_mask(transform):
+    x = _batch()
+    mask = torch.tensor([True, False, True, False])
+    y = transform.forward_batch(x, mask)
+    assert y.shape == x.shape
+    assert torch.equal(y[~mask], x[~mask])
+
+
+@pytest.mark.parametrize("augment_id", range(6))
+def test_batch_augmenter(augment_id):
+    x = _batch()
+    aug = get_augmenter(augment_id, batch=True)
+    assert isinstance(aug, BatchAugmenter)
+    assert aug(x).shape == x.shape
+    assert aug(x[0]).shape == x[0].shape
+
+
+def _fix_randomness(aug):
+    """Seeds the random draws of every transform, independent of the order of the draws."""
+
+    def _seeded(f, seed):
+        def g(*args, **kwargs):
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            return f(*args, **kwargs)
+
+        return g
+
+    for i, t in enumerate(aug.transforms):
+        t.sample_mask = _seeded(t.sample_mask, 100 + i)
+        t.forward_batch = _seeded(t.forward_batch, i)
+        if hasattr(t, "warp_grid"):
+            t.warp_grid = _seeded(t.warp_grid, i)
+    return aug
+
+
+@pytest.mark.parametrize("augment_id", [4, 5])
+def test_batch_augmenter_matches_sequential(augment_id):
+    """Fused warps equal the transforms applied one by one (each matching its per-sample version)."""
+    B, T, H, W = 8, 2, 48, 56
+    yy, xx = torch.meshgrid(torch.linspace(0, 1, H), torch.linspace(0, 1, W), indexing="ij")
+    # smooth and asymmetric, such that interpolating once or several times hardly differs
+    x = 0.5 + 0.3 * torch.sin(3 * xx + 2 * yy) + 0.2 * yy**2
+    x = x.expand(B, T, 1, H, W).clone()
+
+    aug = _fix_randomness(get_augmenter(augment_id, batch=True))
+    y = aug(x)
+
+    expected = x
+    for t in aug.transforms:
+        expected = t.forward_batch(expected, t.sample_mask(B, x.device))
+
+    # interpolating once instead of twice only differs along sharp (zero padded) edges,
+    # while wrong padding of the intermediate warps changes whole border regions
+    err = (y - expected).abs()
+    assert err.mean() < 5e-3
+    assert (err > 0.1).float().mean() < 0.02
@@ -0,0 +1,82 @@
+import pickle
+import numpy as np
+import torch
+import pytest
+from torch.utils.data import DataLoader
+
+from tarrow.data import CropStore, CropStoreWriter, open_crops
+
+
+def _crops(n=11, shape=(2, 1, 8, 10)):
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1, (n,) + shape).astype(np.float32)
+    event_labels = rng.integers(0, 2, n)
+    labels = rng.integers(0, 2, n)
+    coords = np.stack([rng.integers(0, 50, n), rng.integers(0, 50, n), np.arange(n), labels], 1)
+    return x, event_labels, labels, coords
+
+
+def _write(root, dtype="float16", shard_size=4):
+    x, event_labels, labels, coords = _crops()
+    with CropStoreWriter(root, shard_size=shard_size, dtype=dtype) as writer:
+        for args in zip(x, event_labels, labels, coords):
+            writer.append(*args)
+    return x, event_labels, labels, coords
+
+
+@pytest.mark.parametrize("dtype,atol", [("float16", 1e-3), ("float32", 0), ("uint8", 0.5 / 255)])
+def test_roundtrip(dtype, atol, tmp_path):
+    x, event_labels, labels, coords = _write(tmp_path / "store", dtype=dtype)
+    assert len(list((tmp_path / "store").glob("crops_*.npy"))) == 3
+
+    store = open_crops(tmp_path / "store")
+    assert isinstance(store, CropStore)
+    assert len(store) == len(x)
+    assert store.crop_shape == x.shape[1:]
+    assert np.array_equal(store.event_labels, event_labels)
+    for i in (0, 5, 10):
+        xi, ev, lab, c = store[i]
+        assert xi.dtype == torch.float32
+        assert np.allclose(xi.numpy(), x[i], atol=atol, rtol=0)
+        assert ev.item() == event_labels[i] and lab.item() == labels[i]
+        assert [t.item() for t in c] == list(coords[i])
+
+
+def test_views(tmp_path):
+    x, event_labels, _, coords = _write(tmp_path / "store")
+    store = CropStore(tmp_path / "store")
+
+    sub = store.subset([7, 2, 9]).subset([2, 0])
+    assert np.array_equal(sub.indices, [9, 7])
+    assert np.array_equal(sub.event_labels, event_labels[[9, 7]])
+    assert torch.equal(sub[0][0], store[9][0])
+
+    sub.save_view(tmp_path / "view.npz")
+    sub2 = open_crops(tmp_path / "view.npz")
+    assert np.array_equal(sub2.indices, sub.indices)
+
+    sub3 = pickle.loads(pickle.dumps(sub2))
+    assert torch.equal(sub3[1][0], store[7][0])
+
+    # staged as symlinks (e.g. by Nextflow): the view references the link next to it
+    for d in ("work1", "work2"):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / "store").symlink_to(tmp_path / "store")
+    CropStore(tmp_path / "work1" / "store").subset([9, 7]).save_view(tmp_path / "work1" / "view.npz")
+    (tmp_path / "work2" / "view.npz").symlink_to(tmp_path / "work1" / "view.npz")
+    with np.load(tmp_path / "work1" / "view.npz") as view:
+        assert str(view["root"]) == "store"
+    assert torch.equal(open_crops(tmp_path / "work2" / "view.npz")[1][0], store[7][0])
+
+    batch = next(iter(DataLoader(store, batch_size=4)))
+    assert batch[0].shape == (4,) + x.shape[1:]
+    assert torch.equal(batch[3][2], torch.arange(4))
+
+
+def test_incomplete_store(tmp_path):
+    writer = CropStoreWriter(tmp_path / "store", shard_size=2)
+    writer.append(np.zeros((2, 1, 4, 4)), 0, 0, (0, 0, 0, 0))
+    with pytest.raises(ValueError):
+        writer.append(np.zeros((2, 1, 4, 5)), 0, 0, (0, 0, 0, 0))
+    with pytest.raises(FileNotFoundError):
+        CropStore(tmp_path / "store")
@@ -0,0 +1,164 @@
+"""Tests of the event labelling in Workflow/02_data_prep.py, loaded as a module (its name is not importable)."""
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import torch
+import pytest
+
+DATA_PREP = Path(__file__).resolve().parents[3] / "Workflow" / "02_data_prep.py"
+
+
+@pytest.fixture(scope="module")
+def data_prep():
+    if not DATA_PREP.exists():
+        pytest.skip(f"{DATA_PREP} not found")
+    spec = importlib.util.spec_from_file_location("data_prep", DATA_PREP)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _masks(n=6, shape=(70, 90), n_rects=12, dense=False, seed=0):
+    """Small rectangles of 1 to 64 pixels, and optionally a block of more than 2**16 pixels."""
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((n,) + shape, dtype=np.uint8)
+    for t in range(n):
+        for _ in range(n_rects):
+            h, w = rng.integers(1, 9, 2)
+            y, x = rng.integers(0, shape[0] - h), rng.integers(0, shape[1] - w)
+            masks[t, y : y + h, x : x + w] = 255
+    if dense:
+        masks[0, :-20, :-4] = 1
+    return masks
+
+
+def _dataset(data_prep, masks, size, min_pixels=10, **kwargs):
+    imgs = np.random.default_rng(1).uniform(0, 1, masks.shape).astype(np.float32)
+    return data_prep.CellEventDataset(
+        imgs=list(imgs),
+        masks=list(masks),
+        size=size,
+        min_pixels=min_pixels,
+        normalize=lambda x: x,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "shape,size,dtype",
+    [((70, 90), (24, 32), torch.int16), ((300, 260), (40, 48), torch.int16), ((300, 260), None, torch.int32)],
+)
+def test_event_pixel_counts(data_prep, shape, size, dtype):
+    masks = _masks(shape=shape, dense=True)
+    data = _dataset(data_prep, masks, size)
+    assert data._mask_integrals.dtype == dtype
+    h, w = data._size
+
+    counts = (masks > 0).astype(np.int64)
+    counts = np.lib.stride_tricks.sliding_window_view(counts, (h, w), axis=(1, 2)).sum(axis=(-2, -1))
+    t = torch.arange(len(masks))[:, None, None]
+    i = torch.arange(counts.shape[1])[:, None]
+    j = torch.arange(counts.shape[2])
+    assert counts.max() >= min(2**16, h * w)
+    assert np.array_equal(data.event_pixel_counts(t, i, j, h, w).numpy(), counts)
+
+
+@pytest.mark.parametrize("min_pixels", [-1, 0, 10, 24])
+def test_crop_event_labels(data_prep, min_pixels):
+    """Labels from the integral images equal `label_image_pair` on the cropped masks."""
+    masks = _masks(shape=(300, 260), dense=True)
+    data = _dataset(data_prep, masks, (24, 32), min_pixels=min_pixels)
+    h, w = data._size
+    generator = torch.Generator().manual_seed(0)
+    for idx in range(len(data)):
+        i = torch.randint(0, 300 - h + 1, (200,), generator=generator)
+        j = torch.randint(0, 260 - w + 1, (200,), generator=generator)
+        _, y = data._imgs_masks_sequences[idx]
+        expected = [
+            data.label_image_pair(y[0, a : a + h, b : b + w], y[1, a : a + h, b : b + w]).item()
+            for a, b in zip(i.tolist(), j.tolist())
+        ]
+        assert data.crop_event_labels(idx, i, j).tolist() == expected
+        assert data.crop_event_labels(idx, i[0].item(), j[0].item()).item() == expected[0]
+    assert 0 < np.mean(expected) < 1
+
+
+@pytest.mark.parametrize("min_pixels", [-1, 0, 10, 24])
+@pytest.mark.parametrize("tile_size", [8, 16, 64])
+def test_event_count(data_prep, min_pixels, tile_size):
+    """Vectorised tile counts equal the loop over (zero-padded) tiles with `label_image_pair`."""
+    from torchvision.transforms.functional import crop
+
+    masks = _masks(shape=(70, 90))
+    data = _dataset(data_prep, masks, (24, 32), min_pixels=min_pixels)
+    for idx in range(len(data)):
+        _, y = data._imgs_masks_sequences[idx]
+        expected = sum(
+            data.label_image_pair(
+                crop(y[0], i, j, tile_size, tile_size), crop(y[1], i, j, tile_size, tile_size)
+            ).item()
+            for i in range(0, 70, tile_size)
+            for j in range(0, 90, tile_size)
+        )
+        assert data.event_count(idx, tile_size).item() == expected
+        assert data.event_count(idx, tile_size) is data.event_count(idx, tile_size)
+
+
+def _propose_reference(data, idx):
+    """Loop version of `propose_crop_origin`, with the same random draws."""
+    from skimage.measure import label as connected_components
+
+    _, y = data._imgs_masks_sequences[idx]
+    H, W = y.shape[-2:]
+    h, w = data._size
+    n = data._proposal_candidates
+    components = connected_components((y[:2] > 0).any(dim=0).numpy())
+    pixels = [np.argwhere(components == k) for k in range(1, components.max() + 1)]
+
+    want_event = len(pixels) > 0 and torch.rand(()).item() < data._positive_fraction
+    if want_event:
+        c = torch.randint(0, len(pixels), (n,)).tolist()
+        k = (torch.rand(n) * torch.tensor([len(pixels[a]) for a in c])).long().tolist()
+        p = np.array([pixels[a][b] for a, b in zip(c, k)])
+        i = (torch.as_tensor(p[:, 0]) - torch.randint(0, h, (n,))).clamp(0, H - h)
+        j = (torch.as_tensor(p[:, 1]) - torch.randint(0, w, (n,))).clamp(0, W - w)
+    else:
+        i = torch.randint(0, H - h + 1, (n,))
+        j = torch.randint(0, W - w + 1, (n,))
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        if data.label_image_pair(y[0, a : a + h, b : b + w], y[1, a : a + h, b : b + w]).item() == want_event:
+            return a, b
+    return i[0].item(), j[0].item()
+
+
+@pytest.mark.parametrize("min_pixels", [-1, 0, 10, 24])
+@pytest.mark.parametrize("positive_fraction", [0, 0.5, 1])
+def test_propose_crop_origin(data_prep, min_pixels, positive_fraction):
+    masks = _masks(shape=(70, 90), n_rects=3)
+    # no events in the third sequence
+    masks[2:4] = 0
+    data = _dataset(
+        data_prep, masks, (24, 32), min_pixels=min_pixels, proposal="events", positive_fraction=positive_fraction
+    )
+    h, w = data._size
+    labels = []
+    for idx in range(len(data)):
+        _, y = data._imgs_masks_sequences[idx]
+        for seed in range(20):
+            torch.manual_seed(seed)
+            i, j = data.propose_crop_origin(idx)
+            torch.manual_seed(seed)
+            assert (i, j) == _propose_reference(data, idx)
+            assert 0 <= i <= 70 - h and 0 <= j <= 90 - w
+            if idx != 2:
+                labels.append(data.crop_event_labels(idx, i, j).item())
+
+    # a crop around an event pixel is always an event if a single pixel is enough
+    if positive_fraction == 1 and min_pixels <= 0:
+        assert all(labels)
+    if positive_fraction == 0:
+        assert not any(labels)
+    if positive_fraction == 0.5:
+        assert 0.3 < np.mean(labels) < 0.7
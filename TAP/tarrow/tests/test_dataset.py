@@ -0,0 +1,290 @@
+import pickle
+import numpy as np
+import torch
+import tifffile
+import pytest
+
+from tarrow.data import TarrowDataset
+from tarrow.utils import normalize, normalize_stack
+
+
+def _movie(n=12, shape=(40, 48)):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 255, (n,) + shape).astype(np.uint16)
+
+
+@pytest.mark.parametrize("memmap_threshold", [None, 0])
+@pytest.mark.parametrize("delta_frames", [[1], [1, 3]])
+@pytest.mark.parametrize("n_frames", [2, 3])
+def test_windows(memmap_threshold, delta_frames, n_frames, tmp_path):
+    imgs = _movie()
+    data = TarrowDataset(
+        list(imgs),
+        n_frames=n_frames,
+        delta_frames=delta_frames,
+        permute=False,
+        random_crop=False,
+        memmap_dir=tmp_path,
+        memmap_threshold=memmap_threshold,
+    )
+    norm = np.stack([normalize(x, subsample=8) for x in imgs])[:, None]
+
+    expected = [
+        norm[i : i + k * (n_frames - 1) + 1 : k]
+        for k in delta_frames
+        for i in range(len(imgs) - (n_frames - 1) * k)
+    ]
+    assert len(data) == len(expected)
+    for (x, _), y in zip(data, expected):
+        assert x.shape == (n_frames, 1) + imgs.shape[1:]
+        assert torch.allclose(x, torch.as_tensor(y), atol=1e-6)
+
+
+def test_pickle_memmap(tmp_path):
+    data = TarrowDataset(
+        list(_movie()),
+        permute=False,
+        random_crop=False,
+        memmap_dir=tmp_path,
+        memmap_threshold=0,
+    )
+    data2 = pickle.loads(pickle.dumps(data))
+    assert isinstance(data2._frames.frames, np.memmap)
+    assert torch.equal(data[3][0], data2[3][0])
+
+
+def test_tiff_loader(tmp_path):
+    imgs = _movie()
+    fname = tmp_path / "movie.tif"
+    tifffile.imwrite(fname, imgs)
+    data = TarrowDataset(fname, split_end=0.5, permute=False, random_crop=False)
+    assert len(data) == len(imgs) // 2 - 1
+
+
+def test_frame_cache(tmp_path, monkeypatch):
+    from tarrow.data.frame_cache import FrameCache
+
+    imgs = _movie()
+    fname = tmp_path / "movie.tif"
+    tifffile.imwrite(fname, imgs)
+    cache_dir = tmp_path / "cache"
+
+    data = TarrowDataset(fname, subsample=2, permute=False, random_crop=False)
+    data_cached = TarrowDataset(
+        fname, subsample=2, permute=False, random_crop=False, cache_dir=cache_dir
+    )
+    assert torch.equal(data[0][0], data_cached[0][0])
+
+    # second run should not read the raw images
+    def _fail(*args, **kwargs):
+        raise AssertionError("cache miss")
+
+    monkeypatch.setattr(TarrowDataset, "_load", _fail)
+    data_cached = TarrowDataset(
+        fname, subsample=2, permute=False, random_crop=False, cache_dir=cache_dir
+    )
+    assert isinstance(data_cached._frames.frames, np.memmap)
+    assert torch.equal(data[0][0], data_cached[0][0])
+
+    cache = FrameCache(cache_dir)
+    entries = list(cache.entries())
+    assert len(entries) == 1
+    assert cache.check(*entries[0]) == "ok"
+
+    # touching the source invalidates the entry
+    tifffile.imwrite(fname, imgs[:-1])
+    assert cache.check(*entries[0]) == "stale"
+    assert cache.prune(stale=True) == [entries[0][0]]
+    assert len(list(cache.entries())) == 0
+
+
+@pytest.mark.parametrize("num_workers", [0, 4])
+def test_load_image_files(num_workers, tmp_path):
+    from tarrow.data.image_io import load_image_files
+
+    imgs = _movie()
+    fnames = []
+    for i, x in enumerate(imgs):
+        fnames.append(tmp_path / f"img_{i:03d}.tif")
+        tifffile.imwrite(fnames[-1], x)
+    (tmp_path / "notes.txt").write_text("skipped")
+
+    out = load_image_files(fnames + [tmp_path / "notes.txt"], num_workers=num_workers)
+    assert out.dtype == imgs.dtype
+    assert np.array_equal(out, imgs)
+
+    data = TarrowDataset(
+        tmp_path, permute=False, random_crop=False, load_workers=num_workers
+    )
+    assert data._frames.shape == (len(imgs), 1) + imgs.shape[1:]
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+def test_normalize_stack(dtype):
+    x = (np.random.default_rng(1).gamma(2, 40, (20, 1, 64, 70))).astype(dtype)
+    expected = np.stack([normalize(f, subsample=8) for f in x])
+    out = normalize_stack(x, subsample=8, chunk_size=7)
+    assert out.dtype == np.float32
+    assert np.allclose(out, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+@pytest.mark.parametrize("subsample", [1, 8])
+def test_normalize_histogram(dtype, subsample):
+    from tarrow.utils import image_histogram, percentile_from_histogram
+
+    x = (np.random.default_rng(2).gamma(2, 30, (3, 64, 70))).astype(dtype)
+    expected = normalize(x.astype(np.float32), subsample=subsample)
+    assert np.allclose(normalize(x, subsample=subsample), expected, rtol=0, atol=1e-6)
+
+    q = (0, 1, 37.5, 99.8, 100)
+    hist = image_histogram(x)
+    assert np.allclose(percentile_from_histogram(hist, q), np.percentile(x, q))
+    assert np.allclose(
+        normalize(x[1], hist=hist),
+        normalize(x.astype(np.float32))[1],
+        rtol=0,
+        atol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("mode", ["flip", "roll"])
+@pytest.mark.parametrize("random_crop", [True, False])
+def test_get_batch(mode, random_crop):
+    from tarrow.data import BatchCropLoader
+
+    data = TarrowDataset(
+        list(_movie()),
+        n_frames=3,
+        delta_frames=[1, 2],
+        size=(16, 20),
+        mode=mode,
+        random_crop=random_crop,
+    )
+    params = data.crop_params(torch.arange(len(data)))
+    x, y = data.get_batch(params)
+    assert x.shape == (len(data), 3, 1, 16, 20)
+    assert torch.equal(y, params[:, 3])
+
+    for (i, y0, x0, label), crop in zip(params.tolist(), x):
+        expected = data._frames[i][..., y0 : y0 + 16, x0 : x0 + 20]
+        if mode == "flip" and label == 1:
+            expected = torch.flip(expected, dims=(0,))
+        elif mode == "roll":
+            expected = torch.roll(expected, label, dims=(0,))
+        assert torch.equal(crop, expected)
+
+    loader = BatchCropLoader(data, batch_size=8, num_samples=20, seed=0)
+    assert len(loader) == 3
+    assert [len(x) for x, _ in loader] == [8, 8, 4]
+
+
+def test_foreground_index():
+    rng = np.random.default_rng(0)
+    imgs = np.full((6, 128, 128), 100, dtype=np.float32)
+    imgs[:, :40, 80:] += rng.normal(0, 50, (6, 40, 48))
+    imgs[:, -1, -1] = 400
+
+    data = TarrowDataset(list(imgs), size=(32, 32), reject_background=True)
+    params = data.crop_params(torch.arange(len(data)).repeat(20))
+    y, x = params[:, 1], params[:, 2]
+    # every crop overlaps the textured region
+    assert torch.all(y < 40) and torch.all(x + 32 > 80)
+    assert torch.all(y + 32 <= 128) and torch.all(x + 32 <= 128)
+
+    x, _ = data[0]
+    assert x.shape == (2, 1, 32, 32)
+
+
+def _cells(T=8, shape=(160, 256), sigma=0.03, n=10, seed=0):
+    """Drifting blobs on the left third of a noisy background, roughly in [0, 1]."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    c = np.stack([rng.uniform(0, shape[0], n), rng.uniform(0, shape[1] / 3, n)], 1)
+    r, a = rng.uniform(5, 12, n), rng.uniform(0.3, 0.9, n)
+    x = np.full((T, 1) + shape, 0.1, dtype=np.float32)
+    for t in range(T):
+        for (cy, cx), rr, aa in zip(c + 0.5 * t, r, a):
+            x[t, 0] += aa * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * rr**2))
+    return x + rng.normal(0, sigma, x.shape).astype(np.float32)
+
+
+def _median_filtered_std(crop):
+    """Background criterion of the former rejection sampling: std of the median-filtered window."""
+    import skimage
+
+    img = skimage.util.img_as_ubyte(crop[:, 0].clip(-1, 1))
+    img = skimage.filters.rank.median(img, footprint=np.ones((len(crop), 3, 3)))
+    return skimage.util.img_as_float32(img).std()
+
+
+@pytest.mark.parametrize("crop_size", [48, 96])
+def test_foreground_threshold(crop_size, n_frames=2, threshold=0.02):
+    """The default threshold accepts the same crops as the former median filter criterion."""
+    from tarrow.data.foreground import ForegroundIndex
+
+    x = _cells()
+    index = ForegroundIndex(x, (crop_size, crop_size), threshold=threshold)
+    T, Hs, Ws = index.std.shape
+    rng = np.random.default_rng(1)
+    t, oy, ox = (rng.integers(0, n, 300) for n in (T - n_frames + 1, Hs, Ws))
+    frames = t[:, None] + np.arange(n_frames)
+
+    new = index.std[frames, oy[:, None], ox[:, None]].astype(np.float32).mean(1) > threshold
+    old = np.array(
+        [
+            _median_filtered_std(
+                x[f, :, y * index.factor :, x0 * index.factor :][..., :crop_size, :crop_size]
+            )
+            > threshold
+            for f, y, x0 in zip(frames, oy, ox)
+        ]
+    )
+    assert 0.2 < old.mean() < 0.9
+    assert abs(new.mean() - old.mean()) < 0.05
+    assert (new == old).mean() > 0.95
+
+    # unlike the median filter, block averaging rejects crops of strong pixel noise
+    noise = _cells(sigma=0.1, n=0)
+    index = ForegroundIndex(noise, (crop_size, crop_size), threshold=threshold)
+    assert _median_filtered_std(noise[:n_frames, :, :crop_size, :crop_size]) > threshold
+    assert (index.std.astype(np.float32) < threshold).all()
+
+
+@pytest.mark.parametrize("mode", ["replacement", "no_replacement", "weighted", "sequential"])
+def test_balanced_sampler(mode):
+    from tarrow.data import BalancedSampler
+
+    labels = np.zeros(50, dtype=np.int64)
+    labels[[3, 7, 11, 20, 31, 40]] = 1
+    sampler = BalancedSampler(labels, 10, seed=1, mode=mode)
+    idx = list(sampler)
+    assert len(idx) == len(sampler) == 10
+    assert idx == list(BalancedSampler(labels, 10, seed=1, mode=mode))
+    if mode != "weighted":
+        assert labels[idx].sum() == 5
+    if mode == "no_replacement":
+        assert len(set(idx)) == 10
+    sampler.set_epoch(1)
+    assert (list(sampler) == idx) == (mode == "sequential")
+
+    shards = [BalancedSampler(labels, 10, seed=1, mode=mode, num_shards=3, shard=k) for k in range(3)]
+    assert [len(s) for s in shards] == [4, 4, 4]
+    # shards split the epoch, padded with its first samples
+    assert sorted(i for s in shards for i in s) == sorted(idx + idx[:2])
+
+
+def test_sharded_random_sampler():
+    from tarrow.data import ShardedRandomSampler
+
+    data = range(20)
+    shards = [ShardedRandomSampler(data, 10, seed=1, num_shards=3, shard=k) for k in range(3)]
+    idx = [list(s) for s in shards]
+    assert [len(s) for s in shards] == [len(i) for i in idx] == [4, 4, 4]
+    assert all(0 <= i < 20 for s in idx for i in s)
+    assert idx[0] == list(ShardedRandomSampler(data, 10, seed=1, num_shards=3, shard=0))
+    assert idx[0] != idx[1]
+    shards[0].set_epoch(1)
+    assert list(shards[0]) != idx[0]
+    with pytest.raises(ValueError):
+        ShardedRandomSampler(data, 10, num_shards=2, shard=2)
@@ -50,5 +50,432 @@ def test_symmetric(
             assert close
 
 
+def test_embedding_cache(tmp_path):
+    from tarrow.models import EmbeddingCache
+
+    model = TimeArrowNet(backbone="unet").eval()
+    data = [
+        (torch.rand(2, 1, 32, 32), torch.tensor(i % 2), torch.tensor(0)) for i in range(5)
+    ]
+    with torch.no_grad():
+        expected = model.embedding(torch.stack([d[0] for d in data]))
+
+    cache = EmbeddingCache(tmp_path, dtype="float32")
+    emb = cache.embed(model, data, batch_size=2)
+    assert np.allclose(emb.features, expected.numpy(), atol=1e-5)
+    assert np.array_equal(emb.event_labels, [0, 1, 0, 1, 0])
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+
+    # cache hit returns memory-mapped features
+    emb2 = cache.embed(model, data, batch_size=2)
+    assert isinstance(emb2.features, np.memmap)
+    assert torch.equal(emb2[3][0], emb[3][0])
+
+    # changed weights invalidate the entry
+    with torch.no_grad():
+        next(model.parameters()).add_(1)
+    key = cache.key(model, data)
+    assert not (tmp_path / f"{key}.npy").exists()
+
+
+def test_event_maps(tmp_path):
+    from tarrow.models import dense_embedding, window_logits, event_maps
+    from tarrow.data import ChunkedArray, ChunkedArrayWriter
+
+    class _Head(torch.nn.Module):
+        def __init__(self, T, C, window):
+            super().__init__()
+            self.shape = (T * C,) + window
+            self.fc = torch.nn.Linear(np.prod(self.shape), 2)
+
+        def forward(self, x):
+            return self.fc(x.reshape(len(x), -1))
+
+        def dense(self, z, stride):
+            w = self.fc.weight.reshape((2,) + self.shape)
+            return torch.nn.functional.conv2d(
+                z.reshape((1, -1) + z.shape[-2:]), w, self.fc.bias, stride=stride
+            )[0]
+
+    model = TimeArrowNet(backbone="unet").eval()
+    frames = np.random.default_rng(0).uniform(0, 1, (4, 1, 40, 48)).astype(np.float32)
+
+    z = dense_embedding(model, frames[:2], tile_size=(64, 64), overlap=(0, 0))
+    with torch.no_grad():
+        expected = model.embedding(torch.from_numpy(frames[None, :2]))[0]
+    assert torch.allclose(z, expected, atol=1e-5)
+    assert dense_embedding(model, frames[:2], tile_size=(16, 32), overlap=(8, 8)).shape == z.shape
+
+    head = _Head(2, z.shape[1], (8, 6))
+    logits = window_logits(head, z, (8, 6), stride=3, batch_size=7)
+    assert logits.shape == (2, 11, 15)
+    with torch.no_grad():
+        assert torch.allclose(logits[:, 4, 5], head(z[None, :, :, 12:20, 15:21])[0], atol=1e-5)
+    head.dense_forward = head.dense
+    assert torch.allclose(window_logits(head, z, (8, 6), stride=3), logits, atol=1e-4)
+
+    maps = event_maps(model, head, frames, (8, 6), stride=3)
+    assert maps.shape == (3, 11, 15)
+    with ChunkedArrayWriter(tmp_path / "maps", maps.shape[1:], chunk_size=2, attrs=dict(stride=3)) as writer:
+        event_maps(model, head, frames, (8, 6), stride=3, out=writer)
+    stored = ChunkedArray(tmp_path / "maps")
+    assert stored.shape == maps.shape and stored.attrs["stride"] == 3
+    assert np.allclose(np.asarray(stored), maps, atol=1e-6)
+    assert np.allclose(stored[-1, 2:4], maps[2, 2:4], atol=1e-6)
+
+
+@pytest.mark.parametrize("n_frames,delta_frames", [(2, 1), (3, 2)])
+def test_movie_windows(n_frames, delta_frames):
+    from tarrow.models import FrameLRU
+
+    model = TimeArrowNet(backbone="unet", n_frames=n_frames).eval()
+    frames = torch.rand(9, 1, 32, 32)
+    span = (n_frames - 1) * delta_frames
+    windows = torch.stack(
+        [frames[t : t + span + 1 : delta_frames] for t in range(len(frames) - span)]
+    )
+    with torch.no_grad():
+        expected = model(windows)
+        expected_emb = model.embedding(windows)
+
+    out = list(model.movie_windows(frames, delta_frames=delta_frames))
+    assert [t for t, _ in out] == list(range(len(windows)))
+    assert torch.allclose(torch.stack([u for _, u in out]), expected, atol=1e-5)
+    model.projection_head.features.clear()
+    emb = torch.stack([u for _, u in model.movie_windows(frames, delta_frames, mode="embedding")])
+    assert torch.allclose(emb, expected_emb, atol=1e-5)
+    # embeddings do not go through the hooks
+    assert len(model.projection_head.features) == 0
+    with pytest.raises(ValueError):
+        next(model.movie_windows(frames, mode="embedding", layer=model.projection_head.n_feature_layers))
+
+    calls = []
+    cache = FrameLRU(lambda idx: calls.append(idx) or [t * 10 for t in idx], maxsize=2)
+    assert cache.get([0, 1]) == [0, 10]
+    assert cache.get([1, 2]) == [10, 20]
+    assert cache.get([0, 2]) == [0, 20]
+    assert calls == [[0, 1], [2], [0]] and len(cache) == 2
+
+
+@pytest.mark.parametrize("tile_size", [None, (32, 48)])
+def test_gradcam_batch(tile_size):
+    model = TimeArrowNet(backbone="unet").eval()
+    x = torch.rand(5, 2, 1, 64, 80)
+
+    cams, projections = model.gradcam_batch(
+        x, tile_size=tile_size, batch_size=3, return_projections=True
+    )
+    assert cams.shape == (5, 2, 64, 80)
+    assert projections.shape == (5, 2, model.n_features, 64, 80)
+    for xx, cam in zip(x, cams):
+        expected = model.gradcam(xx, tile_size=tile_size, all_frames=True)
+        assert np.allclose(cam.sum(0).numpy(), expected, rtol=1e-4, atol=1e-6)
+    if tile_size is None:
+        with torch.no_grad():
+            assert torch.allclose(projections, model(x, mode="projection"), atol=1e-5)
+    # no parameter gradients are accumulated
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_stream_visuals(tmp_path):
+    import tifffile
+    from tarrow.data import TarrowDataset
+    from tarrow.visualizations import create_visuals, iter_visuals
+    from tarrow.visualizations.create_visuals import PercentileSketch
+
+    sketch = PercentileSketch(capacity=1000)
+    x = np.random.default_rng(0).normal(0, 1, 50000)
+    for chunk in np.split(x, 10):
+        sketch.update(chunk)
+    assert sketch.count == len(x)
+    assert np.allclose(sketch.percentile((5, 50, 95)), np.percentile(x, (5, 50, 95)), atol=0.2)
+
+    model = TimeArrowNet(backbone="unet").eval()
+    imgs = np.random.default_rng(1).integers(0, 255, (7, 48, 40)).astype(np.uint16)
+    data = TarrowDataset(list(imgs), permute=False, random_crop=False)
+    res = create_visuals(data, model, "cpu", return_feats=True, batch_size=4)
+
+    # the sample holds all values of the small movie, i.e. percentiles are exact
+    vis = list(iter_visuals(data, model, return_feats=True, batch_size=4))
+    assert len(vis) == len(data)
+    for v, raw, cam, feat in zip(vis, res.raw_with_time, res.cam, res.feats):
+        assert np.allclose(v.raw_with_time, raw, atol=1e-5)
+        assert np.allclose(v.cam, cam, atol=1e-4)
+        assert np.allclose(v.feats, feat, atol=1e-5)
+
+    out = create_visuals(data, model, "cpu", outdir=tmp_path, stream=True, batch_size=4)
+    assert out.n_frames == len(data)
+    assert len(list((tmp_path / "cam").glob("*.tiff"))) == len(data)
+    assert np.allclose(tifffile.imread(tmp_path / "raws" / "raws_00003.tiff"), res.raws[3], atol=1e-5)
+
+
+@pytest.mark.parametrize("backbone", ["unet", "resnet18"])
+def test_channels_last_mixed_precision(backbone):
+    model = TimeArrowNet(backbone=backbone).eval()
+    x = torch.rand((3, 2, 1, 64, 64))
+    with torch.no_grad():
+        out, pro = model(x, mode="both")
+
+        model.channels_last = True
+        model.backbone.to(memory_format=torch.channels_last)
+        out2, pro2 = model(x, mode="both")
+        assert torch.allclose(out, out2, atol=1e-4)
+        assert torch.allclose(pro, pro2, atol=1e-4)
+
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            out3 = model(x)
+        assert out3.dtype == torch.bfloat16
+        assert torch.allclose(out, out3.float(), atol=0.1)
+
+
+def test_compile_buckets(tmp_path):
+    from tarrow.models import load_exported
+    from tarrow.models.compiled import bucket_size
+
+    assert bucket_size(60, (64, 128)) == 64
+    assert bucket_size(100, (64, 128)) == 128
+    assert bucket_size(300, (64, 128)) == 384
+
+    model = TimeArrowNet(backbone="unet").eval()
+    x = torch.rand((3, 2, 1, 64, 64))
+    with torch.no_grad():
+        out, pro = model(x, mode="both")
+        model.compile(buckets=(64, 128), backend="eager")
+        out2, pro2 = model(x, mode="both")
+        assert torch.allclose(out, out2, atol=1e-4)
+        assert torch.allclose(pro, pro2, atol=1e-4)
+        # all sizes within a bucket share one padded shape
+        for size in ((70, 100), (128, 90), (100, 128)):
+            _, pro = model(torch.rand((3, 2, 1) + size), mode="both")
+            assert pro.shape[-2:] == size
+    assert model._compiled["backbone"].shapes == {(8, 1, 64, 64), (8, 1, 128, 128)}
+
+    fpath = model.export(outdir=tmp_path, example_input=x)
+    exported, meta = load_exported(fpath)
+    assert meta["format"] == "torchscript"
+    with torch.no_grad():
+        out, pro = model(x, mode="both")
+        out2, pro2 = exported(x)
+    assert torch.allclose(out, out2, atol=1e-4)
+    assert torch.allclose(pro, pro2, atol=1e-4)
+
+    # dynamic batch and spatial size, if the backbone allows it
+    model = TimeArrowNet(backbone="simple").eval()
+    fpath = model.export(format="export", outdir=tmp_path, example_input=torch.rand((2, 2, 1, 64, 64)))
+    exported, meta = load_exported(fpath)
+    assert meta["dynamic"]
+    x = torch.rand((3, 2, 1, 96, 80))
+    with torch.no_grad():
+        out, pro = model(x, mode="both")
+    out2, pro2 = exported(x)
+    assert torch.allclose(out, out2, atol=1e-4)
+    assert torch.allclose(pro, pro2, atol=1e-4)
+
+
+@pytest.mark.parametrize("projection_head", ["minimal_batchnorm", "three_3x3convs"])
+def test_embedding_fast_path(projection_head):
+    model = TimeArrowNet(backbone="unet", projection_head=projection_head).eval()
+    x = torch.rand((2, 2, 1, 48, 48))
+    with torch.no_grad():
+        n_layers = model.projection_head.n_feature_layers
+        z = [model.embedding(x, layer=layer) for layer in range(n_layers)]
+        # no activations are captured by the hooks
+        assert model.proj_activations is None
+        assert model.projection_head.features == {}
+
+        pro = model(x, mode="projection")
+        for layer, zz in enumerate(z):
+            expected = model.projection_head.features[layer]
+            assert torch.equal(zz, expected.reshape(x.shape[:2] + expected.shape[1:]))
+        assert torch.equal(z[0], pro)
+    with pytest.raises(ValueError):
+        model.embedding(x, layer=n_layers)
+
+
+@pytest.mark.parametrize("stitch", ["crop", "blend"])
+def test_tiled_inference(stitch):
+    from tarrow.models import plan_tiles
+
+    # a pixelwise model, i.e. tiling must not change the output
+    model = TimeArrowNet(backbone="id", projection_head="minimal_batchnorm").eval()
+    x = torch.rand((2, 1, 100, 70))
+    with torch.no_grad():
+        expected = model.embedding(x[None])[0].numpy()
+    z = model.tiled_inference(x, tile_size=(32, 24), overlap=(8, 5), batch_size=3, stitch=stitch)
+    assert np.allclose(z, expected, atol=1e-5)
+
+    z = model.tiled_inference(x, memory_budget=2**21, overlap=(8, 8), stitch=stitch)
+    assert np.allclose(z, expected, atol=1e-5)
+
+    # larger budgets give larger tiles, then larger batches
+    small, _ = plan_tiles((1000, 1000), 100, 2**24, overlap=(16, 16))
+    large, batch = plan_tiles((1000, 1000), 100, 2**28, overlap=(16, 16))
+    assert small[0] < large[0] == 1000 and batch == 2**28 // (100 * 1032**2)
+    with pytest.raises(ValueError):
+        plan_tiles((1000, 1000), 100, 2**10, overlap=(16, 16))
+
+
+def _sync_batchnorm_worker(rank, world_size, init_file, x, w, outdir):
+    import torch.distributed as dist
+    from tarrow.models.proj_heads import ProjectionHead
+
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    try:
+        torch.manual_seed(0)
+        head = ProjectionHead(4, 8, mode="minimal_batchnorm")
+        head.convert_sync_batchnorm()
+        x = x.chunk(world_size)[rank].clone().requires_grad_()
+        y = head(x)
+        (y * w.chunk(world_size)[rank]).sum().backward()
+        bn = [m for m in head.modules() if isinstance(m, torch.nn.BatchNorm2d)]
+        torch.save(
+            dict(
+                y=y.detach(),
+                grad=x.grad,
+                features=len(head.features),
+                running_mean=[m.running_mean for m in bn],
+                running_var=[m.running_var for m in bn],
+            ),
+            outdir / f"rank_{rank}.pt",
+        )
+    finally:
+        dist.destroy_process_group()
+
+
+def test_sync_batchnorm(tmp_path):
+    """Synchronized batch norm on 2 CPU processes equals batch norm on the full batch."""
+    from tarrow.models.proj_heads import ProjectionHead, SyncBatchNorm2d
+
+    world_size = 2
+    x = torch.rand((6, 2, 4, 5, 7))
+    w = torch.rand((6, 2, 8, 5, 7))
+    torch.multiprocessing.start_processes(
+        _sync_batchnorm_worker,
+        args=(world_size, tmp_path / "init", x, w, tmp_path),
+        nprocs=world_size,
+        start_method="fork",
+    )
+    results = [torch.load(tmp_path / f"rank_{k}.pt") for k in range(world_size)]
+
+    torch.manual_seed(0)
+    head = ProjectionHead(4, 8, mode="minimal_batchnorm")
+    x = x.clone().requires_grad_()
+    y = head(x)
+    (y * w).sum().backward()
+    bn = [m for m in head.modules() if isinstance(m, torch.nn.BatchNorm2d)]
+    assert len(bn) > 0
+
+    assert torch.allclose(torch.cat([r["y"] for r in results]), y.detach(), atol=1e-5)
+    assert torch.allclose(torch.cat([r["grad"] for r in results]), x.grad, atol=1e-5)
+    for r in results:
+        assert r["features"] == len(head.features)
+        for m, mean, var in zip(bn, r["running_mean"], r["running_var"]):
+            assert torch.allclose(mean, m.running_mean, atol=1e-6)
+            assert torch.allclose(var, m.running_var, atol=1e-6)
+
+    # without a process group, the converted head is unchanged
+    head.eval()
+    with torch.no_grad():
+        expected = head(x)
+        head.convert_sync_batchnorm()
+        assert any(isinstance(m, SyncBatchNorm2d) for m in head.modules())
+        assert torch.equal(head(x), expected)
+
+
+class _IndexedCrops(torch.utils.data.Dataset):
+    """Random crops that are a function of their index, recording the indices loaded."""
+
+    def __init__(self, n):
+        self.n = n
+        self.loaded = []
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        self.loaded.append(i)
+        x = torch.rand((2, 1, 32, 32), generator=torch.Generator().manual_seed(i))
+        return x, i % 2
+
+
+def _fit_worker(rank, world_size, init_file, tmp_path):
+    import torch.distributed as dist
+    from tarrow.data import ShardedRandomSampler
+
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    try:
+        # different initializations, DDP starts all processes from the weights of rank 0
+        torch.manual_seed(rank)
+        model = TimeArrowNet(backbone="unet", outdir=tmp_path / f"run_{rank}")
+        if rank > 0:
+            before = sorted(p for p in (tmp_path / f"run_{rank}").rglob("*"))
+        data = dict(train=_IndexedCrops(10000), val=_IndexedCrops(10000))
+        loaders = dict(
+            (
+                phase,
+                torch.utils.data.DataLoader(
+                    d,
+                    batch_size=4,
+                    sampler=ShardedRandomSampler(
+                        d, num_samples=16, seed=seed, num_shards=world_size, shard=rank
+                    ),
+                ),
+            )
+            for (phase, d), seed in zip(data.items(), (0, 1))
+        )
+        metrics = model.fit(
+            loaders["train"],
+            loaders["val"],
+            lr=1e-3,
+            lr_patience=10,
+            epochs=1,
+            steps_per_epoch=len(loaders["train"]),
+            visual_dataset_frequency=0,
+        )
+        if rank > 0:
+            assert sorted(p for p in (tmp_path / f"run_{rank}").rglob("*")) == before
+        torch.save(
+            dict(
+                state=model.state_dict(),
+                metrics=metrics,
+                loaded={k: d.loaded for k, d in data.items()},
+            ),
+            tmp_path / f"rank_{rank}.pt",
+        )
+    finally:
+        dist.destroy_process_group()
+
+
+def test_fit_distributed(tmp_path):
+    """One epoch of `fit` on 2 CPU processes keeps the models in sync."""
+    world_size = 2
+    torch.multiprocessing.start_processes(
+        _fit_worker,
+        args=(world_size, tmp_path / "init", tmp_path),
+        nprocs=world_size,
+        start_method="fork",
+    )
+    results = [torch.load(tmp_path / f"rank_{k}.pt") for k in range(world_size)]
+
+    for name, p in results[0]["state"].items():
+        assert torch.equal(p, results[1]["state"][name]), name
+
+    # each process loads its own half of the samples
+    for phase in ("train", "val"):
+        loaded = [set(r["loaded"][phase]) for r in results]
+        assert all(len(r["loaded"][phase]) == 8 for r in results)
+        assert loaded[0].isdisjoint(loaded[1])
+
+    assert results[0]["metrics"] == results[1]["metrics"]
+
+    # only rank 0 writes its outdir (rank 1 is checked in the worker)
+    for f in ("losses.json", "metrics.csv", "model_full.pt", "model_state.pt"):
+        assert (tmp_path / "run_0" / f).exists(), f
+
+
 if __name__ == "__main__":
     test_symmetric("minimal_batchnorm", "minimal", 2, 3)
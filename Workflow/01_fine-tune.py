@@ -24,7 +24,7 @@ if str(tarrow_path) not in sys.path:
 
 import tarrow
 from tarrow.models import TimeArrowNet
-from tarrow.data import TarrowDataset, get_augmenter
+from tarrow.data import TarrowDataset, BatchCropLoader, ShardedRandomSampler, get_augmenter
 from tarrow.visualizations import create_visuals
 
 # --- Logging setup ---
@@ -64,7 +64,19 @@ def get_argparser():
     parser.add("--train_samples_per_epoch", type=int, default=100000)
     parser.add("--val_samples_per_epoch", type=int, default=10000)
     parser.add("--channels", type=int, default=0)
-    parser.add("--reject_background", type=tarrow.utils.str2bool, default=False)
+    parser.add("--reject_background", type=tarrow.utils.str2bool, default=False,
+               help="Draw crops where the intensity std of the block-averaged frames (about 8x8 cells per crop) exceeds 0.02.")
+    parser.add("--batch_crops", type=tarrow.utils.str2bool, default=False,
+               help="Gather each batch with a single batched crop instead of per-sample DataLoader workers.")
+    parser.add("--mixed_precision", type=tarrow.utils.str2bool, default=False,
+               help="Train with autocast (float16 with gradient scaling on GPU, bfloat16 on CPU).")
+    parser.add("--channels_last", type=tarrow.utils.str2bool, default=False,
+               help="Run the backbone in channels-last memory format.")
+    parser.add("--compile", type=tarrow.utils.str2bool, default=False,
+               help="Run the model with `torch.compile`.")
+    parser.add("--export", choices=["torchscript", "export"], default=None,
+               help="Also export the best model for inference without the tarrow code. `export` has dynamic "
+                    "batch and frame sizes only if the backbone allows it, otherwise fixed ones.")
     parser.add("--cam_subsampling", type=int, default=3)
     parser.add("--write_final_cams", type=tarrow.utils.str2bool, default=False)
     parser.add("--augment", type=int, default=5)
@@ -78,6 +90,8 @@ def get_argparser():
     parser.add("--binarize", action="store_true")
     parser.add("--decor_loss", type=float, default=0.01)
     parser.add("--save_checkpoint_every", type=int, default=25)
+    parser.add("--cache_dir", type=str, default=None,
+               help="Cache normalized input frames in this folder to speed up subsequent runs.")
     parser.add("--num_workers", type=int, default=8)
     parser.add("--gpu", "-g", type=str, default="0")
     parser.add("--tensorboard", type=tarrow.utils.str2bool, default=True)
@@ -163,15 +177,21 @@ def _build_dataset(
         binarize=args.binarize,
         random_crop=random_crop,
         reject_background=reject_background,
+        cache_dir=args.cache_dir,
     )
 
 def _subset(data: Dataset, split=(0, 1.0)):
     low, high = int(len(data) * split[0]), int(len(data) * split[1])
     return Subset(data, range(low, high))
 
-def _create_loader(dataset, args, num_samples, num_workers, idx=None, sequential=False):
-    sampler = (
-        torch.utils.data.SequentialSampler(
+def _create_loader(dataset, args, num_samples, num_workers, idx=None, sequential=False, augmenter=None,
+                   rank=0, world_size=1):
+    # with several processes, each one draws num_samples / world_size samples per epoch
+    if args.batch_crops and not sequential:
+        return BatchCropLoader(dataset, batch_size=args.batchsize, num_samples=-(-num_samples // world_size),
+                               augmenter=augmenter)
+    if sequential:
+        sampler = torch.utils.data.SequentialSampler(
             torch.utils.data.Subset(
                 dataset,
                 torch.multinomial(
@@ -179,11 +199,14 @@ def _create_loader(dataset, args, num_samples, num_workers, idx=None, sequential
                 ),
             )
         )
-        if sequential
-        else torch.utils.data.RandomSampler(
+    elif world_size > 1:
+        sampler = ShardedRandomSampler(
+            dataset, num_samples=num_samples, seed=args.seed, num_shards=world_size, shard=rank
+        )
+    else:
+        sampler = torch.utils.data.RandomSampler(
             dataset, replacement=True, num_samples=num_samples
         )
-    )
     return torch.utils.data.DataLoader(
         dataset,
         sampler=sampler,
@@ -464,11 +487,6 @@ def main(args):
     args.split_train = _convert_to_split_pairs(args.split_train)
     args.split_val = _convert_to_split_pairs(args.split_val)
 
-    outdir = _build_outdir_path(args)
-    outdir.mkdir(parents=True, exist_ok=True)
-    figures_dir = outdir / "figures"
-    figures_dir.mkdir(exist_ok=True)
-
     for p in args.input_train:
         if not Path(p).exists():
             raise FileNotFoundError(f"Training path not found: {p}")
@@ -483,7 +501,6 @@ def main(args):
     except git.InvalidGitRepositoryError:
         pass
 
-    tarrow.utils.seed(args.seed)
     try:
         use_gpu = (
             hasattr(args, "gpu")
@@ -494,7 +511,6 @@ def main(args):
         if use_gpu:
             device, n_gpus = tarrow.utils.set_device(args.gpu)
             if n_gpus > 1:
-                logger.info(f"Using {n_gpus} GPUs with DataParallel.")
                 device = torch.device(f"cuda:{args.gpu.split(',')[0]}")
             else:
                 device = torch.device(f"cuda:{args.gpu}")
@@ -506,9 +522,30 @@ def main(args):
         logger.warning(f"Could not set GPU device ({e}), falling back to CPU.")
         device = torch.device("cpu")
         n_gpus = 0
-    logger.info(f"Using device: {device}")
+    rank, world_size, device = tarrow.utils.init_distributed(device)
+    main_process = rank == 0
+    if n_gpus > 1 and world_size == 1:
+        logger.warning(
+            f"{n_gpus} GPUs requested, but training on {device} only. "
+            "Launch with `torchrun --nproc_per_node N` for distributed data-parallel training."
+        )
+    if not main_process:
+        logging.getLogger().setLevel(logging.WARNING)
+    logger.info(f"Using device: {device} (process {rank + 1}/{world_size})")
 
-    augmenter = get_augmenter(args.augment)
+    # different random crops and augmentations in each process
+    tarrow.utils.seed(args.seed + rank)
+
+    # only rank 0 writes logs, checkpoints, the model and figures
+    outdir = None
+    if main_process:
+        outdir = _build_outdir_path(args)
+        outdir.mkdir(parents=True, exist_ok=True)
+        figures_dir = outdir / "figures"
+        figures_dir.mkdir(exist_ok=True)
+
+    # with batched crops, whole batches are augmented by the loader after collation
+    augmenter = get_augmenter(args.augment, batch=args.batch_crops)
 
     inputs = {}
     for inp, phase in zip((args.input_train, args.input_val), ("train", "val")):
@@ -539,7 +576,7 @@ def main(args):
             args=args,
             n_frames=args.frames,
             delta_frames=args.delta,
-            augmenter=augmenter,
+            augmenter=None if args.batch_crops else augmenter,
             reject_background=args.reject_background,
         )
         for split in args.split_train
@@ -561,10 +598,12 @@ def main(args):
     )
 
     loader_train = _create_loader(
-        data_train, args=args, num_samples=args.train_samples_per_epoch, num_workers=args.num_workers
+        data_train, args=args, num_samples=args.train_samples_per_epoch, num_workers=args.num_workers,
+        augmenter=augmenter, rank=rank, world_size=world_size,
     )
     loader_val = _create_loader(
-        data_val, args=args, num_samples=args.val_samples_per_epoch, num_workers=0
+        data_val, args=args, num_samples=args.val_samples_per_epoch, num_workers=0,
+        rank=rank, world_size=world_size,
     )
 
     logger.info(f"Training set: {len(data_train)} images")
@@ -583,16 +622,15 @@ def main(args):
     )
 
     model = TimeArrowNet(**model_kwargs)
-
-    if n_gpus > 1:
-        model = nn.DataParallel(model)
-        logger.info("Model wrapped with DataParallel for multi-GPU training.")
+    if args.compile:
+        model.compile()
 
     model.to(device)
     logger.info(f"Number of parameters: {sum(p.numel() for p in model.parameters()) / 1.e6:.2f} Million")
 
-    save_partial_config(args, outdir)
-    save_full_config(args, outdir)
+    if main_process:
+        save_partial_config(args, outdir)
+        save_full_config(args, outdir)
 
     assert args.ndim == 2
 
@@ -605,7 +643,7 @@ def main(args):
             lr_scheduler=args.lr_scheduler,
             lr_patience=args.lr_patience,
             epochs=args.epochs,
-            steps_per_epoch=args.train_samples_per_epoch // args.batchsize,
+            steps_per_epoch=args.train_samples_per_epoch // (args.batchsize * world_size),
             visual_datasets=tuple(
                 Subset(d, list(range(0, len(d), 1 + (len(d) // args.cam_subsampling))))
                 for d in data_visuals
@@ -614,6 +652,9 @@ def main(args):
             tensorboard=bool(args.tensorboard),
             save_checkpoint_every=args.save_checkpoint_every,
             lambda_decorrelation=args.decor_loss,
+            mixed_precision=args.mixed_precision,
+            channels_last=args.channels_last,
+            export=args.export,
         )
         # --------------- PATCH: Add epoch column if missing ---------------
         if metrics and 'epoch' not in metrics[0]:
@@ -624,19 +665,21 @@ def main(args):
         logger.error(f"Training failed with error: {e}")
         sys.exit(1)
 
+    if not main_process:
+        tarrow.utils.cleanup_distributed()
+        return
+
     save_metrics_csv(metrics, outdir)
 
     model_kwargs_serializable = model_kwargs.copy()
     model_kwargs_serializable['device'] = str(model_kwargs_serializable['device'])
+    model_kwargs_serializable['outdir'] = str(model_kwargs_serializable['outdir'])
     model_folder = outdir / f"{outdir.name}_backbone_{args.backbone}"
     model_folder.mkdir(parents=True, exist_ok=True)
     figures_dir = outdir / "figures"
     figures_dir.mkdir(exist_ok=True)
 
-    if isinstance(model, nn.DataParallel):
-        torch.save(model.module.state_dict(), model_folder / "model.pth")
-    else:
-        torch.save(model.state_dict(), model_folder / "model.pth")
+    torch.save(model.state_dict(), model_folder / "model.pth")
 
     with open(model_folder / "model_kwargs.yaml", "w") as f:
         yaml.safe_dump(model_kwargs_serializable, f)
@@ -655,6 +698,8 @@ def main(args):
     if args.write_final_cams:
         _write_cams(data_visuals, model, device)
 
+    tarrow.utils.cleanup_distributed()
+
 if __name__ == "__main__":
     parser = get_argparser()
     args, unknown = parser.parse_known_args()
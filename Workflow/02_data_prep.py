@@ -96,7 +96,12 @@ class CellEventDataset(Dataset):
             random_crop=True,
             reject_background=False,
             crops_per_image=1,
-            min_pixels=10
+            min_pixels=10,
+            cache_dir=None,
+            load_workers=None,
+            proposal="random",
+            positive_fraction=0.5,
+            proposal_candidates=32
     ):
         super().__init__()
         import numpy as np
@@ -117,43 +122,81 @@ class CellEventDataset(Dataset):
         self._permute = permute
         self._channels = channels
         self._device = device
+        self._load_workers = load_workers
         self._augmenter = augmenter
         if self._augmenter is not None:
             self._augmenter.to(device)
         self._crops_per_image = crops_per_image
         self._min_pixels = min_pixels
 
-        # Read and process imgs
-        if isinstance(imgs, (str, Path)):
-            imgs = self._load(
-                path=imgs,
+        # "random": uniform crop origins. "events": a crop is drawn around an event with probability positive_fraction,
+        # and from the event-free crops otherwise (as far as they can be found among proposal_candidates).
+        assert proposal in ["random", "events"]
+        self._proposal = proposal
+        self._positive_fraction = positive_fraction
+        self._proposal_candidates = proposal_candidates
+        self._event_pixels = {}
+
+        # Read and process imgs, reusing a cached normalized stack if available
+        cache = None
+        cached_imgs = None
+        if cache_dir is not None and isinstance(imgs, (str, Path)) and normalize is None:
+            from tarrow.data.frame_cache import FrameCache
+            cache = FrameCache(cache_dir)
+            cache_sources = self._source_files(imgs)
+            cache_params = dict(
+                dataset=type(self).__name__,
                 split_start=split_start,
                 split_end=split_end,
                 n_images=n_images,
+                channels=channels,
+                binarize=binarize,
+                normalize=None if binarize else dict(pmin=1, pmax=99.8, subsample=8),
             )
-        elif isinstance(imgs, (tuple, list, np.ndarray)) and isinstance(imgs[0], np.ndarray):
-            imgs = np.asarray(imgs)[:n_images]
-        else:
-            raise ValueError(
-                f"Cannot form a dataset from {imgs}. "
-                "Input should be either a path to a sequence of 2d images, a single 2d+time image, or a list of 2d np.ndarrays."
-            )
-        if self._channels == 0:
-            imgs = np.expand_dims(imgs, 1)
+            cache_key = cache.key(cache_sources, cache_params)
+            cached_imgs = cache.open(cache_key)
+
+        if cached_imgs is not None:
+            imgs = np.array(cached_imgs)
         else:
-            imgs = imgs[:, : self._channels, ...]
+            if isinstance(imgs, (str, Path)):
+                imgs = self._load(
+                    path=imgs,
+                    split_start=split_start,
+                    split_end=split_end,
+                    n_images=n_images,
+                )
+            elif isinstance(imgs, (tuple, list, np.ndarray)) and isinstance(imgs[0], np.ndarray):
+                imgs = np.asarray(imgs)[:n_images]
+            else:
+                raise ValueError(
+                    f"Cannot form a dataset from {imgs}. "
+                    "Input should be either a path to a sequence of 2d images, a single 2d+time image, or a list of 2d np.ndarrays."
+                )
+            if self._channels == 0:
+                imgs = np.expand_dims(imgs, 1)
+            else:
+                imgs = imgs[:, : self._channels, ...]
 
-        assert imgs.shape[1] == 1
+            assert imgs.shape[1] == 1
 
-        if binarize:
-            logger.debug("Binarize images")
-            imgs = (imgs > 0).astype(np.float32)
-        else:
-            logger.debug("Normalize images")
-            if normalize is None:
-                imgs = self._default_normalize(imgs)
+            if binarize:
+                logger.debug("Binarize images")
+                imgs = (imgs > 0).astype(np.float32)
             else:
-                imgs = normalize(imgs)
+                logger.debug("Normalize images")
+                if normalize is None:
+                    # normalize straight into the cache file if caching
+                    out = None if cache is None else cache.create(cache_key, imgs.shape)
+                    imgs = self._default_normalize(imgs, out=out)
+                else:
+                    imgs = normalize(imgs)
+            if cache is not None:
+                if not isinstance(imgs, np.memmap):
+                    cached_imgs = cache.create(cache_key, imgs.shape)
+                    cached_imgs[:] = imgs
+                    imgs = cached_imgs
+                imgs = np.array(cache.commit(cache_key, imgs, cache_sources, cache_params))
 
         # Read and process masks
         if isinstance(masks, (str, Path)):
@@ -225,6 +268,8 @@ class CellEventDataset(Dataset):
 
         # Precompute the time slices, get image-mask pairs (I_t, I_{t+\delta t), M_t, M_{t+\delta t})
         self._imgs_masks_sequences = []
+        self._sequence_frames = []
+        self._event_counts = {}
         for delta in self._delta_frames:
             n, k = self._n_frames, delta
             logger.debug(f"Creating delta {delta} crops")
@@ -233,6 +278,10 @@ class CellEventDataset(Dataset):
             )
             imgs_masks_sequences = [(torch.as_tensor(imgs[ss]), torch.as_tensor(masks[ss])) for ss in tslices]
             self._imgs_masks_sequences.extend(imgs_masks_sequences)
+            self._sequence_frames.extend(list(range(len(masks)))[ss] for ss in tslices)
+
+        # Integral images of the binarised masks, for O(1) event pixel counts of any crop
+        self._mask_integrals = self._integral_images(masks, max_count=int(np.prod(self._size)))
 
     def _reject_background(self, random_seed, threshold=0.02, max_iterations=10):
         from torchvision import transforms
@@ -263,15 +312,22 @@ class CellEventDataset(Dataset):
 
         return crop
 
-    def _default_normalize(self, imgs):
-        from tqdm import tqdm
-        from utils import normalize as utils_normalize
+    def _default_normalize(self, imgs, out=None):
+        from utils import normalize_stack
         import numpy as np
 
-        imgs_norm = []
-        for img in tqdm(imgs, desc="normalizing images", leave=False):
-            imgs_norm.append(utils_normalize(img, subsample=8))
-        return np.stack(imgs_norm)
+        return normalize_stack(np.asarray(imgs), subsample=8, out=out)
+
+    def _source_files(self, path):
+        """Files that the images given by `path` are read from."""
+        inp = Path(path).expanduser()
+        if inp.is_dir():
+            for s in ("png", "jpg", "tif", "tiff"):
+                fnames = sorted(inp.glob(f"*.{s}"))
+                if len(fnames) > 0:
+                    return fnames
+            raise ValueError(f"Could not find any images in {inp}")
+        return [inp]
 
     def _load(self, path, split_start, split_end, n_images=None):
         from pathlib import Path
@@ -317,30 +373,13 @@ class CellEventDataset(Dataset):
             split_start: float,
             split_end: float,
     ) -> np.ndarray:
-        import tifffile
-        from tqdm import tqdm
-        from pathlib import Path
-        import imageio
+        from tarrow.data.image_io import load_image_files
         idx_start = int(len(fnames) * split_start)
         idx_end = int(len(fnames) * split_end)
         fnames = fnames[idx_start:idx_end]
 
         logger.info(f"Load images {idx_start}-{idx_end}")
-        imgs = []
-        for f in tqdm(fnames, leave=False, desc="loading images"):
-            f = Path(f)
-            if f.suffix in (".tif", ".TIFF", ".tiff"):
-                x = tifffile.imread(f)
-            elif f.suffix in (".png", ".jpg", ".jpeg"):
-                x = imageio.imread(f)
-                if x.ndim == 3:
-                    x = np.moveaxis(x[..., :3], -1, 0)
-            else:
-                continue
-            x = np.squeeze(x)
-            imgs.append(x)
-        imgs = np.stack(imgs)
-        return imgs
+        return load_image_files(fnames, num_workers=self._load_workers)
 
     def __len__(self):
         return len(self._imgs_masks_sequences)
@@ -375,28 +414,139 @@ class CellEventDataset(Dataset):
             event_label = torch.tensor(0)
         return event_label
 
+    @staticmethod
+    def _integral_images(masks, max_count=None, chunk_size=64):
+        """
+        Summed-area tables of a (T, H, W) stack of binary masks, zero-padded to shape (T, H + 1, W + 1).
+        If the counted crops have less than 2**16 pixels (max_count), the tables are stored modulo 2**16 as int16,
+        at half the memory: a crop count is a difference of four entries and stays exact modulo 2**16.
+        """
+        T, H, W = masks.shape
+        wrap = max_count is not None and max_count < 2**16
+        sat = torch.zeros((T, H + 1, W + 1), dtype=torch.int16 if wrap else torch.int32)
+        for start in range(0, T, chunk_size):
+            chunk = masks[start : start + chunk_size] > 0
+            chunk = chunk.cumsum(1, dtype=torch.int32).cumsum(2, dtype=torch.int32)
+            if wrap:
+                chunk = chunk & 0xFFFF
+                chunk = torch.where(chunk >= 2**15, chunk - 2**16, chunk)
+            sat[start : start + chunk_size, 1:, 1:] = chunk
+        return sat
+
+    def event_pixel_counts(self, t, i, j, h, w):
+        """
+        Number of foreground mask pixels in the crops [i:i+h, j:j+w] of mask frames t, from four lookups
+        into the integral images. t, i and j can be broadcastable index tensors, to count many crops at once.
+        """
+        sat = self._mask_integrals
+        counts = sat[t, i + h, j + w].int() - sat[t, i, j + w] - sat[t, i + h, j] + sat[t, i, j]
+        if sat.dtype == torch.int16:
+            # tables modulo 2**16, see `_integral_images`
+            counts = counts & 0xFFFF
+        return counts
+
+    def crop_event_labels(self, idx, i, j):
+        """
+        Event labels of crops of size `self._size` at origins (i, j) (scalars or 1d tensors) of sequence idx.
+        Same rule as `label_image_pair` on the cropped masks of the first two frames.
+        """
+        i, j = torch.as_tensor(i), torch.as_tensor(j)
+        t = torch.as_tensor(self._sequence_frames[idx][:2]).reshape((-1,) + (1,) * i.ndim)
+        counts = self.event_pixel_counts(t, i, j, *self._size)
+        return (counts > max(self._min_pixels, 0)).any(dim=0).long()
+
+    def event_pixel_index(self, idx):
+        """
+        Event pixels of sequence idx (union of the first two masks), grouped by connected component.
+        Returns (pixels (N, 2), component start offsets, component sizes), or None if there are no events. Cached.
+        """
+        if idx not in self._event_pixels:
+            from skimage.measure import label as connected_components
+
+            _, y = self._imgs_masks_sequences[idx]
+            components = connected_components((y[:2] > 0).any(dim=0).numpy())
+            ys, xs = np.nonzero(components)
+            if len(ys) == 0:
+                self._event_pixels[idx] = None
+            else:
+                ids = components[ys, xs]
+                order = np.argsort(ids, kind="stable")
+                sizes = np.bincount(ids)[1:]
+                starts = np.cumsum(sizes) - sizes
+                self._event_pixels[idx] = (
+                    torch.as_tensor(np.stack((ys[order], xs[order]), axis=1)),
+                    torch.as_tensor(starts),
+                    torch.as_tensor(sizes),
+                )
+        return self._event_pixels[idx]
+
+    def propose_crop_origin(self, idx):
+        """
+        Event-aware crop origin for sequence idx. Draws `proposal_candidates` origins, either around event pixels
+        (a uniformly chosen component, a uniformly chosen pixel of it, placed at a random position inside the crop)
+        or uniformly, labels all of them at once and returns the first one of the wanted class.
+        """
+        _, y = self._imgs_masks_sequences[idx]
+        H, W = y.shape[-2:]
+        h, w = self._size
+        n = self._proposal_candidates
+
+        index = self.event_pixel_index(idx)
+        want_event = index is not None and torch.rand(()).item() < self._positive_fraction
+        if want_event:
+            pixels, starts, sizes = index
+            c = torch.randint(0, len(sizes), (n,))
+            p = pixels[starts[c] + (torch.rand(n) * sizes[c]).long()]
+            i = (p[:, 0] - torch.randint(0, h, (n,))).clamp(0, H - h)
+            j = (p[:, 1] - torch.randint(0, w, (n,))).clamp(0, W - w)
+        else:
+            i = torch.randint(0, H - h + 1, (n,))
+            j = torch.randint(0, W - w + 1, (n,))
+
+        hits = torch.nonzero(self.crop_event_labels(idx, i, j) == int(want_event))
+        k = hits[0, 0] if len(hits) > 0 else 0
+        return i[k].item(), j[k].item()
+
+    def tile_event_labels(self, masks, tile_size):
+        """
+        Binary event label of every (tile_size x tile_size) tile of a stack of binary masks of shape (T, H, W).
+        Same rule as `mask_to_label`: a tile is an event if it has more than `min_pixels` foreground pixels.
+        Tiles at the border are zero-padded. Returns a bool tensor of shape (T, ceil(H / tile_size), ceil(W / tile_size)).
+        """
+        T, H, W = masks.shape
+        nh, nw = -(-H // tile_size), -(-W // tile_size)
+        fg = torch.nn.functional.pad(
+            (masks > 0).to(torch.uint8), (0, nw * tile_size - W, 0, nh * tile_size - H)
+        )
+        counts = fg.reshape(T, nh, tile_size, nw, tile_size).sum(dim=(2, 4), dtype=torch.int32)
+        return counts > max(self._min_pixels, 0)
+
     def count_event_labels_one_pair(self, image1, image2, tile_size):
-        event_count = torch.tensor(0)
-        image_h, image_w = image1.size()[0], image1.size()[1]
-        from torchvision import transforms
-        for i in range(0, image_h, tile_size):
-            for j in range(0, image_w, tile_size):
-                crop_1 = transforms.functional.crop(image1, i, j, tile_size, tile_size)
-                crop_2 = transforms.functional.crop(image2, i, j, tile_size, tile_size)
-                event_count += self.label_image_pair(mask1=crop_1, mask2=crop_2)
-        return event_count
+        """Number of tiles that are an event in either of the two masks."""
+        labels = self.tile_event_labels(torch.stack((image1, image2)), tile_size)
+        return (labels[0] | labels[1]).sum()
+
+    def event_count(self, idx, tile_size=64):
+        """Cached event tile count of the mask pair of sequence `idx` (masks do not change)."""
+        key = (idx, tile_size)
+        if key not in self._event_counts:
+            _, y = self._imgs_masks_sequences[idx]
+            self._event_counts[key] = self.count_event_labels_one_pair(y[0], y[1], tile_size)
+        return self._event_counts[key]
 
     def generate_one_datapoint(self, idx):
         if isinstance(idx, (list, tuple)):
             return list(self[_idx] for _idx in idx)
 
-        x, y = self._imgs_masks_sequences[idx]
-        i, j, h, w = self._crop.get_params(x, output_size=self._size)
+        x, _ = self._imgs_masks_sequences[idx]
+        if self._proposal == "events":
+            (i, j), (h, w) = self.propose_crop_origin(idx), self._size
+        else:
+            i, j, h, w = self._crop.get_params(x, output_size=self._size)
         from torchvision import transforms
         x_crop = transforms.functional.crop(x, i, j, h, w)
-        y_crop = transforms.functional.crop(y, i, j, h, w)
 
-        event_label = self.label_image_pair(mask1=y_crop[0], mask2=y_crop[1])
+        event_label = self.crop_event_labels(idx, i, j)
 
         if self._permute:
             if self._mode == "flip":
@@ -420,8 +570,7 @@ class CellEventDataset(Dataset):
         return x_crop, event_label, label, crop_coordinates
 
     def __getitem__(self, idx):
-        x, y = self._imgs_masks_sequences[idx]
-        total_event_count = self.count_event_labels_one_pair(y[0], y[1], tile_size=64)
+        total_event_count = self.event_count(idx, tile_size=64)
         total_event_count = total_event_count.to(self._device)
         sample = [tuple(self.generate_one_datapoint(idx)) for i in range(self._crops_per_image)]
         return sample, total_event_count
@@ -439,7 +588,9 @@ def _build_dataset(
         random_crop=True,
         reject_background=False,
         crops_per_image=1,
-        min_pixels=10
+        min_pixels=10,
+        proposal="random",
+        positive_fraction=0.5
 ):
     return CellEventDataset(
         imgs=imgs,
@@ -460,7 +611,10 @@ def _build_dataset(
         random_crop=random_crop,
         reject_background=reject_background,
         crops_per_image=crops_per_image,
-        min_pixels=min_pixels
+        min_pixels=min_pixels,
+        cache_dir=args.cache_dir,
+        proposal=proposal,
+        positive_fraction=positive_fraction
     )
 
 def flatten_data(input_data, crops_per_image):
@@ -470,6 +624,13 @@ def flatten_data(input_data, crops_per_image):
             flat_data.append((input_data[i][0][j]))
     return flat_data
 
+def write_crops(input_data, writer):
+    """Streams all crops of a dataset into a CropStoreWriter, one image pair at a time."""
+    for i in range(len(input_data)):
+        for x_crop, event_label, label, crop_coordinates in input_data[i][0]:
+            writer.append(x_crop.cpu().numpy(), event_label, label, crop_coordinates)
+    return len(writer)
+
 def get_argparser():
     parser = configargparse.ArgumentParser()
     parser.add_argument("--input_frame", type=str, required=True)
@@ -484,6 +645,12 @@ def get_argparser():
     parser.add_argument("--binarize", action="store_true")
     parser.add_argument("--data_seed", type=int, default=42)
     parser.add_argument("--n_images", type=int, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None, help="Cache normalized input frames in this folder to speed up subsequent runs.")
+    parser.add_argument("--crop_proposal", type=str, default="random", choices=["random", "events"], help="'random': uniform crops. 'events': draw crops around mask events with probability --positive_fraction, event-free crops otherwise.")
+    parser.add_argument("--positive_fraction", type=float, default=0.5, help="Fraction of event crops for --crop_proposal events.")
+    parser.add_argument("--output_format", type=str, default="store", choices=["store", "pth"], help="'store': sharded, memory-mappable crop store folder. 'pth': single pickled list of crops (legacy).")
+    parser.add_argument("--crop_dtype", type=str, default="float16", choices=["float16", "float32", "uint8"], help="Storage type of the crops in the crop store.")
+    parser.add_argument("--shard_size", type=int, default=4096, help="Number of crops per shard of the crop store.")
     return parser
 
 def main():
@@ -519,19 +686,28 @@ def main():
                 n_frames=args.frames,
                 delta_frames=time_delta,
                 crops_per_image=args.crops_per_image,
-                min_pixels=args.min_pixels
+                min_pixels=args.min_pixels,
+                proposal=args.crop_proposal,
+                positive_fraction=args.positive_fraction
             )
             for inp, mask in zip(inputs_frame, inputs_mask)
         )
     )
 
     start_time = datetime.now()
-    image_crops_flat = flatten_data(image_crops, args.crops_per_image)
-
     os.makedirs(args.data_save_dir, exist_ok=True)
-    save_path = Path(args.data_save_dir) / "preprocessed_image_crops.pth"
-    torch.save(image_crops_flat, save_path)
-    print(f"Image crops saved to {save_path}!")
+    if args.output_format == "store":
+        from tarrow.data.crop_store import CropStoreWriter
+
+        save_path = Path(args.data_save_dir) / "preprocessed_image_crops"
+        with CropStoreWriter(save_path, shard_size=args.shard_size, dtype=args.crop_dtype) as writer:
+            n_crops = write_crops(image_crops, writer)
+        print(f"{n_crops} image crops saved to {save_path}!")
+    else:
+        image_crops_flat = flatten_data(image_crops, args.crops_per_image)
+        save_path = Path(args.data_save_dir) / "preprocessed_image_crops.pth"
+        torch.save(image_crops_flat, save_path)
+        print(f"Image crops saved to {save_path}!")
 
     elapsed = (datetime.now() - start_time).total_seconds()
     print(f"Data pre-processing completed in {elapsed:.2f} seconds.")
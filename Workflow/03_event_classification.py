@@ -5,6 +5,7 @@ import matplotlib
 matplotlib.use('Agg')  # <--- Fix: Use Agg for headless environments
 import csv
 import sys
+import time
 import os
 from pathlib import Path
 from datetime import datetime
@@ -15,10 +16,13 @@ import pandas as pd
 import logging
 import configargparse
 import tarrow
+from tarrow.data.crop_store import CropStore, open_crops
+from tarrow.data.samplers import BalancedSampler, SAMPLING_MODES
+from tarrow.models.embedding_cache import EmbeddingCache, EmbeddedCrops
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Sampler, RandomSampler
+from torch.utils.data import DataLoader, RandomSampler
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -218,6 +222,7 @@ class ClsHead(nn.Module):
         batch_size, time_step, channel, height, width = input_shape
         # input shape (Batch, Time, Channel, X, Y)
         self.flattened_size = time_step*channel*height*width
+        self.window = (height, width)
 
         # using a fully connected layer
         self.fc = nn.Linear(self.flattened_size, num_cls)
@@ -227,6 +232,14 @@ class ClsHead(nn.Module):
         x = self.fc(x)
         return x
 
+    def dense_forward(self, z, stride=1):
+        """
+        Logits of all windows of a full-frame embedding z (Time, Channel, X, Y), shape (num_cls, X', Y').
+        The fully connected layer is a correlation of z with its weights.
+        """
+        weight = self.fc.weight.view(self.fc.out_features, -1, *self.window)
+        return F.conv2d(z.reshape(1, -1, *z.shape[-2:]), weight, self.fc.bias, stride=stride)[0]
+
 
 # class ClsHead(nn.Module):
 #     """
@@ -283,19 +296,116 @@ def reinitialize_weights(model):
             init.zeros_(layer.bias)
 
 
+def build_cls_head(cls_head_arch, patch_size, device):
+    # shape of the dense representation from the pretrained U-net is '(1, 2, 32, patch_size, patch_size)'
+    if cls_head_arch == 'linear':
+        return ClsHead(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
+    elif cls_head_arch == 'resnet':
+        return SimpleResNet(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
+    elif cls_head_arch == 'minimal':
+        # For now, treat 'minimal' as 'linear'
+        return ClsHead(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
+    else:
+        raise ValueError(f"Unknown cls_head_arch: {cls_head_arch} (expected 'linear', 'resnet', or 'minimal')")
+
+
+def precision_recall_from_cm(cm_test):
+    """(precision class 0, precision class 1, recall class 0, recall class 1) of a 2x2 confusion matrix."""
+    precision_class_0 = cm_test[0][0] / (cm_test[0][0] + cm_test[1][0]) if (cm_test[0][0] + cm_test[1][0]) > 0 else float('nan')
+    precision_class_1 = cm_test[1][1] / (cm_test[0][1] + cm_test[1][1]) if (cm_test[0][1] + cm_test[1][1]) > 0 else float('nan')
+    recall_class_0 = cm_test[0][0] / (cm_test[0][0] + cm_test[0][1]) if (cm_test[0][0] + cm_test[0][1]) > 0 else float('nan')
+    recall_class_1 = cm_test[1][1] / (cm_test[1][0] + cm_test[1][1]) if (cm_test[1][0] + cm_test[1][1]) > 0 else float('nan')
+    return precision_class_0, precision_class_1, recall_class_0, recall_class_1
+
+
+class DebugSink:
+    """
+    Opt-in, rate-limited printing of per-sample predictions: at most max_lines lines in total,
+    and at most one batch every `interval` seconds. Only the printed samples are moved to the host.
+    """
+    def __init__(self, max_lines=0, interval=1.0):
+        self.max_lines = max_lines
+        self.interval = interval
+        self._n = 0
+        self._last = None
+
+    def __call__(self, y, predicted, probs):
+        if self._n >= self.max_lines:
+            return
+        now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval:
+            return
+        self._last = now
+        k = min(len(y), self.max_lines - self._n)
+        rows = torch.cat([y[:k, None].float(), predicted[:k, None].float(), probs[:k]], dim=1).tolist()
+        for i, (t, p, p0, p1) in enumerate(rows):
+            print(f"Sample {self._n + i}: True label = {int(t)}, Pred = {int(p)}, "
+                  f"Prob_class0 = {p0:.3f}, Prob_class1 = {p1:.3f}")
+        self._n += k
+
+
+def evaluate_cls_heads(embed, cls_heads, loader, device, criterion=None, debug=None):
+    """
+    Batched evaluation of classification heads on a shared embedding of every batch.
+    Predictions, probabilities, losses and confusion matrices are accumulated on the device
+    and moved to the host once at the end.
+    Returns one dict per head with numpy arrays y_true, y_pred, y_scores (probability of class 1),
+    the 2x2 confusion matrix cm, the accuracy and the mean loss (nan without criterion).
+    debug: optional DebugSink, fed with the predictions of the first head.
+    """
+    for cls_head in cls_heads:
+        cls_head.eval()
+    y_true = []
+    y_pred = [[] for _ in cls_heads]
+    probs = [[] for _ in cls_heads]
+    loss_sum = torch.zeros(len(cls_heads), device=device)
+    with torch.no_grad():
+        for datapoint in loader:
+            x, y = datapoint[0].to(device), datapoint[1].to(device)
+            rep = embed(x)
+            for k, cls_head in enumerate(cls_heads):
+                outputs = cls_head(rep)
+                if criterion is not None:
+                    loss_sum[k] += criterion(outputs, y) * x.size(0)
+                y_pred[k].append(outputs.argmax(1))
+                probs[k].append(torch.softmax(outputs, dim=1))
+            y_true.append(y)
+            if debug is not None:
+                debug(y, y_pred[0][-1], probs[0][-1])
+
+    y_true = torch.cat(y_true)
+    results = []
+    for k in range(len(cls_heads)):
+        pred, prob = torch.cat(y_pred[k]), torch.cat(probs[k])
+        cm = torch.bincount(2 * y_true + pred, minlength=4).reshape(2, 2)
+        results.append(dict(y_true=y_true, y_pred=pred, y_scores=prob[:, 1], cm=cm, loss=loss_sum[k]))
+    results = [{key: v.cpu().numpy() for key, v in r.items()} for r in results]
+    for r in results:
+        r["accuracy"] = np.trace(r["cm"]) / max(len(r["y_true"]), 1)
+        r["loss"] = float(r["loss"]) / len(r["y_true"]) if criterion is not None else float("nan")
+    return results
+
+
+def evaluate_cls_head(embed, cls_head, loader, device, criterion=None, debug=None):
+    """Batched evaluation of a single head, see `evaluate_cls_heads`."""
+    return evaluate_cls_heads(embed, [cls_head], loader, device, criterion, debug)[0]
+
+
 def train_cls_head(
     train_loader, test_loader, patch_size, num_epochs, random_seed, device,
     model_load_dir, cls_head_arch, TAP_init,
     load_saved_cls_head=False, cls_head_load_path=None,
-    output_dir=None
+    output_dir=None, embedded=False, debug=None
 ):
     """
     Train the classification head to the task of predicting cell event: no event, division, death
     for the input pair of patches.
+    If embedded, the loaders yield precomputed TAP embeddings (see `EmbeddingCache`) instead of crops.
+    debug: optional DebugSink for per-sample test predictions.
     """
     import torch.nn as nn
     import torch.optim as optim
-    from sklearn.metrics import confusion_matrix, classification_report
+    from sklearn.metrics import classification_report
     import pandas as pd
     import numpy as np
     import os
@@ -313,21 +423,14 @@ def train_cls_head(
 
     for parem in model.parameters():
         parem.requires_grad = False
+    embed = (lambda x: x) if embedded else model.embedding
 
     # shape of the dense representation from the pretrained U-net is '(1, 2, 32, patch_size, patch_size)'
     # fix the random seed for reproducibility
     torch.manual_seed(random_seed)
     torch.cuda.manual_seed_all(random_seed)
 
-    if cls_head_arch == 'linear':
-        cls_head = ClsHead(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
-    elif cls_head_arch == 'resnet':
-        cls_head = SimpleResNet(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
-    elif cls_head_arch == 'minimal':
-        # For now, treat 'minimal' as 'linear'
-        cls_head = ClsHead(input_shape=(1, 2, 32, patch_size, patch_size), num_cls=2).to(device)
-    else:
-        raise ValueError(f"Unknown cls_head_arch: {cls_head_arch} (expected 'linear', 'resnet', or 'minimal')")
+    cls_head = build_cls_head(cls_head_arch, patch_size, device)
 
     if load_saved_cls_head:
         print(f" - - Loading pretrained cls head - - ")
@@ -339,6 +442,8 @@ def train_cls_head(
 
     # --- Training Loop ---
     for epoch in range(num_epochs):
+        if hasattr(train_loader.sampler, "set_epoch"):
+            train_loader.sampler.set_epoch(epoch)
         cls_head.train()
         running_loss = 0.0
         correct = 0
@@ -347,7 +452,7 @@ def train_cls_head(
             x, y = datapoint[0].to(device), datapoint[1].to(device)
             # Forward pass through the pre-trained model to get the dense representation
             with torch.no_grad():
-                rep = model.embedding(x)
+                rep = embed(x)
             # Forward pass through the classification head
             outputs = cls_head(rep)
             # Calculate the loss
@@ -364,44 +469,16 @@ def train_cls_head(
         epoch_accuracy = correct / total
         print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {epoch_loss:.4f}, Accuracy: {epoch_accuracy:.4f}")
 
-    # --- TEST LOOP WITH DEBUG PRINTS ---
-    running_loss = 0.0
-    correct = 0
-    total = 0
-    count_event_interest = 0
-    y_pred = []
-    y_true = []
-    y_scores = []  # collect softmax probabilities for class 1
-    cls_head.eval()
-    print("\n=== Test set predictions (DEBUG) ===")
-    with torch.no_grad():
-        for datapoint in test_loader:
-            x, y = datapoint[0].to(device), datapoint[1].to(device)
-            rep = model.embedding(x)
-            outputs = cls_head(rep)
-            loss = criterion(outputs, y)
-            running_loss += loss.item() * x.size(0)
-            _, predicted = torch.max(outputs, 1)
-            correct += (predicted == y).sum().item()
-            total += y.size(0)
-            count_event_interest += (y == 1).sum().item()
-            y_pred.extend([t.item() for t in predicted])
-            y_true.extend([t.item() for t in y])
-            probs = torch.softmax(outputs, dim=1)
-            y_scores.extend(probs[:, 1].cpu().numpy())
-            # --- DEBUG PRINT for every sample ---
-            for i in range(x.size(0)):
-                print(f"Sample {i}: True label = {y[i].item()}, "
-                      f"Pred = {predicted[i].item()}, "
-                      f"Prob_class0 = {probs[i,0].item():.3f}, "
-                      f"Prob_class1 = {probs[i,1].item():.3f}")
-
-    epoch_loss = running_loss / total
-    epoch_accuracy = correct / total
-    print(f"\nTest Loss: {epoch_loss:.4f}, Test accuracy: {epoch_accuracy:.4f}")
-    print(f"There are {count_event_interest} out of {total} crops containing events of interest in the test set")
-
-    cm_test = confusion_matrix(y_true, y_pred)
+    # --- TEST LOOP ---
+    if debug is not None and debug.max_lines > 0:
+        print("\n=== Test set predictions (DEBUG) ===")
+    result = evaluate_cls_head(embed, cls_head, test_loader, device, criterion=criterion, debug=debug)
+    y_true, y_pred, y_scores = result["y_true"], result["y_pred"], result["y_scores"]
+    total = len(y_true)
+    print(f"\nTest Loss: {result['loss']:.4f}, Test accuracy: {result['accuracy']:.4f}")
+    print(f"There are {(y_true == 1).sum()} out of {total} crops containing events of interest in the test set")
+
+    cm_test = result["cm"]
     cm_df = pd.DataFrame(cm_test, index=['Actual 0', 'Actual 1'], columns=['Predicted 0', 'Predicted 1'])
     print("Confusion Matrix test data:")
     print(cm_df)
@@ -416,22 +493,10 @@ def train_cls_head(
         print(f"Saved test predictions to {output_dir}")
 
     # Distribution of positive labels in training set
-    count_event_interest_train = 0
-    total = 0
-    y_pred = []
-    y_true = []
-    with torch.no_grad():
-        for datapoint in train_loader:
-            x, y = datapoint[0].to(device), datapoint[1].to(device)
-            count_event_interest_train += (y == 1).sum().item()
-            total += y.size(0)
-            rep = model.embedding(x)
-            outputs = cls_head(rep)
-            _, predicted = torch.max(outputs, 1)
-            y_pred.extend([t.item() for t in predicted])
-            y_true.extend([t.item() for t in y])
-    print(f"There are {count_event_interest_train} out of {total} crops containing events of interest in the training set")
-    cm = confusion_matrix(y_true, y_pred)
+    result = evaluate_cls_head(embed, cls_head, train_loader, device)
+    y_true, y_pred = result["y_true"], result["y_pred"]
+    print(f"There are {(y_true == 1).sum()} out of {len(y_true)} crops containing events of interest in the training set")
+    cm = result["cm"]
     cm_df = pd.DataFrame(cm, index=['Actual 0', 'Actual 1'], columns=['Predicted 0', 'Predicted 1'])
     print("Confusion Matrix train data:")
     print(cm_df)
@@ -440,80 +505,111 @@ def train_cls_head(
     return cls_head, model, cm_test
     
 
+def train_cls_heads_concurrent(
+    train_loader, test_loader, patch_size, num_epochs, random_seeds, device,
+    model_load_dir, cls_head_arch,
+    load_saved_cls_head=False, cls_head_load_path=None, embedded=False, debug=None
+):
+    """
+    Train one classification head per seed at the same time, on the same batches.
+    The frozen TAP embedding of every batch is computed once and shared by all heads, every head has its own optimiser.
+    Gives the same heads as training them one after another with `train_cls_head` (with TAP_init 'loaded'),
+    as the balanced sampler yields the same batches in every run.
+    Prints the same test and train set reports per head as `train_cls_head`.
+    debug: optional DebugSink for per-sample test predictions of the first head.
+    Returns the heads, the TAP model and the test confusion matrix of every head.
+    """
+    import torch.optim as optim
+    from sklearn.metrics import classification_report
+    import pandas as pd
+
+    model = tarrow.models.TimeArrowNet.from_folder(model_folder=model_load_dir)
+    model.to(device)
+    for parem in model.parameters():
+        parem.requires_grad = False
+    embed = (lambda x: x) if embedded else model.embedding
+
+    heads = []
+    for random_seed in random_seeds:
+        torch.manual_seed(random_seed)
+        torch.cuda.manual_seed_all(random_seed)
+        cls_head = build_cls_head(cls_head_arch, patch_size, device)
+        if load_saved_cls_head:
+            cls_head.load_state_dict(torch.load(cls_head_load_path, map_location=device))
+        heads.append(cls_head)
+    optimizers = [optim.Adam(cls_head.parameters(), lr=0.001) for cls_head in heads]
+    criterion = nn.CrossEntropyLoss()
+
+    # --- Training Loop ---
+    for epoch in range(num_epochs):
+        if hasattr(train_loader.sampler, "set_epoch"):
+            train_loader.sampler.set_epoch(epoch)
+        for cls_head in heads:
+            cls_head.train()
+        running_loss = torch.zeros(len(heads), device=device)
+        correct = torch.zeros(len(heads), device=device)
+        total = 0
+        for datapoint in train_loader:
+            x, y = datapoint[0].to(device), datapoint[1].to(device)
+            with torch.no_grad():
+                rep = embed(x)
+            for k, (cls_head, optimizer) in enumerate(zip(heads, optimizers)):
+                outputs = cls_head(rep)
+                loss = criterion(outputs, y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                running_loss[k] += loss.detach() * x.size(0)
+                correct[k] += (outputs.argmax(1) == y).sum()
+            total += y.size(0)
+        for random_seed, l, c in zip(random_seeds, (running_loss / total).tolist(), (correct / total).tolist()):
+            print(f"Seed {random_seed} Epoch [{epoch+1}/{num_epochs}], Loss: {l:.4f}, Accuracy: {c:.4f}")
+
+    # --- Test Loop ---
+    if debug is not None and debug.max_lines > 0:
+        print(f"\n=== Test set predictions of seed {random_seeds[0]} (DEBUG) ===")
+    results = evaluate_cls_heads(embed, heads, test_loader, device, criterion=criterion, debug=debug)
+    cms = []
+    for random_seed, result in zip(random_seeds, results):
+        y_true, y_pred = result["y_true"], result["y_pred"]
+        cm_df = pd.DataFrame(result["cm"], index=['Actual 0', 'Actual 1'], columns=['Predicted 0', 'Predicted 1'])
+        print(f"\nSeed {random_seed}: Test Loss: {result['loss']:.4f}, Test accuracy: {result['accuracy']:.4f}")
+        print(f"There are {(y_true == 1).sum()} out of {len(y_true)} crops containing events of interest in the test set")
+        print("Confusion Matrix test data:")
+        print(cm_df)
+        print(classification_report(y_true, y_pred, target_names=['class 0', 'class 1']))
+        cms.append(result["cm"])
+
+    # Distribution of positive labels in training set
+    results = evaluate_cls_heads(embed, heads, train_loader, device)
+    for random_seed, result in zip(random_seeds, results):
+        y_true, y_pred = result["y_true"], result["y_pred"]
+        cm_df = pd.DataFrame(result["cm"], index=['Actual 0', 'Actual 1'], columns=['Predicted 0', 'Predicted 1'])
+        print(f"\nSeed {random_seed}: There are {(y_true == 1).sum()} out of {len(y_true)} crops containing events of interest in the training set")
+        print("Confusion Matrix train data:")
+        print(cm_df)
+        print(classification_report(y_true, y_pred, target_names=['class 0', 'class 1']))
+
+    return heads, model, cms
+
+
+def event_labels_of(data):
+    """Event labels of a list of crops, a CropStore or EmbeddedCrops (without reading the crops)."""
+    if isinstance(data, (CropStore, EmbeddedCrops)):
+        return data.event_labels
+    return np.array([int(x[1]) for x in data], dtype=np.int64)
+
+
 def count_data_points(dataloader):
     count = 0
     num_positive_event = 0
     for batch in dataloader:
-        inputs, event_labels, labels = batch[0], batch[1], batch[2]
+        inputs, event_labels = batch[0], batch[1]
         count += inputs.size(0)  # Increment by the batch size
         num_positive_event += (event_labels == 1).sum().item()
     return count, num_positive_event
 
 
-class BalancedSampler(Sampler):
-    def __init__(self, data_source, num_crops_per_image, balanced_sample_size, data_gen_seed, sequential=False):
-        self.data_source = data_source
-        self.sequential = sequential
-        self.num_crops_per_image = num_crops_per_image
-        self.balanced_sample_size = balanced_sample_size  # the number of samples after resampling and balancing
-        self.data_gen_seed = data_gen_seed
-        num_image_pairs = len(self.data_source)
-        # Separate the initial samples by label
-        self.positive_indices = []
-        self.negative_indices = []
-
-        for i in range(num_image_pairs):
-            if data_source[i][1] > 0:
-                self.positive_indices.append(i)
-            if data_source[i][1] == 0:
-                self.negative_indices.append(i)
-
-        # Ensure equal sampling from both classes
-        self.num_samples_per_class = min(self.balanced_sample_size // 2, len(self.positive_indices),
-                                         len(self.negative_indices))
-
-    def get_combined_samples(self, data_gen_seed):
-        import random
-        # for reproducibility
-        torch.manual_seed(data_gen_seed)
-
-        if self.sequential:
-            positive_samples = self.positive_indices[:self.num_samples_per_class]
-            negative_samples = self.negative_indices[:self.num_samples_per_class]
-        else:
-            positive_samples = torch.multinomial(
-                torch.ones(len(self.positive_indices)),
-                self.num_samples_per_class,
-                replacement=True
-            ).tolist()
-            positive_samples = [self.positive_indices[i] for i in positive_samples]
-
-            negative_samples = torch.multinomial(
-                torch.ones(len(self.negative_indices)),
-                self.num_samples_per_class,
-                replacement=True
-            ).tolist()
-            negative_samples = [self.negative_indices[i] for i in negative_samples]
-
-        # Combine positive and negative samples
-        # print(f"positive_samples : {len(positive_samples)}, negative_samples : {len(negative_samples)}")
-        combined_samples = positive_samples + negative_samples
-
-        # Shuffle the combined samples if not sequential
-        if not self.sequential:
-            # for reproducibility
-            random.seed(data_gen_seed + 123)
-            combined_samples = random.sample(combined_samples, len(combined_samples))
-        return combined_samples
-
-    def __iter__(self):
-        combined_samples = self.get_combined_samples(data_gen_seed=self.data_gen_seed)
-        return iter(combined_samples)
-
-    def __len__(self):
-        return 2 * self.num_samples_per_class
-
-
 def probing_mistake_predictions(model, cls_head, test_data_loader, device):
     """
     Output mistake predictions according to the type (e.g. false positive).
@@ -521,35 +617,36 @@ def probing_mistake_predictions(model, cls_head, test_data_loader, device):
     :param test_data:
     :param type_pred_err:
     :param num_outputs:
-    :param test_data_loader: batchsize must be 1
+    :param test_data_loader: any batch size, but a sequential sampler
     :return:
     """
-    false_positives = []
-    false_negatives = []
-    logits_false_pos = []
-    logits_false_neg = []
+    from torch.utils.data import SequentialSampler
+    from torch.utils.data.dataloader import default_collate
+
+    assert isinstance(test_data_loader.sampler, SequentialSampler)
     cls_head.eval()
+    logits, y_true = [], []
     with torch.no_grad():
         for datapoint in test_data_loader:
             x, y = datapoint[0].to(device), datapoint[1].to(device)
-            # Forward pass through the pre-trained model to get the dense representation
             # Ensure the pre-trained model is not being updated
-            rep = model.embedding(x)
-
-            # Forward pass through the classification head
-            outputs = cls_head(rep)
-            _, predicted = torch.max(outputs, 1)
-            datapoint.append(predicted.detach().cpu())
-            # datapoint : (x_crop, event_label, label, crop_coordinates, predicted_value)
-            # crop_coordinates = (torch.tensor(i), torch.tensor(j), torch.tensor(idx) (time index of the frame), TAP label)
-            if (predicted == 1) and (y == 0):
-                # false positive
-                false_positives.append(datapoint)
-                logits_false_pos.append(torch.squeeze(outputs.detach().cpu()))
-            elif (predicted == 0) and (y == 1):
-                false_negatives.append(datapoint)
-                logits_false_neg.append(torch.squeeze(outputs.detach().cpu()))
-
+            logits.append(cls_head(model.embedding(x)))
+            y_true.append(y)
+    logits, y_true = torch.cat(logits).cpu(), torch.cat(y_true).cpu()
+    predicted = logits.argmax(1)
+
+    def _datapoints(mask):
+        # datapoint : (x_crop, event_label, label, crop_coordinates, predicted_value), as from a batch_size=1 loader
+        # crop_coordinates = (torch.tensor(i), torch.tensor(j), torch.tensor(idx) (time index of the frame), TAP label)
+        out = []
+        for i in torch.nonzero(mask)[:, 0].tolist():
+            datapoint = default_collate([test_data_loader.dataset[i]])
+            datapoint.append(predicted[i:i + 1])
+            out.append(datapoint)
+        return out, list(logits[mask])
+
+    false_positives, logits_false_pos = _datapoints((predicted == 1) & (y_true == 0))
+    false_negatives, logits_false_neg = _datapoints((predicted == 0) & (y_true == 1))
     return false_positives, false_negatives, logits_false_pos, logits_false_neg
 
 
@@ -592,11 +689,7 @@ def estimate_total_events(input_data):
     :param data:
     :return: total count of event labels for the entire sequence of frames (a.k.a. movie)
     """
-    total_count_events = 0
-    for i in range(len(input_data)):
-        count_current_image = input_data[i][1].detach().item()
-        total_count_events += count_current_image
-    return total_count_events
+    return int(event_labels_of(input_data).sum())
 
 
 def save_as_json(input_data, file_save_path):
@@ -635,17 +728,23 @@ def data_split(input_image_crops, train_data_ratio, validation_data_ratio, data_
     """
     import random
     random.seed(data_seed)
-    random.shuffle(input_image_crops)
+    # shuffle indices, which gives the same permutation as shuffling the list itself
+    order = list(range(len(input_image_crops)))
+    random.shuffle(order)
 
     # Determine split indices
     total_length = len(input_image_crops)
     train_end = int(train_data_ratio * total_length)
     valid_end = train_end + int(validation_data_ratio * total_length)
 
-    # Split the list
-    train_data = input_image_crops[:train_end]
-    valid_data = input_image_crops[train_end:valid_end]
-    test_data = input_image_crops[valid_end:]
+    # Split the crops (a CropStore is split into index views, without copying)
+    if isinstance(input_image_crops, CropStore):
+        split = input_image_crops.subset
+    else:
+        split = lambda idx: [input_image_crops[i] for i in idx]
+    train_data = split(order[:train_end])
+    valid_data = split(order[train_end:valid_end])
+    test_data = split(order[valid_end:])
 
     # Verify the sizes
     print(f"Total data points: {total_length}")
@@ -662,7 +761,10 @@ def multi_runs_training(num_runs, model_seed_init, train_loader, test_loader,
                         TAP_init,
                         load_saved_cls_head=False,
                         cls_head_load_path=None,
-                        output_dir=None):  # <-- ADDED output_dir
+                        output_dir=None,
+                        embedded=False,
+                        concurrent=False,
+                        debug=None):
 
     import numpy as np
     import os
@@ -674,12 +776,34 @@ def multi_runs_training(num_runs, model_seed_init, train_loader, test_loader,
     cls_head_trained = None
     model = None
 
-    # These will collect the predictions/scores from the *last run*
-    y_true = []
-    y_pred = []
-    y_scores = []
+    if concurrent and TAP_init != 'loaded':
+        print(f"Concurrent runs disabled: TAP_init={TAP_init} re-initialises the TAP model in every run.")
+        concurrent = False
 
-    for i in range(num_runs):
+    if concurrent:
+        heads, model, cms = train_cls_heads_concurrent(
+            train_loader=train_loader,
+            test_loader=test_loader,
+            patch_size=size,
+            num_epochs=training_epochs,
+            random_seeds=[model_seed_init + i*20 for i in range(num_runs)],
+            device=device,
+            model_load_dir=model_load_dir,
+            cls_head_arch=cls_head_arch,
+            load_saved_cls_head=load_saved_cls_head,
+            cls_head_load_path=cls_head_load_path,
+            embedded=embedded,
+            debug=debug
+        )
+        cls_head_trained = heads[-1]
+        for cm_test in cms:
+            precision_class_0, precision_class_1, recall_class_0, recall_class_1 = precision_recall_from_cm(cm_test)
+            precision_class_0_all.append(precision_class_0)
+            precision_class_1_all.append(precision_class_1)
+            recall_class_0_all.append(recall_class_0)
+            recall_class_1_all.append(recall_class_1)
+
+    for i in range(0 if concurrent else num_runs):
         model_seed = model_seed_init + i*20
         cls_head_trained, model, cm_test = train_cls_head(
             cls_head_arch=cls_head_arch,
@@ -693,29 +817,21 @@ def multi_runs_training(num_runs, model_seed_init, train_loader, test_loader,
             load_saved_cls_head=load_saved_cls_head,
             cls_head_load_path=cls_head_load_path,
             TAP_init=TAP_init,
-            output_dir=output_dir  # <-- PASS output_dir TO SAVE .npy FILES
+            output_dir=output_dir,  # <-- PASS output_dir TO SAVE .npy FILES
+            embedded=embedded,
+            debug=debug
         )
-        precision_class_0 = cm_test[0][0] / (cm_test[0][0] + cm_test[1][0]) if (cm_test[0][0] + cm_test[1][0]) > 0 else float('nan')
-        precision_class_1 = cm_test[1][1] / (cm_test[0][1] + cm_test[1][1]) if (cm_test[0][1] + cm_test[1][1]) > 0 else float('nan')
-        recall_class_0 = cm_test[0][0] / (cm_test[0][0] + cm_test[0][1]) if (cm_test[0][0] + cm_test[0][1]) > 0 else float('nan')
-        recall_class_1 = cm_test[1][1] / (cm_test[1][0] + cm_test[1][1]) if (cm_test[1][0] + cm_test[1][1]) > 0 else float('nan')
+        precision_class_0, precision_class_1, recall_class_0, recall_class_1 = precision_recall_from_cm(cm_test)
         precision_class_0_all.append(precision_class_0)
         precision_class_1_all.append(precision_class_1)
         recall_class_0_all.append(recall_class_0)
         recall_class_1_all.append(recall_class_1)
 
     # After training, run predictions on the test set for reporting and visualizations
-    cls_head_trained.eval()
-    with torch.no_grad():
-        for datapoint in test_loader:
-            x, y = datapoint[0].to(device), datapoint[1].to(device)
-            rep = model.embedding(x)
-            outputs = cls_head_trained(rep)
-            _, predicted = torch.max(outputs, 1)
-            probs = torch.softmax(outputs, dim=1)
-            y_true.extend([t.item() for t in y])
-            y_pred.extend([t.item() for t in predicted])
-            y_scores.extend(probs[:, 1].cpu().numpy())
+    result = evaluate_cls_head(
+        (lambda x: x) if embedded else model.embedding, cls_head_trained, test_loader, device
+    )
+    y_true, y_pred, y_scores = result["y_true"], result["y_pred"], result["y_scores"]
 
     # --- Save y_true, y_pred, y_scores as .npy files to output_dir (figures) ---
     if output_dir is not None:
@@ -733,9 +849,12 @@ def multi_runs_training(num_runs, model_seed_init, train_loader, test_loader,
 def save_datasets(train_data_crops_flat, valid_data_crops_flat, test_data_crops_flat, dataset_save_dir):
     import os
     os.makedirs(dataset_save_dir, exist_ok=True)
-    torch.save(train_data_crops_flat, os.path.join(dataset_save_dir, 'train_data_crops_flat.pth'))
-    torch.save(valid_data_crops_flat, os.path.join(dataset_save_dir, 'valid_data_crops_flat.pth'))
-    torch.save(test_data_crops_flat, os.path.join(dataset_save_dir, 'test_data_crops_flat.pth'))
+    for name, data in (('train', train_data_crops_flat), ('valid', valid_data_crops_flat), ('test', test_data_crops_flat)):
+        if isinstance(data, CropStore):
+            # only the indices into the crop store
+            data.save_view(os.path.join(dataset_save_dir, f'{name}_data_crops_flat.npz'))
+        else:
+            torch.save(data, os.path.join(dataset_save_dir, f'{name}_data_crops_flat.pth'))
     print(f"Train, validation and test data all saved to {dataset_save_dir}")
 
 
@@ -957,6 +1076,18 @@ def main():
     p.add_argument("--TAP_model_load_path")
     p.add_argument("--cls_head_arch")
     p.add_argument("--TAP_init")
+    p.add_argument("--sampling_mode", choices=SAMPLING_MODES, default="replacement",
+                   help="How BalancedSampler draws the balanced training samples, reshuffled every epoch.")
+    p.add_argument("--debug_predictions", type=int, default=0,
+                   help="Print at most this many per-sample test predictions (rate-limited to one batch per second).")
+    p.add_argument("--probing_batchsize", type=int, default=64)
+    p.add_argument("--concurrent_runs", action="store_true",
+                   help="Train the heads of all --num_runs seeds at once on shared TAP embeddings, instead of one run after another.")
+    p.add_argument("--embedding_cache", default="off", choices=["off", "memory", "disk"],
+                   help="Compute the frozen TAP embeddings of the train/test crops once and train the heads on them. "
+                        "'disk' memory-maps them from --embedding_cache_dir. Embeddings are ~32x larger than the crops.")
+    p.add_argument("--embedding_cache_dir", default=None, help="Folder for --embedding_cache disk (default: <data_save_dir>/embeddings)")
+    p.add_argument("--embedding_cache_dtype", default="float16", choices=["float16", "float32"])
 
     args = p.parse_args()
     if not args.dataset_save_dir:
@@ -964,8 +1095,10 @@ def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Running on", device)
 
-    data_load_path = os.path.join(args.data_save_dir, 'preprocessed_image_crops.pth')
-    image_crops_flat_loaded = torch.load(data_load_path)
+    data_load_path = os.path.join(args.data_save_dir, 'preprocessed_image_crops')
+    if not os.path.isdir(data_load_path):
+        data_load_path += '.pth'
+    image_crops_flat_loaded = open_crops(data_load_path)
     print(f"image_crops_flat_loaded: {len(image_crops_flat_loaded)}")
     train_data_ratio = 0.6
     validation_data_ratio = 0.2
@@ -990,23 +1123,40 @@ def main():
 
     # === PRINT & SAVE CLASS BALANCE METRICS (before balancing) ===
     vis_outdir = os.path.join(args.data_save_dir, "figures")
-    labels_train_before = np.array([x[1] for x in train_data_crops_flat])
-    labels_valid = np.array([x[1] for x in valid_data_crops_flat])
-    labels_test = np.array([x[1] for x in test_data_crops_flat])
+    labels_train_before = event_labels_of(train_data_crops_flat)
+    labels_valid = event_labels_of(valid_data_crops_flat)
+    labels_test = event_labels_of(test_data_crops_flat)
 
     print_and_save_stats("Train BEFORE balancing", labels_train_before, vis_outdir, "train_before_balancing")
     print_and_save_stats("Validation", labels_valid, vis_outdir, "validation")
     print_and_save_stats("Test", labels_test, vis_outdir, "test")
 
     estimated_total_event_count = estimate_total_events(image_crops_flat_loaded)
+
+    # Frozen TAP embeddings, computed once instead of in every epoch of every run
+    train_inputs, test_inputs = train_data_crops_flat, test_data_crops_flat
+    embedded = False
+    if args.embedding_cache != "off":
+        if args.TAP_init != "loaded":
+            print(f"Embedding cache disabled: TAP_init={args.TAP_init} re-initialises the TAP model in every run.")
+        else:
+            cache_dir = None
+            if args.embedding_cache == "disk":
+                cache_dir = args.embedding_cache_dir or os.path.join(args.data_save_dir, "embeddings")
+            cache = EmbeddingCache(cache_dir, dtype=args.embedding_cache_dtype)
+            tap_model = tarrow.models.TimeArrowNet.from_folder(model_folder=args.TAP_model_load_path).to(device)
+            train_inputs = cache.embed(tap_model, train_data_crops_flat, batch_size=args.batchsize, device=device)
+            test_inputs = cache.embed(tap_model, test_data_crops_flat, batch_size=args.batchsize, device=device)
+            embedded = True
+            del tap_model
+
     train_loader = DataLoader(
-        train_data_crops_flat,
+        train_inputs,
         sampler=BalancedSampler(
-            train_data_crops_flat,
-            args.crops_per_image,
+            event_labels_of(train_inputs),
             args.balanced_sample_size,
-            data_gen_seed=args.data_seed,
-            sequential=False
+            seed=args.data_seed,
+            mode=args.sampling_mode
         ),
         batch_size=args.batchsize,
         num_workers=0,
@@ -1015,8 +1165,8 @@ def main():
     )
     torch.manual_seed(args.data_seed)
     test_loader = DataLoader(
-        test_data_crops_flat,
-        sampler=RandomSampler(test_data_crops_flat),
+        test_inputs,
+        sampler=RandomSampler(test_inputs),
         batch_size=args.batchsize,
         num_workers=0,
         drop_last=False,
@@ -1025,8 +1175,7 @@ def main():
 
     # === PRINT & SAVE CLASS BALANCE METRICS (AFTER balancing) ===
     sampler = train_loader.sampler
-    indices_balanced = list(sampler.get_combined_samples(args.data_seed))
-    labels_balanced = np.array([train_data_crops_flat[i][1] for i in indices_balanced])
+    labels_balanced = sampler.labels[sampler.indices(epoch=0)]
     print_and_save_stats("Train AFTER balancing", labels_balanced, vis_outdir, "train_after_balancing")
 
     print(f"Estimated event count: {estimated_total_event_count}")
@@ -1035,7 +1184,7 @@ def main():
     print(f"Loading pretrained TAP model from: {args.TAP_model_load_path}")
     test_loader_probing = DataLoader(
         test_data_crops_flat,
-        batch_size=1,
+        batch_size=args.probing_batchsize,
         num_workers=0,
         drop_last=False,
         persistent_workers=False
@@ -1052,7 +1201,10 @@ def main():
         TAP_init=args.TAP_init,
         load_saved_cls_head=args.load_saved_cls_head,
         cls_head_load_path=args.cls_head_load_path,
-        output_dir=vis_outdir)
+        output_dir=vis_outdir,
+        embedded=embedded,
+        concurrent=args.concurrent_runs,
+        debug=DebugSink(args.debug_predictions) if args.debug_predictions > 0 else None)
     print("Final Metrics (mean, std):")
     for label, values in zip(
         ["Precision Class 0", "Precision Class 1", "Recall Class 0", "Recall Class 1"],
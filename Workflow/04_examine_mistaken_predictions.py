@@ -9,7 +9,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import tarrow
-from torch.utils.data import DataLoader
+from tarrow.data.crop_store import open_crops
+from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 from datetime import datetime
 import logging
 from typing import Sequence
@@ -183,23 +185,13 @@ def _get_paths_recursive(paths: Sequence[str], level: int):
     return input_rec
 
 # ------------------- THIS IS THE ONLY NEW FUNCTION ADDED -------------------
-def _load_image_folder(fnames, split_start, split_end):
-    import tifffile
-    import numpy as np
+def _load_image_folder(fnames, split_start, split_end, num_workers=None):
+    from tarrow.data.image_io import load_image_files
 
-    imgs = []
     total = len(fnames)
     start = int(total * split_start)
     end = int(total * split_end)
-    fnames = fnames[start:end]
-    for fname in fnames:
-        if str(fname).endswith('.tif') or str(fname).endswith('.tiff'):
-            img = tifffile.imread(str(fname))
-        else:
-            from PIL import Image
-            img = np.array(Image.open(fname))
-        imgs.append(img)
-    return np.stack(imgs)
+    return load_image_files(fnames[start:end], num_workers=num_workers)
 # --------------------------------------------------------------------------
 
 def _load(path, split_start, split_end, n_images=None):
@@ -358,6 +350,38 @@ def masks_lookup(coord_x, coord_y, patch_size, time_index, imgs_masks_sequences)
     masks_crops_2 = transforms.functional.crop(y, coord_x, coord_y, patch_size, patch_size)
     return masks_crops_1, masks_crops_2
 
+def batched_predictions(predict, test_loader, device):
+    """
+    Runs `predict` (crops -> logits) over a loader with a sequential sampler.
+    Logits and event labels are accumulated on the device and moved to the host once.
+    :return: logits (N, 2), predicted (N,), event labels (N,)
+    """
+    assert isinstance(test_loader.sampler, SequentialSampler), "test_loader must not shuffle"
+    logits, y_true = [], []
+    with torch.no_grad():
+        for datapoint in test_loader:
+            x, y = datapoint[0].to(device), datapoint[1].to(device)
+            logits.append(predict(x))
+            y_true.append(y)
+    logits, y_true = torch.cat(logits).cpu(), torch.cat(y_true).cpu()
+    return logits, logits.argmax(1), y_true
+
+
+def select_datapoints(dataset, mask, logits, predicted):
+    """
+    Datapoints and logits of the crops selected by a boolean mask.
+    Every datapoint has the layout of a batch_size=1 DataLoader, with the prediction appended:
+    (x_crop, event_label, label, crop_coordinates, predicted_value)
+    crop_coordinates = (torch.tensor(i), torch.tensor(j), torch.tensor(idx) (time index of the frame), TAP label)
+    """
+    datapoints = []
+    for i in torch.nonzero(mask)[:, 0].tolist():
+        datapoint = default_collate([dataset[i]])
+        datapoint.append(predicted[i:i + 1])
+        datapoints.append(datapoint)
+    return datapoints, list(logits[mask])
+
+
 def probing_mistake_predictions(model, cls_head, test_data_loader, device):
     """
     Output mistake predictions according to the type (e.g. false positive).
@@ -365,42 +389,18 @@ def probing_mistake_predictions(model, cls_head, test_data_loader, device):
     :param test_data:
     :param type_pred_err:
     :param num_outputs:
-    :param test_data_loader: batchsize must be 1
+    :param test_data_loader: any batch size, but a sequential sampler
     :return:
     """
-    false_positives = []
-    false_negatives = []
-    logits_false_pos = []
-    logits_false_neg = []
     cls_head.eval()
-    with torch.no_grad():
-        for datapoint in test_data_loader:
-            x, y = datapoint[0].to(device), datapoint[1].to(device)
-            # Forward pass through the pre-trained model to get the dense representation
-            # Ensure the pre-trained model is not being updated
-            rep = model.embedding(x)
-
-            # Forward pass through the classification head
-            outputs = cls_head(rep)
-            _, predicted = torch.max(outputs, 1)
-            datapoint.append(predicted.detach().cpu())
-            # datapoint : (x_crop, event_label, label, crop_coordinates, predicted_value)
-            # crop_coordinates = (torch.tensor(i), torch.tensor(j), torch.tensor(idx) (time index of the frame), TAP label)
-            if (predicted == 1) and (y == 0):
-                # false positive
-                false_positives.append(datapoint)
-                logits_false_pos.append(torch.squeeze(outputs.detach().cpu()))
-            elif (predicted == 0) and (y == 1):
-                false_negatives.append(datapoint)
-                logits_false_neg.append(torch.squeeze(outputs.detach().cpu()))
-
+    logits, predicted, y = batched_predictions(
+        lambda x: cls_head(model.embedding(x)), test_data_loader, device)
+    dataset = test_data_loader.dataset
+    false_positives, logits_false_pos = select_datapoints(dataset, (predicted == 1) & (y == 0), logits, predicted)
+    false_negatives, logits_false_neg = select_datapoints(dataset, (predicted == 0) & (y == 1), logits, predicted)
     return false_positives, false_negatives, logits_false_pos, logits_false_neg
 
 def probing_mistaken_preds(model, test_loader, device, is_true_positive, is_true_negative):
-    false_positives = []
-    false_negatives = []
-    logits_false_pos = []
-    logits_false_neg = []
     true_positives = []
     true_negatives = []
     logits_true_positives = []
@@ -408,27 +408,16 @@ def probing_mistaken_preds(model, test_loader, device, is_true_positive, is_true
     true_positives_coordinates = []
     true_negatives_coordinates = []
     model.eval()
-    with torch.no_grad():
-        for datapoint in test_loader:
-            x, y = datapoint[0].to(device), datapoint[1].to(device)
-            outputs = model(x)
-            _, predicted = torch.max(outputs, 1)
-            datapoint.append(predicted.detach().cpu())
-            if (predicted == 1) and (y == 0):
-                # false positive
-                false_positives.append(datapoint)
-                logits_false_pos.append(torch.squeeze(outputs.detach().cpu()))
-            elif (predicted == 0) and (y == 1):
-                false_negatives.append(datapoint)
-                logits_false_neg.append(torch.squeeze(outputs.detach().cpu()))
-            if is_true_positive:
-                if (predicted == 1) and (y == 1):
-                    true_positives.append(datapoint)
-                    logits_true_positives.append(torch.squeeze(outputs.detach().cpu()))
-            if is_true_negative:
-                if (predicted == 0) and (y == 0):
-                    true_negatives.append(datapoint)
-                    logits_true_negatives.append(torch.squeeze(outputs.detach().cpu()))
+    logits, predicted, y = batched_predictions(model, test_loader, device)
+    dataset = test_loader.dataset
+    false_positives, logits_false_pos = select_datapoints(dataset, (predicted == 1) & (y == 0), logits, predicted)
+    false_negatives, logits_false_neg = select_datapoints(dataset, (predicted == 0) & (y == 1), logits, predicted)
+    if is_true_positive:
+        true_positives, logits_true_positives = select_datapoints(
+            dataset, (predicted == 1) & (y == 1), logits, predicted)
+    if is_true_negative:
+        true_negatives, logits_true_negatives = select_datapoints(
+            dataset, (predicted == 0) & (y == 0), logits, predicted)
 
     false_positives_coordinates = [tuple(e[1:]) for e in false_positives]
     false_negatives_coordinates = [tuple(e[1:]) for e in false_negatives]
@@ -509,13 +498,14 @@ def main():
     parser.add_argument("--num_egs_to_show", type=int, default=10)
     parser.add_argument("--TAP_model_load_path", type=str)
     parser.add_argument("--patch_size", type=int, default=48)
-    parser.add_argument("--test_data_load_path", type=str)
+    parser.add_argument("--test_data_load_path", type=str, help="crop store folder, .npz view of a crop store, or .pth file")
     parser.add_argument("--combined_model_load_dir", type=str)
     parser.add_argument("--model_id", type=str)
     parser.add_argument("--is_true_positive", action="store_true")
     parser.add_argument("--is_true_negative", action="store_true")
     parser.add_argument("--cls_head_arch", type=str, help='linear or resnet')
     parser.add_argument("--save_data", action="store_true")
+    parser.add_argument("--batch_size", type=int, default=64, help="batch size for the predictions on the test data")
     args = parser.parse_args()
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -540,10 +530,10 @@ def main():
     for param in event_rec_model.parameters():
         param.requires_grad = False
 
-    test_data_crops_flat = torch.load(args.test_data_load_path)
+    test_data_crops_flat = open_crops(args.test_data_load_path)
     test_loader = DataLoader(
         test_data_crops_flat,
-        batch_size=1,
+        batch_size=args.batch_size,
         num_workers=0,
         drop_last=False,
         persistent_workers=False
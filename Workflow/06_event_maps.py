@@ -0,0 +1,127 @@
+# 06_event_maps.py
+"""
+Screen whole movies with a fine-tuned event classifier (from 03_event_classification.py).
+
+For every frame pair (t, t + delta_frames) the TAP embedding is computed once on the full frames
+(tiled with overlap), and the classification head is evaluated on all windows of size patch_size.
+The output is a chunked array of event probabilities of shape (T - delta_frames, H', W'),
+with H' = (H - patch_size) // stride + 1: entry [t, a, b] is the probability of an event
+in the crop with origin (a * stride, b * stride) of frame pair t.
+It can be read with `tarrow.data.ChunkedArray`.
+"""
+import sys
+import os
+import importlib
+from pathlib import Path
+import logging
+
+import numpy as np
+import torch
+
+# Dynamic TAP path (like in earlier scripts)
+script_dir = Path(__file__).resolve().parent
+project_root = script_dir.parent
+sys.path.insert(0, str(project_root / "TAP" / "tarrow"))
+
+import tarrow
+from tarrow.data import ChunkedArray, ChunkedArrayWriter
+from tarrow.models import event_maps
+from tarrow.utils import normalize_stack
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# classification heads and the combined model as trained in 03
+event_classification = importlib.import_module("03_event_classification")
+
+
+def load_movie(path):
+    """(T, 1, H, W) float32 frames of a 2d+time tif or a folder of 2d images, normalized as in 02_data_prep.py."""
+    import tifffile
+    from tarrow.data.image_io import load_image_files
+
+    inp = Path(path).expanduser()
+    if inp.is_dir():
+        fnames = sorted(f for s in ("png", "jpg", "tif", "tiff") for f in inp.glob(f"*.{s}"))
+        if len(fnames) == 0:
+            raise ValueError(f"Could not find any images in {inp}")
+        imgs = load_image_files(fnames)
+    else:
+        imgs = tifffile.imread(str(inp))
+    if imgs.ndim != 3:
+        raise ValueError(f"Expected a 2d+time movie, got shape {imgs.shape}")
+    return normalize_stack(np.expand_dims(imgs, 1), subsample=8)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_frame", required=True, help="movie: 2d+time tif or folder of 2d images")
+    parser.add_argument("--output_dir", required=True, help="output folder of the chunked event map")
+    parser.add_argument("--TAP_model_load_path", type=str, required=True)
+    parser.add_argument("--combined_model_load_dir", type=str, required=True)
+    parser.add_argument("--model_id", type=str, required=True)
+    parser.add_argument("--cls_head_arch", type=str, default="linear", help='linear, resnet or minimal')
+    parser.add_argument("--patch_size", type=int, default=48)
+    parser.add_argument("--stride", type=int, default=4, help="spacing of the classified windows in pixels")
+    parser.add_argument("--delta_frames", type=int, default=1)
+    parser.add_argument("--tile_size", type=int, default=256, help="tile size for the full-frame TAP embedding")
+    parser.add_argument("--tile_overlap", type=int, default=32)
+    parser.add_argument("--tile_batch_size", type=int, default=4, help="tiles per batch for the TAP embedding")
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help="peak memory (MB) of one batch of embedding tiles, overrides tile_size and tile_batch_size")
+    parser.add_argument("--batch_size", type=int, default=1024, help="windows per batch for non-linear heads")
+    parser.add_argument("--chunk_size", type=int, default=16, help="frame pairs per chunk of the output")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Running on", device)
+
+    TAPmodel = tarrow.models.TimeArrowNet.from_folder(model_folder=args.TAP_model_load_path)
+    cls_head = event_classification.build_cls_head(args.cls_head_arch, args.patch_size, device)
+    event_rec_model = event_classification.CellEventClassModel(TAPmodel=TAPmodel, ClsHead=cls_head)
+    model_state_path = os.path.join(args.combined_model_load_dir, f'{args.model_id}.pth')
+    event_rec_model.load_state_dict(torch.load(model_state_path, map_location=device))
+    event_rec_model.to(device)
+    event_rec_model.eval()
+
+    frames = load_movie(args.input_frame)
+    print(f"Movie shape: {frames.shape}")
+    n_pairs = len(frames) - args.delta_frames
+    map_shape = tuple((s - args.patch_size) // args.stride + 1 for s in frames.shape[-2:])
+    if n_pairs < 1 or min(map_shape) < 1:
+        raise ValueError(f"Movie of shape {frames.shape} too small for patch size {args.patch_size}")
+
+    attrs = dict(
+        input=str(args.input_frame),
+        model_id=args.model_id,
+        cls_head_arch=args.cls_head_arch,
+        patch_size=args.patch_size,
+        stride=args.stride,
+        delta_frames=args.delta_frames,
+    )
+    with ChunkedArrayWriter(args.output_dir, map_shape, dtype=args.dtype,
+                            chunk_size=args.chunk_size, attrs=attrs) as writer:
+        event_maps(
+            event_rec_model._TAPmodel,
+            event_rec_model._ClsHead,
+            frames,
+            window=(args.patch_size, args.patch_size),
+            stride=args.stride,
+            delta_frames=args.delta_frames,
+            tile_size=(args.tile_size, args.tile_size),
+            overlap=(args.tile_overlap, args.tile_overlap),
+            batch_size=args.batch_size,
+            device=device,
+            out=writer,
+            tile_batch_size=args.tile_batch_size,
+            memory_budget=None if args.memory_budget is None else args.memory_budget * 2**20,
+        )
+
+    maps = ChunkedArray(args.output_dir)
+    print(f"Saved event maps of shape {maps.shape} to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
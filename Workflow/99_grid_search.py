@@ -25,6 +25,8 @@ def parse_args():
     parser.add_argument('--backbone', type=str, default="unet")
     parser.add_argument('--hyperparam_yaml', type=str, help="YAML file with parameter grid")
     parser.add_argument('--hyperparam_csv', type=str, help="CSV file with explicit parameter sets (advanced)")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Shared cache of normalized input frames (default: <outdir>/frame_cache)")
     return parser.parse_args()
 
 def load_param_grid(args):
@@ -83,6 +85,7 @@ def run_pipeline(config, args, config_idx, run_idx, outdir):
         'binarize': False,
         'min_pixels': config['min_pixels'],
         'config_yaml': config_file,
+        'cache_dir': args.cache_dir or os.path.join(outdir, "frame_cache"),
     }
     with open(config_file, 'w') as f:
         yaml.dump(config_yaml, f)
@@ -347,7 +347,7 @@ EOL
         --masks_path "$CONTAINER_MASK" \
         --TAP_model_load_path "/app/$TAP_MODEL_DIR" \
         --patch_size "$CROP_SIZE" \
-        --test_data_load_path "$CONTAINER_OUTDIR/test_data_crops_flat.pth" \
+        --test_data_load_path "$CONTAINER_OUTDIR/test_data_crops_flat.npz" \
         --combined_model_load_dir "$CONTAINER_RUNSDIR" \
         --model_id "$MODEL_ID" \
         --cls_head_arch linear \